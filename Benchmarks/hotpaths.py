@@ -0,0 +1,311 @@
+"""
+Benchmark of the I/O and conversion hot paths of the module, without Slicer.
+NiftyRegLogic is imported with stubbed Slicer modules (see stubs.py) and runs
+on synthetic volumes and NIfTI displacement fields of each size.
+
+    python Benchmarks/hotpaths.py [--sizes 64 128 256 512]
+    python Benchmarks/hotpaths.py --save-baseline
+    python Benchmarks/hotpaths.py --check
+
+The startup benchmark imports NiftyReg in a new interpreter, as Slicer does
+when it starts, and lists the heavy dependencies that were imported.
+
+With --check, the exit code is 1 if a time or a peak memory is worse than
+the baseline by more than the tolerance.
+The timings are the best of --repeat runs. The peak memory is the peak of
+the NumPy and Python allocations during one more run (tracemalloc), so it
+does not include memory allocated by VTK or SimpleITK.
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARKS_DIR.parent))
+sys.path.insert(0, str(BENCHMARKS_DIR))
+
+import stubs
+
+vtk, HAS_REAL_VTK = stubs.install()
+
+import NiftyReg
+import NiftyRegLib
+from NiftyRegLib import registration
+from NiftyRegLib.nifti import NIFTI1_HEADER_DTYPE
+from NiftyRegLib.vectorfield import DISP_FIELD
+
+BASELINE_PATH = BENCHMARKS_DIR / 'baseline.json'
+MEGABYTE = 2.**20
+
+HEAVY_MODULES = 'numpy', 'SimpleITK', 'sitkUtils', 'vtk.util.numpy_support'
+
+STARTUP_SCRIPT = '''
+import sys
+import json
+import time
+import tracemalloc
+sys.path[:0] = {paths!r}
+import stubs
+stubs.install()
+heavyModules = [name for name in {heavyModules!r} if name in sys.modules]
+traceMemory = {traceMemory!r}
+if traceMemory:
+    tracemalloc.start()
+start = time.perf_counter()
+import NiftyReg
+seconds = time.perf_counter() - start
+peak = tracemalloc.get_traced_memory()[1] if traceMemory else None
+imported = [name for name in {heavyModules!r} if name in sys.modules and name not in heavyModules]
+print(json.dumps({{'seconds': seconds, 'peakMemory': peak, 'imported': imported}}))
+'''
+
+FAKE_ALADIN = '''#!{python}
+import sys
+import shutil
+args = sys.argv[1:]
+options = {{flag: value for flag, value in zip(args, args[1:] + [None]) if flag.startswith('-')}}
+for level in range(1, 3):
+    print('[reg_aladin] Current level: {{}} / 2'.format(level))
+with open(options['-aff'], 'w') as f:
+    f.write('1 0 0 0\\n0 1 0 0\\n0 0 1 0\\n0 0 0 1\\n')
+shutil.copyfile(options['-flo'], options['-res'])
+'''
+
+
+def writeDisplacementField(path, size, spacing=1.):
+    """
+    Dense NiftyReg displacement field with a smooth displacement
+    """
+    header = np.zeros(1, NIFTI1_HEADER_DTYPE)[0]
+    header['sizeof_hdr'] = NIFTI1_HEADER_DTYPE.itemsize
+    header['dim'] = [5, size, size, size, 1, 3, 1, 1]
+    header['datatype'] = 16
+    header['bitpix'] = 32
+    header['pixdim'] = [1, spacing, spacing, spacing, 1, 1, 1, 1]
+    header['vox_offset'] = 352
+    header['sform_code'] = 1
+    header['srow_x'] = [spacing, 0, 0, 0]
+    header['srow_y'] = [0, spacing, 0, 0]
+    header['srow_z'] = [0, 0, spacing, 0]
+    header['intent_name'] = b'NREG_TRANS'
+    header['intent_p1'] = DISP_FIELD
+    header['magic'] = b'n+1'
+    k = np.sin(np.linspace(0, np.pi, size, dtype=np.float32))
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(b'\0' * 4)
+        for component in range(3):
+            for z in range(size):
+                plane = np.full((size, size), k[z] * (component + 1), dtype=np.float32)
+                f.write(plane.tobytes())
+
+
+def writeFakeAladin(directory):
+    path = Path(directory) / 'reg_aladin'
+    path.write_text(FAKE_ALADIN.format(python=sys.executable))
+    path.chmod(0o755)
+    return str(path)
+
+
+def measure(function, repeat, number=1):
+    """
+    Returns the best time per call and the peak of traced memory
+    """
+    seconds = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def measureStartup(repeat):
+    """
+    Returns the best time to import NiftyReg in a new interpreter, the peak
+    of traced memory during one more import and the heavy modules imported
+    """
+
+    def run(traceMemory):
+        script = STARTUP_SCRIPT.format(paths=[str(BENCHMARKS_DIR.parent), str(BENCHMARKS_DIR)],
+                                       heavyModules=HEAVY_MODULES,
+                                       traceMemory=traceMemory)
+        output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+        return json.loads(output.splitlines()[-1])
+
+    seconds = min(run(False)['seconds'] for _ in range(repeat))
+    result = run(True)
+    return seconds, result['peakMemory'], result['imported']
+
+
+def getBenchmarks(logic, size, directory):
+    """
+    Returns (name, function, number of bytes processed or None, calls per timing)
+    """
+    sizeDir = Path(directory) / str(size)
+    sizeDir.mkdir()
+    fieldPath = str(sizeDir / 'displacement.nii')
+    writeDisplacementField(fieldPath, size)
+    fieldBytes = os.path.getsize(fieldPath)
+    volumeNode = stubs.makeVolumeNode(size)
+    volumeBytes = volumeNode.array.nbytes
+
+    def readStream():
+        stream = logic.getDataStreamFromVectorField(fieldPath)
+        return float(stream.sum(dtype=np.float64))
+
+    def exportVolume():
+        logic.exportedVolumes.clear()
+        return logic.getInputPath(volumeNode, str(sizeDir))
+
+    def getPyramid():
+        logic.pyramidShapesMaps.clear()
+        return logic.getPyramidShapesMap(volumeNode)
+
+    volumePath = exportVolume()
+    parameters = NiftyRegLib.RegistrationParameters('Rigid')
+
+    def runAladin():
+        aladinRegistration = NiftyRegLib.Registration(volumePath, volumePath, parameters, outputDir=str(sizeDir))
+        aladinRegistration.run()
+        assert aladinRegistration.succeeded(), aladinRegistration.errorOutput
+
+    benchmarks = [
+        ('getDataStreamFromVectorField', readStream, fieldBytes, 1),
+        ('getPyramidShapesMap', getPyramid, None, 1000),
+        ('getInputPath (temporary export)', exportVolume, volumeBytes, 1),
+        ('reg_aladin round trip (fake binary)', runAladin, volumeBytes, 1),
+    ]
+    if HAS_REAL_VTK:
+        benchmarks.insert(1, ('vectorfieldToDisplacementField',
+                              lambda: logic.vectorfieldToDisplacementField(fieldPath, volumeNode),
+                              fieldBytes, 1))
+    return benchmarks
+
+
+def getMatrixBenchmarks(directory):
+    matrix = np.identity(4)
+    matrix[:3] += np.random.default_rng(0).uniform(-1, 1, (3, 4))
+    path = str(Path(directory) / 'matrix.txt')
+    NiftyRegLib.writeNiftyRegMatrix(matrix, path)
+    return [
+        ('writeNiftyRegMatrix', lambda: NiftyRegLib.writeNiftyRegMatrix(matrix, path), None, 1000),
+        ('readNiftyRegMatrix', lambda: NiftyRegLib.readNiftyRegMatrix(path), None, 1000),
+    ]
+
+
+def runBenchmarks(sizes, repeat):
+    """
+    Returns {name: {size: {'seconds': ..., 'throughput': ..., 'peakMemory': ...}}}.
+    Benchmarks that do not depend on the size use the key 'any'
+    """
+    results = {}
+    logic = NiftyReg.NiftyRegLogic()
+
+    def record(name, key, function, numberOfBytes, number):
+        seconds, peak = measure(function, repeat, number=number)
+        result = {'seconds': seconds, 'peakMemory': peak, 'throughput': None}
+        if numberOfBytes is not None:
+            result['throughput'] = numberOfBytes / MEGABYTE / seconds
+        results.setdefault(name, {})[key] = result
+        report(name, key, result)
+
+    seconds, peak, imported = measureStartup(repeat)
+    name = 'import NiftyReg (new interpreter)'
+    results[name] = {'any': {'seconds': seconds, 'peakMemory': peak, 'throughput': None}}
+    report(name, 'any', results[name]['any'])
+    if imported:
+        print('  Imported at startup: {}'.format(', '.join(imported)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        registration.TRANSFORMATIONS_MAP['Rigid'] = writeFakeAladin(directory)
+        for name, function, numberOfBytes, number in getMatrixBenchmarks(directory):
+            record(name, 'any', function, numberOfBytes, number)
+        for size in sizes:
+            for name, function, numberOfBytes, number in getBenchmarks(logic, size, directory):
+                record(name, str(size), function, numberOfBytes, number)
+        logic.removeTempFiles()
+    return results
+
+
+def report(name, key, result):
+    size = key if key == 'any' else '{}^3'.format(key)
+    throughput = '' if result['throughput'] is None else '{:10.1f} MB/s'.format(result['throughput'])
+    print('{:<40} {:>6} {:>12.3f} ms {:>15} {:>10.1f} MB peak'.format(
+        name, size, 1e3 * result['seconds'], throughput, result['peakMemory'] / MEGABYTE))
+
+
+def getRegressions(results, baseline, tolerance):
+    """
+    Times and peak memories worse than the baseline by more than the
+    tolerance. Very small absolute differences are ignored, as they are
+    mostly noise
+    """
+    regressions = []
+    for name, sizes in results.items():
+        for key, result in sizes.items():
+            reference = baseline.get('results', {}).get(name, {}).get(key)
+            if reference is None:
+                continue
+            for metric, minimumDifference in ('seconds', 1e-3), ('peakMemory', MEGABYTE):
+                value, referenceValue = result[metric], reference[metric]
+                limit = referenceValue * (1 + tolerance) + minimumDifference
+                if value > limit:
+                    regressions.append('{} ({}): {} {:g} > {:g}'.format(name, key, metric, value, limit))
+    return regressions
+
+
+def getParser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[64, 128, 256],
+                        help='volume sizes, in voxels per side [%(default)s]')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing [%(default)s]')
+    parser.add_argument('--baseline', default=str(BASELINE_PATH), help='baseline JSON file [%(default)s]')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--check', action='store_true', help='fail if the results are worse than the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative regression [%(default)s]')
+    return parser
+
+
+def main(argv=None):
+    args = getParser().parse_args(argv)
+    if not HAS_REAL_VTK:
+        print('vtk not found, skipping vectorfieldToDisplacementField')
+    results = runBenchmarks(args.sizes, args.repeat)
+
+    if args.save_baseline:
+        baseline = {
+            'machine': '{} {} ({} cores), Python {}, NumPy {}'.format(
+                platform.system(), platform.machine(), os.cpu_count(),
+                platform.python_version(), np.__version__),
+            'results': results,
+        }
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Baseline written to {}'.format(args.baseline))
+
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = getRegressions(results, baseline, args.tolerance)
+        if regressions:
+            print('\nRegressions against {} ({}):'.format(args.baseline, baseline.get('machine')))
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('\nNo regressions against {}'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Micro-benchmark of the matrix conversions and of the NiftyReg matrix I/O.
+The element-by-element versions are the ones the module used before.
+
+    python Benchmarks/matrices.py [--number 1000]
+
+The VTK conversions are skipped if vtk cannot be imported.
+"""
+
+import sys
+import timeit
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import NiftyRegLib
+
+
+def getNumpyMatrixLoop(vtkMatrix):
+    matrix = np.identity(4)
+    for row in range(4):
+        for col in range(4):
+            matrix[row, col] = vtkMatrix.GetElement(row, col)
+    return matrix
+
+
+def getVTKMatrixLoop(numpyMatrix):
+    import vtk
+    vtkMatrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+        for col in range(4):
+            vtkMatrix.SetElement(row, col, numpyMatrix[row, col])
+    return vtkMatrix
+
+
+def writeMatrixLoop(matrix, trsfPath):
+    lines = []
+    for row in matrix:
+        line = []
+        for n in row:
+            line.append('{:13.8f}'.format(n))
+        lines.append(''.join(line))
+    with open(trsfPath, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def readMatrixLoadtxt(trsfPath):
+    with open(trsfPath) as f:
+        return np.loadtxt(f.readlines())
+
+
+def report(name, seconds, number):
+    print('{:<55} {:>10.2f} us'.format(name, 1e6 * seconds / number))
+
+
+def benchmarkVTK(matrices, number):
+    try:
+        from NiftyRegLib import vtkmatrix
+    except ImportError:
+        print('vtk not found, skipping VTK conversions')
+        return
+
+    matrix = matrices[0]
+    vtkMatrix = vtkmatrix.getVTKMatrixFromNumpyMatrix(matrix)
+    assert np.allclose(getNumpyMatrixLoop(vtkMatrix), vtkmatrix.getNumpyMatrixFromVTKMatrix(vtkMatrix))
+
+    def run(name, function):
+        report(name, timeit.timeit(function, number=number), number)
+
+    run('VTK to NumPy, element by element', lambda: getNumpyMatrixLoop(vtkMatrix))
+    run('VTK to NumPy, DeepCopy', lambda: vtkmatrix.getNumpyMatrixFromVTKMatrix(vtkMatrix))
+    run('NumPy to VTK, element by element', lambda: getVTKMatrixLoop(matrix))
+    run('NumPy to VTK, DeepCopy', lambda: vtkmatrix.getVTKMatrixFromNumpyMatrix(matrix))
+
+    vtkMatrices = vtkmatrix.getVTKMatricesFromNumpyMatrices(matrices)
+    n = len(matrices)
+    loopTime = getBestTime(lambda: [getNumpyMatrixLoop(m) for m in vtkMatrices])
+    report('{} VTK to NumPy, element by element (per matrix)'.format(n), loopTime, n)
+    stackTime = getBestTime(lambda: vtkmatrix.getNumpyMatricesFromVTKMatrices(vtkMatrices))
+    report('{} VTK to NumPy, stacked (per matrix)'.format(n), stackTime, n)
+
+
+def getBestTime(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def benchmarkIO(matrices, directory):
+    n = len(matrices)
+    loopPaths = [str(Path(directory) / 'loop_{}.txt'.format(i)) for i in range(n)]
+    paths = [str(Path(directory) / 'batched_{}.txt'.format(i)) for i in range(n)]
+
+    seconds = getBestTime(lambda: [writeMatrixLoop(m, p) for m, p in zip(matrices, loopPaths)])
+    report('Write {} matrices, element by element (per matrix)'.format(n), seconds, n)
+    seconds = getBestTime(lambda: NiftyRegLib.writeNiftyRegMatrices(matrices, paths))
+    report('Write {} matrices, batched (per matrix)'.format(n), seconds, n)
+
+    seconds = getBestTime(lambda: [readMatrixLoadtxt(p) for p in loopPaths])
+    report('Read {} matrices, loadtxt (per matrix)'.format(n), seconds, n)
+    seconds = getBestTime(lambda: NiftyRegLib.readNiftyRegMatrices(paths))
+    report('Read {} matrices, batched (per matrix)'.format(n), seconds, n)
+
+    assert np.allclose(NiftyRegLib.readNiftyRegMatrices(paths), matrices, atol=1e-7)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=1000, help='number of matrices [%(default)s]')
+    args = parser.parse_args()
+
+    matrices = np.tile(np.identity(4), (args.number, 1, 1))
+    matrices[:, :3, :] += np.random.uniform(-1, 1, (args.number, 3, 4))
+
+    benchmarkVTK(matrices, args.number)
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarkIO(matrices, directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Minimal stand-ins for the Slicer modules imported by NiftyReg.py, so that
+NiftyRegLogic can be benchmarked with a plain Python interpreter.
+The real vtk is used if it can be imported. NumPy and SimpleITK are only
+imported when needed, so that the startup of the module can be measured.
+"""
+
+import sys
+import types
+import itertools
+import tempfile
+
+
+class Recorder(object):
+    """
+    Accepts any method call, like the Slicer transforms and nodes that are
+    only configured by the code being benchmarked
+    """
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class StubImageData(object):
+
+    modifiedTimes = itertools.count(1)
+
+    def __init__(self, shape):
+        self.shape = shape  # (z, y, x)
+        self.mtime = next(self.modifiedTimes)
+
+
+    def GetDimensions(self):
+        return self.shape[::-1]
+
+
+    def GetMTime(self):
+        return self.mtime
+
+
+    def Modified(self):
+        self.mtime = next(self.modifiedTimes)
+
+
+class StubVolumeNode(object):
+
+    ids = itertools.count(1)
+
+    def __init__(self, array, spacing=(1, 1, 1), origin=(0, 0, 0), name='Volume'):
+        self.array = array
+        self.spacing = tuple(float(s) for s in spacing)
+        self.origin = tuple(float(o) for o in origin)
+        self.name = name
+        self.id = 'vtkMRMLScalarVolumeNode{}'.format(next(self.ids))
+        self.imageData = StubImageData(array.shape)
+        scene.nodes[self.id] = self
+
+
+    def GetID(self):
+        return self.id
+
+
+    def GetName(self):
+        return self.name
+
+
+    def GetImageData(self):
+        return self.imageData
+
+
+    def GetStorageNode(self):
+        return None
+
+
+    def GetModifiedSinceRead(self):
+        return True
+
+
+    def GetSpacing(self):
+        return self.spacing
+
+
+    def GetOrigin(self):
+        return self.origin
+
+
+    def GetIJKToRASDirections(self, directions):
+        directions[:] = 0
+        for i in range(3):
+            directions[i, i] = 1
+
+
+    def GetIJKToRASMatrix(self, matrix):
+        for i in range(3):
+            matrix.SetElement(i, i, self.spacing[i])
+            matrix.SetElement(i, 3, self.origin[i])
+
+
+class StubScene(object):
+
+    def __init__(self):
+        self.nodes = {}
+
+
+    def AddNewNodeByClass(self, className):
+        return Recorder()
+
+
+    def GetNodeByID(self, nodeID):
+        return self.nodes[nodeID]
+
+
+scene = StubScene()
+
+
+def pullFromSlicer(nodeID):
+    import SimpleITK as sitk
+    node = scene.GetNodeByID(nodeID)
+    image = sitk.GetImageFromArray(node.array)
+    image.SetSpacing(node.spacing)
+    image.SetOrigin(node.origin)
+    return image
+
+
+def makeModule(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def makeVTKStub():
+    vtk = makeModule('vtk')
+    vtk.util = makeModule('vtk.util')
+    vtk.util.numpy_support = makeModule('vtk.util.numpy_support')
+    return vtk
+
+
+def install(temporaryPath=None):
+    """
+    Registers the stub modules and returns (vtk, hasRealVTK)
+    """
+    if temporaryPath is None:
+        temporaryPath = tempfile.mkdtemp()
+    try:
+        import vtk
+        import vtk.util.numpy_support
+        hasRealVTK = True
+    except ImportError:
+        vtk = makeVTKStub()
+        hasRealVTK = False
+
+    slicer = makeModule('slicer')
+    slicer.app = types.SimpleNamespace(temporaryPath=temporaryPath)
+    slicer.util = types.SimpleNamespace(
+        tempDirectory=lambda key='': tempfile.mkdtemp(prefix=key, dir=temporaryPath),
+        arrayFromVolume=lambda node: node.array,
+        getNode=scene.GetNodeByID,
+    )
+    slicer.mrmlScene = scene
+    slicer.vtkOrientedGridTransform = Recorder
+    slicer.vtkOrientedBSplineTransform = Recorder
+
+    class ScriptedLoadableModuleBase(object):
+        def __init__(self, *args):
+            pass
+
+    makeModule('slicer.ScriptedLoadableModule',
+               ScriptedLoadableModule=ScriptedLoadableModuleBase,
+               ScriptedLoadableModuleWidget=ScriptedLoadableModuleBase,
+               ScriptedLoadableModuleLogic=ScriptedLoadableModuleBase)
+    makeModule('sitkUtils', PullFromSlicer=pullFromSlicer)
+    qt = makeModule('qt')
+    ctk = makeModule('ctk')
+
+    main = sys.modules['__main__']
+    main.vtk, main.qt, main.ctk, main.slicer = vtk, qt, ctk, slicer
+    return vtk, hasRealVTK
+
+
+def makeVolumeNode(size, dtype='float32', seed=0):
+    import numpy as np
+    array = np.random.default_rng(seed).random((size, size, size), dtype=np.float32).astype(dtype)
+    return StubVolumeNode(array, name='Volume{}'.format(size))
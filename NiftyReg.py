@@ -1,24 +1,26 @@
-import time
+import os
+import queue
 import shutil
-import random
-import string
 import datetime
-import subprocess
+import threading
 import collections
 from pathlib import Path
 
-import numpy as np
-import sitkUtils as su
-import SimpleITK as sitk
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 
+import NiftyRegLib
+from NiftyRegLib.lazy import LazyModule
+from NiftyRegLib.process import NiftyRegProcess
+from NiftyRegLib.parameters import RegistrationParameters, TRANSFORMATION_TYPES, INTERPOLATION_ORDERS
+
+# Slicer imports every module at startup, so the heavy dependencies are only
+# imported when they are first used
+np = LazyModule('numpy')
+su = LazyModule('sitkUtils')
+sitk = LazyModule('SimpleITK')
+
 NIFTYREG_LINK = 'https://github.com/KCL-BMEIS/niftyreg'
-ALADIN_PATH = shutil.which('reg_aladin')
-F3D_PATH = shutil.which('reg_f3d')
-TRANSFORMATIONS_MAP = collections.OrderedDict([('Rigid', ALADIN_PATH),
-                                               ('Affine', ALADIN_PATH),
-                                               ('Non-linear', F3D_PATH)])
 
 
 class NiftyReg(ScriptedLoadableModule):
@@ -41,12 +43,42 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         ScriptedLoadableModuleWidget.__init__(self, parent)
 
 
+    def cleanup(self):
+        if self.process is not None:
+            self.process.cancel()
+        self.processTimer.stop()
+        self.logic.widgetRunning = False
+        # The one-to-many registrations can not be cancelled, but their
+        # results are not loaded anymore. Their threads are still using the
+        # temporary directory, so it is left in the Slicer temporary path
+        for timer in self.logic.oneToManyTimers:
+            timer.stop()
+        if not self.logic.isRegistering():
+            self.logic.removeTempFiles()
+
+
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
         self.logic = NiftyRegLogic()
+        self.makeInputTimer()
         self.makeGUI()
         self.onTransformationTypeChanged()
         self.onInputModified()
+        self.flushInputUpdates()
+
+
+    def makeInputTimer(self):
+        """
+        Changing a selector is cheap, but updating the widgets that depend on
+        the volumes is not. Those updates wait until the selection settles
+        """
+        self.referencePyramidMap = None
+        self.floatingPyramidMap = None
+        self.modifiedVolumes = set()
+        self.inputTimer = qt.QTimer()
+        self.inputTimer.setSingleShot(True)
+        self.inputTimer.setInterval(200)
+        self.inputTimer.timeout.connect(self.updateVolumeWidgets)
 
 
     def makeGUI(self):
@@ -87,12 +119,51 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.makeParametersButton()
         self.makeOutputsButton()
 
+        self.makeApplyWidgets()
+
+        self.makeProgressWidgets()
+
+        self.parent.layout().addStretch()
+
+
+    def makeApplyWidgets(self):
+        applyLayout = qt.QHBoxLayout()
+        self.quickRunButton = qt.QPushButton('Quick run')
+        self.quickRunButton.toolTip = 'Use only the coarsest pyramid level to get an approximate result'
+        self.quickRunButton.setDisabled(True)
+        self.quickRunButton.clicked.connect(self.onQuickRun)
+        applyLayout.addWidget(self.quickRunButton)
+
         self.applyButton = qt.QPushButton('Apply')
         self.applyButton.setDisabled(True)
         self.applyButton.clicked.connect(self.onApply)
-        self.parent.layout().addWidget(self.applyButton)
+        applyLayout.addWidget(self.applyButton)
+        self.parent.layout().addLayout(applyLayout)
 
-        self.parent.layout().addStretch()
+        self.quickResult = None
+        self.useQuickResultCheckBox = qt.QCheckBox('Initialize with the quick run result')
+        self.useQuickResultCheckBox.setDisabled(True)
+        self.parent.layout().addWidget(self.useQuickResultCheckBox)
+
+
+    def makeProgressWidgets(self):
+        self.process = None
+        self.binariesReported = False
+        self.processTimer = qt.QTimer()
+        self.processTimer.setInterval(100)
+        self.processTimer.timeout.connect(self.onProcessTimer)
+
+        progressLayout = qt.QHBoxLayout()
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.hide()
+        progressLayout.addWidget(self.progressBar)
+
+        self.cancelButton = qt.QPushButton('Cancel')
+        self.cancelButton.clicked.connect(self.onCancel)
+        self.cancelButton.hide()
+        progressLayout.addWidget(self.cancelButton)
+        self.parent.layout().addLayout(progressLayout)
 
 
     def makeInputsButton(self):
@@ -112,7 +183,7 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.referenceSelector.showHidden = False
         self.referenceSelector.showChildNodeTypes = True
         self.referenceSelector.setMRMLScene(slicer.mrmlScene)
-        self.referenceSelector.currentNodeChanged.connect(self.onInputModified)
+        self.referenceSelector.currentNodeChanged.connect(lambda: self.onInputModified('reference'))
         self.inputsLayout.addRow("Reference: ", self.referenceSelector)
 
         # Floating
@@ -125,7 +196,7 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.floatingSelector.showHidden = True
         self.floatingSelector.showChildNodeTypes = True
         self.floatingSelector.setMRMLScene(slicer.mrmlScene)
-        self.floatingSelector.currentNodeChanged.connect(self.onInputModified)
+        self.floatingSelector.currentNodeChanged.connect(lambda: self.onInputModified('floating'))
         self.inputsLayout.addRow("Floating: ", self.floatingSelector)
 
         # Initial transform
@@ -139,7 +210,7 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.initialTransformSelector.showChildNodeTypes = True
         self.initialTransformSelector.setMRMLScene(slicer.mrmlScene)
         self.initialTransformSelector.baseName = 'Initial transform'
-        self.initialTransformSelector.currentNodeChanged.connect(self.onInputModified)
+        self.initialTransformSelector.currentNodeChanged.connect(lambda: self.onInputModified('initialTransform'))
         self.inputsLayout.addRow("Initial transform: ", self.initialTransformSelector)
 
 
@@ -161,7 +232,7 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.resultTransformSelector.showHidden = False
         self.resultTransformSelector.showChildNodeTypes = True
         self.resultTransformSelector.setMRMLScene(slicer.mrmlScene)
-        self.resultTransformSelector.currentNodeChanged.connect(self.onInputModified)
+        self.resultTransformSelector.currentNodeChanged.connect(lambda: self.onInputModified('outputs'))
         self.outputsLayout.addRow("Result transform: ", self.resultTransformSelector)
 
 
@@ -176,9 +247,51 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.resultVolumeSelector.showHidden = False
         self.resultVolumeSelector.showChildNodeTypes = True
         self.resultVolumeSelector.setMRMLScene(slicer.mrmlScene)
-        self.resultVolumeSelector.currentNodeChanged.connect(self.onInputModified)
+        self.resultVolumeSelector.currentNodeChanged.connect(lambda: self.onInputModified('outputs'))
         self.outputsLayout.addRow("Result volume: ", self.resultVolumeSelector)
 
+        # Cache
+        self.useCacheCheckBox = qt.QCheckBox('Reuse results of identical registrations')
+        self.useCacheCheckBox.checked = True
+        self.outputsLayout.addRow(self.useCacheCheckBox)
+
+        # Previous runs
+        self.warmStartCheckBox = qt.QCheckBox('Initialize with the closest previous result')
+        self.warmStartCheckBox.toolTip = (
+            'If there is no initial transform, start from the transform of an earlier '
+            'registration of the same volumes, preferably of the same type and with '
+            'similar parameters')
+        self.warmStartCheckBox.checked = False
+        self.outputsLayout.addRow(self.warmStartCheckBox)
+
+        # Export of volumes that are not NIfTI files on the disk
+        self.compressExportsCheckBox = qt.QCheckBox('Compress temporary input files')
+        self.compressExportsCheckBox.toolTip = 'Slower, but uses less disk space'
+        self.compressExportsCheckBox.checked = False
+        self.outputsLayout.addRow(self.compressExportsCheckBox)
+
+        # Linear results
+        self.resampleInSlicerCheckBox = qt.QCheckBox('Resample linear results in Slicer')
+        self.resampleInSlicerCheckBox.toolTip = (
+            'Compute the result volume from the floating volume and the result matrix '
+            'instead of loading the image written by NiftyReg')
+        self.resampleInSlicerCheckBox.checked = False
+        self.outputsLayout.addRow(self.resampleInSlicerCheckBox)
+
+        self.computeMetricsCheckBox = qt.QCheckBox('Compute quality metrics')
+        self.computeMetricsCheckBox.toolTip = (
+            'NCC, NMI and mean squared difference within the reference thresholds and, '
+            'for non-linear results, statistics of the Jacobian determinant')
+        self.computeMetricsCheckBox.checked = False
+        self.outputsLayout.addRow(self.computeMetricsCheckBox)
+
+        self.previewButton = qt.QPushButton('Preview hardened linear transform')
+        self.previewButton.toolTip = (
+            'Create a volume with the floating volume resampled using the result transform')
+        self.previewButton.clicked.connect(self.onPreview)
+        self.previewButton.setEnabled(False)
+        self.outputsLayout.addRow(self.previewButton)
+
 
     def makeParametersButton(self):
         self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
@@ -189,18 +302,38 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.parametersTabWidget = qt.QTabWidget()
         self.parametersLayout.addWidget(self.parametersTabWidget)
 
-        self.makeTransformationTypeWidgets()
-        self.makePyramidWidgets()
-        self.makeThresholdsWidgets()
+        # The tabs are filled when they are first shown, so that the
+        # intensity statistics are not computed until they are needed
+        self.parametersTabMakers = {}
+        self.pyramidHighestSpinBox = None
+        self.referenceThresholdSlider = None
+        self.presetComboBox = None
+        self.trsfTypeTab = self.addParametersTab('Transformation type', self.makeTransformationTypeWidgets)
+        self.pyramidTab = self.addParametersTab('Pyramid levels', self.makePyramidWidgets)
+        self.thresholdsTab = self.addParametersTab('Thresholds', self.makeThresholdsWidgets)
+        self.performanceTab = self.addParametersTab('Performance', self.makePerformanceWidgets)
+        self.parametersTabWidget.currentChanged.connect(self.makeParametersTab)
+        self.makeParametersTab(self.parametersTabWidget.currentIndex)
+
+
+    def addParametersTab(self, title, maker):
+        tab = qt.QWidget()
+        index = self.parametersTabWidget.addTab(tab, title)
+        self.parametersTabMakers[index] = maker
+        return tab
+
+
+    def makeParametersTab(self, index):
+        maker = self.parametersTabMakers.pop(index, None)
+        if maker is not None:
+            maker()
 
 
     def makeTransformationTypeWidgets(self):
-        self.trsfTypeTab = qt.QWidget()
-        self.parametersTabWidget.addTab(self.trsfTypeTab, 'Transformation type')
         trsfTypeLayout = qt.QHBoxLayout(self.trsfTypeTab)
 
         self.trsfTypeRadioButtons = []
-        for trsfType in TRANSFORMATIONS_MAP:
+        for trsfType in TRANSFORMATION_TYPES:
             radioButton = qt.QRadioButton(trsfType)
             radioButton.clicked.connect(self.onTransformationTypeChanged)
             self.trsfTypeRadioButtons.append(radioButton)
@@ -208,10 +341,15 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
 
         self.trsfTypeRadioButtons[0].setChecked(True)
 
+        self.pipelineCheckBox = qt.QCheckBox('Run previous stages first')
+        self.pipelineCheckBox.toolTip = (
+            'Run rigid, then affine, then non-linear registrations up to the selected type, '
+            'each one initialized with the result of the previous one')
+        self.pipelineCheckBox.checked = False
+        trsfTypeLayout.addWidget(self.pipelineCheckBox)
+
 
     def makePyramidWidgets(self):
-        self.pyramidTab = qt.QWidget()
-        self.parametersTabWidget.addTab(self.pyramidTab, 'Pyramid levels')
         self.pyramidLayout = qt.QGridLayout(self.pyramidTab)
 
         self.pyramidLayout.addWidget(qt.QLabel('Reference'), 0, 2)
@@ -243,10 +381,18 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.pyramidLayout.addWidget(self.pyramidLowestReferenceLabel, 2, 2)
         self.pyramidLayout.addWidget(self.pyramidLowestFloatingLabel, 2, 3)
 
+        self.autoTuneCheckBox = qt.QCheckBox('Choose levels, control point spacing and threads automatically')
+        self.autoTuneCheckBox.toolTip = (
+            'Use the pyramid levels that fit in the available memory and, once NiftyReg has '
+            'been calibrated on this machine, in a time budget. The calibration takes a few '
+            'seconds and is only run the first time')
+        self.autoTuneCheckBox.checked = False
+        self.autoTuneCheckBox.toggled.connect(self.updatePyramidWidgets)
+        self.pyramidLayout.addWidget(self.autoTuneCheckBox, 3, 0, 1, 4)
+        self.updatePyramidWidgets()
+
 
     def makeThresholdsWidgets(self):
-        self.thresholdsTab = qt.QWidget()
-        self.parametersTabWidget.addTab(self.thresholdsTab, 'Thresholds')
         self.thresholdsLayout = qt.QFormLayout(self.thresholdsTab)
 
         self.referenceThresholdSlider = ctk.ctkRangeWidget()
@@ -259,6 +405,242 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.floatingThresholdSlider.valuesChanged.connect(self.onFloatingThresholdSlider)
         self.thresholdsLayout.addRow('Floating: ', self.floatingThresholdSlider)
 
+        self.robustThresholdsButton = qt.QPushButton('Ignore outliers')
+        self.robustThresholdsButton.toolTip = (
+            'Set the thresholds to the {} and {} intensity percentiles'.format(*NiftyRegLib.ROBUST_PERCENTILES))
+        self.robustThresholdsButton.clicked.connect(self.onRobustThresholds)
+        self.thresholdsLayout.addRow(self.robustThresholdsButton)
+
+        self.cropCheckBox = qt.QCheckBox('Crop the inputs to the thresholds')
+        self.cropCheckBox.toolTip = (
+            'NiftyReg only sees the bounding box of the voxels within the thresholds, '
+            'which is faster if the volumes have large empty margins. '
+            'The results are mapped back to the whole reference volume')
+        self.cropCheckBox.checked = False
+        self.cropMarginSpinBox = qt.QDoubleSpinBox()
+        self.cropMarginSpinBox.suffix = ' mm'
+        self.cropMarginSpinBox.maximum = 1000
+        self.cropMarginSpinBox.value = RegistrationParameters().cropMargin
+        self.cropMarginSpinBox.toolTip = 'Margin around the bounding box'
+        cropLayout = qt.QHBoxLayout()
+        cropLayout.addWidget(self.cropCheckBox)
+        cropLayout.addWidget(self.cropMarginSpinBox)
+        self.thresholdsLayout.addRow(cropLayout)
+
+        self.masksCheckBox = qt.QCheckBox('Use the voxels within the thresholds as masks')
+        self.masksCheckBox.checked = False
+        self.thresholdsLayout.addRow(self.masksCheckBox)
+        self.updateThresholdsWidgets(('reference', 'floating'))
+
+
+    def makePerformanceWidgets(self):
+        self.performanceLayout = qt.QFormLayout(self.performanceTab)
+
+        self.presetComboBox = qt.QComboBox()
+        self.presetComboBox.toolTip = 'Options that trade accuracy for speed'
+        self.presetComboBox.currentIndexChanged.connect(self.onPresetChanged)
+        self.savePresetButton = qt.QPushButton('Save...')
+        self.savePresetButton.toolTip = 'Save the options below as a new preset'
+        self.savePresetButton.clicked.connect(self.onSavePreset)
+        presetLayout = qt.QHBoxLayout()
+        presetLayout.addWidget(self.presetComboBox, 1)
+        presetLayout.addWidget(self.savePresetButton)
+        self.performanceLayout.addRow('Preset: ', presetLayout)
+
+        self.threadsSpinBox = self.makeOptionalSpinBox(0, os.cpu_count() or 1)
+        self.threadsSpinBox.toolTip = 'Number of OpenMP threads (-omp)'
+        self.performanceLayout.addRow('Threads: ', self.threadsSpinBox)
+
+        self.linearIterationsSpinBox = self.makeOptionalSpinBox(0, 100)
+        self.linearIterationsSpinBox.toolTip = 'Maximum number of iterations per level of reg_aladin (-maxit)'
+        self.performanceLayout.addRow('Linear iterations: ', self.linearIterationsSpinBox)
+
+        self.blocksSpinBox = self.makeOptionalSpinBox(0, 100, suffix=' %')
+        self.blocksSpinBox.toolTip = 'Percentage of blocks used by reg_aladin (-pv)'
+        self.inliersSpinBox = self.makeOptionalSpinBox(0, 100, suffix=' %')
+        self.inliersSpinBox.toolTip = 'Percentage of blocks considered as inliers by reg_aladin (-pi)'
+        blocksLayout = qt.QHBoxLayout()
+        blocksLayout.addWidget(self.blocksSpinBox)
+        blocksLayout.addWidget(qt.QLabel('Inliers: '))
+        blocksLayout.addWidget(self.inliersSpinBox)
+        self.performanceLayout.addRow('Blocks: ', blocksLayout)
+
+        self.nonLinearIterationsSpinBox = self.makeOptionalSpinBox(0, 10000)
+        self.nonLinearIterationsSpinBox.toolTip = 'Maximum number of iterations per level of reg_f3d (-maxit)'
+        self.performanceLayout.addRow('Non-linear iterations: ', self.nonLinearIterationsSpinBox)
+
+        # Zero is a valid weight, so the default is chosen with a check box
+        self.bendingEnergySpinBox = qt.QDoubleSpinBox()
+        self.bendingEnergySpinBox.decimals = 4
+        self.bendingEnergySpinBox.minimum = 0
+        self.bendingEnergySpinBox.maximum = 1
+        self.bendingEnergySpinBox.singleStep = 0.001
+        self.bendingEnergySpinBox.value = 0.001  # NiftyReg default
+        self.bendingEnergySpinBox.toolTip = 'Weight of the bending energy of reg_f3d (-be)'
+        self.bendingEnergyDefaultCheckBox = qt.QCheckBox('Default')
+        self.bendingEnergyDefaultCheckBox.toggled.connect(self.bendingEnergySpinBox.setDisabled)
+        self.bendingEnergyDefaultCheckBox.checked = True
+        bendingEnergyLayout = qt.QHBoxLayout()
+        bendingEnergyLayout.addWidget(self.bendingEnergySpinBox, 1)
+        bendingEnergyLayout.addWidget(self.bendingEnergyDefaultCheckBox)
+        self.performanceLayout.addRow('Bending energy: ', bendingEnergyLayout)
+
+        self.spacingSpinBox = self.makeOptionalSpinBox(0, 100, decimals=1)
+        self.spacingSpinBox.toolTip = 'Control point spacing of reg_f3d (-sx)'
+        self.spacingUnitsComboBox = qt.QComboBox()
+        self.spacingUnitsComboBox.addItems(['voxels', 'mm'])
+        spacingLayout = qt.QHBoxLayout()
+        spacingLayout.addWidget(self.spacingSpinBox, 1)
+        spacingLayout.addWidget(self.spacingUnitsComboBox)
+        self.performanceLayout.addRow('Control point spacing: ', spacingLayout)
+
+        self.referenceSmoothingSpinBox = self.makeOptionalSpinBox(0, 20, decimals=1, suffix=' mm')
+        self.referenceSmoothingSpinBox.toolTip = 'Standard deviation of the Gaussian smoothing (-smooR)'
+        self.floatingSmoothingSpinBox = self.makeOptionalSpinBox(0, 20, decimals=1, suffix=' mm')
+        self.floatingSmoothingSpinBox.toolTip = 'Standard deviation of the Gaussian smoothing (-smooF)'
+        smoothingLayout = qt.QHBoxLayout()
+        smoothingLayout.addWidget(self.referenceSmoothingSpinBox)
+        smoothingLayout.addWidget(qt.QLabel('Floating: '))
+        smoothingLayout.addWidget(self.floatingSmoothingSpinBox)
+        self.performanceLayout.addRow('Smoothing: ', smoothingLayout)
+
+        self.similarityComboBox = qt.QComboBox()
+        self.similarityComboBox.addItems(['Default', 'NMI', 'LNCC'])
+        self.similarityComboBox.toolTip = 'Similarity measure of reg_f3d (--nmi, --lncc)'
+        self.binsSpinBox = self.makeOptionalSpinBox(1, 256)
+        self.binsSpinBox.toolTip = 'Number of histogram bins for NMI (--rbn, --fbn)'
+        self.lnccSpinBox = self.makeOptionalSpinBox(0, 50, decimals=1, suffix=' mm')
+        self.lnccSpinBox.toolTip = 'Standard deviation of the LNCC kernel (--lncc)'
+        similarityLayout = qt.QHBoxLayout()
+        similarityLayout.addWidget(self.similarityComboBox)
+        similarityLayout.addWidget(qt.QLabel('Bins: '))
+        similarityLayout.addWidget(self.binsSpinBox)
+        similarityLayout.addWidget(qt.QLabel('LNCC: '))
+        similarityLayout.addWidget(self.lnccSpinBox)
+        self.performanceLayout.addRow('Similarity: ', similarityLayout)
+
+        self.interpolationComboBox = qt.QComboBox()
+        self.interpolationComboBox.addItems(['Default', 'Nearest neighbor', 'Linear', 'Cubic'])
+        self.interpolationComboBox.toolTip = 'Interpolation used by NiftyReg (-interp)'
+        self.performanceLayout.addRow('Interpolation: ', self.interpolationComboBox)
+
+        self.updatePresetComboBox(NiftyRegLib.DEFAULT_PRESET)
+
+
+    def makeOptionalSpinBox(self, minimum, maximum, decimals=0, suffix=''):
+        """
+        The minimum of the spin box means the NiftyReg default
+        """
+        if decimals:
+            spinBox = qt.QDoubleSpinBox()
+            spinBox.decimals = decimals
+        else:
+            spinBox = qt.QSpinBox()
+        spinBox.minimum = minimum
+        spinBox.maximum = maximum
+        spinBox.suffix = suffix
+        spinBox.specialValueText = 'Default'
+        spinBox.value = minimum
+        return spinBox
+
+
+    def getOptionalValue(self, spinBox):
+        return None if spinBox.value == spinBox.minimum else spinBox.value
+
+
+    def setOptionalValue(self, spinBox, value):
+        spinBox.value = spinBox.minimum if value is None else value
+
+
+    def getOptionalSpinBoxes(self):
+        return collections.OrderedDict([
+            ('threads', self.threadsSpinBox),
+            ('linearIterations', self.linearIterationsSpinBox),
+            ('blocksPercentage', self.blocksSpinBox),
+            ('inliersPercentage', self.inliersSpinBox),
+            ('nonLinearIterations', self.nonLinearIterationsSpinBox),
+            ('referenceSmoothing', self.referenceSmoothingSpinBox),
+            ('floatingSmoothing', self.floatingSmoothingSpinBox),
+            ('histogramBins', self.binsSpinBox),
+            ('lnccStandardDeviation', self.lnccSpinBox),
+        ])
+
+
+    def getPerformanceOptions(self):
+        """
+        Options of the performance tab, or None if it has not been shown
+        """
+        if self.presetComboBox is None: return None
+        options = collections.OrderedDict()
+        for name, spinBox in self.getOptionalSpinBoxes().items():
+            options[name] = self.getOptionalValue(spinBox)
+        if self.bendingEnergyDefaultCheckBox.checked:
+            options['bendingEnergyWeight'] = None
+        else:
+            options['bendingEnergyWeight'] = self.bendingEnergySpinBox.value
+        spacing = self.getOptionalValue(self.spacingSpinBox)
+        if spacing is not None and self.spacingUnitsComboBox.currentIndex == 0:
+            spacing = -spacing  # NiftyReg uses negative values for voxels
+        options['controlPointSpacing'] = spacing
+        similarityIndex = self.similarityComboBox.currentIndex
+        options['similarityMeasure'] = None if similarityIndex == 0 else str(self.similarityComboBox.currentText)
+        interpolationIndex = self.interpolationComboBox.currentIndex
+        options['interpolationOrder'] = None if interpolationIndex == 0 else INTERPOLATION_ORDERS[interpolationIndex - 1]
+        return options
+
+
+    def setPerformanceOptions(self, parameters):
+        """
+        Shows the performance options of the parameters, except the threads
+        """
+        for name, spinBox in self.getOptionalSpinBoxes().items():
+            if name != 'threads':
+                self.setOptionalValue(spinBox, getattr(parameters, name))
+        bendingEnergyWeight = parameters.bendingEnergyWeight
+        self.bendingEnergyDefaultCheckBox.checked = bendingEnergyWeight is None
+        if bendingEnergyWeight is not None:
+            self.bendingEnergySpinBox.value = bendingEnergyWeight
+        spacing = parameters.controlPointSpacing
+        self.spacingUnitsComboBox.currentIndex = 1 if spacing is not None and spacing > 0 else 0
+        self.setOptionalValue(self.spacingSpinBox, None if spacing is None else abs(spacing))
+        similarity = parameters.similarityMeasure
+        self.similarityComboBox.currentIndex = 0 if similarity is None else self.similarityComboBox.findText(similarity)
+        order = parameters.interpolationOrder
+        self.interpolationComboBox.currentIndex = 0 if order is None else INTERPOLATION_ORDERS.index(order) + 1
+
+
+    def updatePresetComboBox(self, selectedName=None):
+        self.presetComboBox.blockSignals(True)
+        self.presetComboBox.clear()
+        self.presetComboBox.addItems(self.logic.presetLibrary.getNames())
+        self.presetComboBox.blockSignals(False)
+        if selectedName is not None:
+            self.presetComboBox.currentIndex = self.presetComboBox.findText(selectedName)
+        self.onPresetChanged()
+
+
+    def onPresetChanged(self):
+        name = str(self.presetComboBox.currentText)
+        if not name: return
+        try:
+            preset = self.logic.presetLibrary.get(name)
+            self.setPerformanceOptions(RegistrationParameters().applyPreset(preset))
+        except (OSError, ValueError, KeyError) as e:
+            slicer.util.errorDisplay('The preset "{}" could not be read:\n{}'.format(name, e))
+
+
+    def onSavePreset(self):
+        name = qt.QInputDialog.getText(slicer.util.mainWindow(), 'Save preset', 'Preset name:')
+        name = str(name).strip()
+        if not name: return
+        if self.logic.presetLibrary.isBuiltIn(name):
+            slicer.util.errorDisplay('"{}" is a built-in preset'.format(name))
+            return
+        options = self.getPerformanceOptions()
+        del options['threads']
+        self.logic.presetLibrary.save(name, RegistrationParameters().applyPreset(options))
+        self.updatePresetComboBox(name)
+
 
     def getSelectedTransformationType(self):
         for b in self.trsfTypeRadioButtons:
@@ -267,7 +649,7 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         return trsfType
 
 
-    def readParameters(self):
+    def readNodes(self):
         self.referenceVolumeNode = self.referenceSelector.currentNode()
         self.floatingVolumeNode = self.floatingSelector.currentNode()
         self.initialTransformNode = self.initialTransformSelector.currentNode()
@@ -275,15 +657,37 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         self.resultVolumeNode = self.resultVolumeSelector.currentNode()
         self.resultTransformNode = self.resultTransformSelector.currentNode()
 
+
+    def readParameters(self):
+        self.readNodes()
         self.referenceThresholds = self.logic.getThresholdRange(self.referenceVolumeNode)
         self.floatingThresholds = self.logic.getThresholdRange(self.floatingVolumeNode)
 
-
-    def getCommandLineList(self):
-        self.tempDir = str(slicer.util.tempDirectory())
-
-        self.refPath = self.logic.getNodeFilepath(self.referenceVolumeNode)
-        self.floPath = self.logic.getNodeFilepath(self.floatingVolumeNode)
+        # The defaults are used if the thresholds tab has not been shown
+        cropOptions = {}
+        if self.referenceThresholdSlider is not None:
+            cropOptions = dict(cropToThresholds=self.cropCheckBox.checked,
+                               cropMargin=self.cropMarginSpinBox.value,
+                               useMasks=self.masksCheckBox.checked)
+
+        self.parameters = RegistrationParameters(
+            transformationType=self.getSelectedTransformationType(),
+            referenceThresholds=self.referenceThresholds,
+            floatingThresholds=self.floatingThresholds,
+            pyramidLevels=self.getPyramidLevels(),
+            **cropOptions)
+        performanceOptions = self.getPerformanceOptions()
+        if performanceOptions is not None:
+            self.parameters = self.parameters.copy(**performanceOptions)
+        if self.pyramidHighestSpinBox is not None and self.autoTuneCheckBox.checked:
+            self.parameters = self.logic.getTunedParameters(self.parameters,
+                                                            self.referenceVolumeNode,
+                                                            self.floatingVolumeNode)
+            print(NiftyRegLib.getTuningDescription(self.parameters))
+
+
+    def getCommandLineList(self, quick=False):
+        self.tempDir = self.logic.getTempDirectory()
 
         refName = self.referenceVolumeNode.GetName()
         floName = self.floatingVolumeNode.GetName()
@@ -291,100 +695,84 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
         dateTime = datetime.datetime.now()
 
         # We make sure they are in the disk
-        if not self.refPath or not self.logic.hasNiftiExtension(self.refPath):
-            self.refPath = self.logic.getTempPath(self.tempDir,
-                                                  '.nii',
-                                                  filename=refName,
-                                                  dateTime=dateTime)
-            slicer.util.saveNode(self.referenceVolumeNode, self.refPath)
-
-        if not self.floPath or not self.logic.hasNiftiExtension(self.floPath):
-            self.floPath = self.logic.getTempPath(self.tempDir,
-                                                  '.nii',
-                                                  filename=floName,
-                                                  dateTime=dateTime)
-            slicer.util.saveNode(self.floatingVolumeNode, self.floPath)
-
-
-        self.resPath = self.logic.getTempPath(self.tempDir,
-                                              '.nii',
-                                              filename='{}_on_{}'.format(floName, refName),
-                                              dateTime=dateTime)
-
-        trsfType = self.getSelectedTransformationType()
-        binaryPath = TRANSFORMATIONS_MAP[trsfType]
-
-        if binaryPath == ALADIN_PATH:
-            extension = '.txt'
-        elif binaryPath == F3D_PATH:
-            extension = '.nii'
-        self.resultTransformPath = self.logic.getTempPath(self.tempDir,
-                                                          extension,
-                                                          filename='t_ref-{}_flo-{}'.format(refName, floName),
-                                                          dateTime=dateTime)
-
-
-
-        # Save the command line for debugging
-        self.cmdPath = self.logic.getTempPath(self.tempDir,
-                                              '.txt',
-                                              filename='cmd_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
-                                              dateTime=dateTime)
-
-        self.logPath = self.logic.getTempPath(self.tempDir,
-                                              '.txt',
-                                              filename='log_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
-                                              dateTime=dateTime)
-
-        refThreshMin, refThreshMax = self.referenceThresholds
-        floThreshMin, floThreshMax = self.floatingThresholds
-
-        ln, lp = self.getPyramidLevels()
-
-        cmd = [binaryPath]
-        cmd += ['-ref', self.refPath]
-        cmd += ['-flo', self.floPath]
-        cmd += ['-res', self.resPath]
-        if binaryPath == ALADIN_PATH:
-            if trsfType == 'Rigid':
-                cmd += ['-rigOnly']
-            elif trsfType == 'Affine':
-                cmd += ['-affDirect']
-            cmd += ['-aff', self.resultTransformPath]
-            cmd += ['-refLowThr', str(refThreshMin)]
-            cmd += ['-refUpThr', str(refThreshMax)]
-            cmd += ['-floLowThr', str(floThreshMin)]
-            cmd += ['-floUpThr', str(floThreshMax)]
-        elif binaryPath == F3D_PATH:
-            cmd += ['-cpp', self.resultTransformPath]
-            cmd += ['-rLwTh', str(refThreshMin)]
-            cmd += ['-rUpTh', str(refThreshMax)]
-            cmd += ['-fLwTh', str(floThreshMin)]
-            cmd += ['-fUpTh', str(floThreshMax)]
-        cmd += ['-ln', str(ln)]
-        cmd += ['-lp', str(lp)]
-        # cmd += ['-transformation-type', trsfType]
-        # cmd += ['-command-line', self.cmdPath]
-        # cmd += ['-logfile', self.logPath]
+        compress = self.compressExportsCheckBox.checked
+        self.refPath = self.logic.getInputPath(self.referenceVolumeNode, self.tempDir, compress=compress)
+        self.floPath = self.logic.getInputPath(self.floatingVolumeNode, self.tempDir, compress=compress)
 
+        self.initialTransformPath = None
         if self.initialTransformNode:
             self.initialTransformPath = str(self.logic.getTempPath(self.tempDir, '.txt', dateTime=dateTime))
             self.logic.writeNiftyRegMatrix(self.initialTransformNode, self.initialTransformPath)
-            if binaryPath == ALADIN_PATH:
-                cmd += ['-inaff', self.initialTransformPath]
-            elif binaryPath == F3D_PATH:
-                cmd += ['-aff', self.initialTransformPath]
-
-        self.commandLineList = cmd
-
 
-    def printCommandLine(self):
+        parameters = self.parameters
+        initialControlPointGridPath = None
+        if quick:
+            parameters = parameters.getQuickRunParameters()
+        elif self.useQuickResultCheckBox.enabled and self.useQuickResultCheckBox.checked:
+            quickTransformPath = self.getMatchingQuickResult()
+            if parameters.isLinear():
+                self.initialTransformPath = quickTransformPath
+            else:
+                initialControlPointGridPath = quickTransformPath
+
+        self.warmStart = None
+        if (self.warmStartCheckBox.checked
+                and not quick
+                and self.initialTransformPath is None
+                and initialControlPointGridPath is None):
+            self.warmStart = self.logic.getWarmStart(self.referenceVolumeNode,
+                                                     self.floatingVolumeNode,
+                                                     parameters)
+            if self.warmStart is not None:
+                print('Initializing with the {} result of run {}'.format(self.warmStart.transformationType,
+                                                                        self.warmStart.runId))
+                self.initialTransformPath = self.warmStart.initialTransformPath
+                initialControlPointGridPath = self.warmStart.initialControlPointGridPath
+
+        usePipeline = (self.pipelineCheckBox.checked
+                       and not quick
+                       and initialControlPointGridPath is None
+                       and parameters.transformationType != 'Rigid')
+        if usePipeline:
+            pipeline = NiftyRegLib.Pipeline(self.refPath,
+                                            self.floPath,
+                                            parameters,
+                                            outputDir=self.tempDir,
+                                            initialTransformPath=self.initialTransformPath,
+                                            refName=refName,
+                                            floName=floName,
+                                            dateTime=dateTime)
+            self.stageRegistrations = pipeline.registrations
+            self.finishStage = pipeline.finishStage
+        else:
+            registration = NiftyRegLib.Registration(self.refPath,
+                                        self.floPath,
+                                        parameters,
+                                        outputDir=self.tempDir,
+                                        initialTransformPath=self.initialTransformPath,
+                                        refName=refName,
+                                        floName=floName,
+                                        dateTime=dateTime,
+                                        initialControlPointGridPath=initialControlPointGridPath)
+            self.stageRegistrations = [registration]
+            self.finishStage = lambda index: None
+        self.registration = self.stageRegistrations[-1]
+        self.resPath = self.registration.resPath
+        self.resultTransformPath = self.registration.resultTransformPath
+        self.cmdPath = self.registration.cmdPath
+        self.logPath = self.registration.logPath
+        self.commandLineList = self.registration.getCommandLineList()
+
+
+    def printCommandLine(self, commandLineList=None):
         """
         Pretty-prints the command line so that it can be copied from the Python
         console and pasted on a terminal.
         """
+        if commandLineList is None:
+            commandLineList = self.commandLineList
         prettyCmd = []
-        for s in self.commandLineList:
+        for s in commandLineList:
             if s.startswith('-'):
                 prettyCmd.append('\\\n')
             prettyCmd.append(s)
@@ -401,6 +789,10 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
             shutil.copy(self.refPath, self.resPath)
 
 
+    def resamplesInSlicer(self):
+        return self.resampleInSlicerCheckBox.checked and self.parameters.isLinear()
+
+
     def loadResults(self):
         # Remove transform from reference
         self.referenceVolumeNode.SetAndObserveTransformNodeID(None)
@@ -414,7 +806,11 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
             # Load the new one
             # When loading a 2D image with slicer.util, there is a bug that
             # keeps stacking the output result instead of creating a 2D image
-            if self.logic.is2D(self.referenceVolumeNode):  # load using SimpleITK
+            if self.resamplesInSlicer():
+                matrix = self.logic.readNiftyRegMatrix(self.resultTransformPath)
+                self.resultVolumeNode = self.logic.resampleFloatingVolume(
+                    self.floatingVolumeNode, self.referenceVolumeNode, matrix, resultName)
+            elif self.logic.is2D(self.referenceVolumeNode):  # load using SimpleITK
                 resultImage = sitk.ReadImage(self.resPath)
                 su.PushToSlicer(resultImage, resultName, overwrite=True)
                 self.resultVolumeNode = slicer.util.getNode(resultName)
@@ -437,12 +833,10 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
                 resultTransformName = self.resultTransformNode.GetName()
                 slicer.mrmlScene.RemoveNode(self.resultTransformNode)
 
-                # Load the generated transform node
-                self.displacementFieldPath = self.resultTransformPath
+                # Create the transform node from the control point grid
                 self.resultTransformNode = self.logic.vectorfieldToDisplacementField(
                     self.resultTransformPath,
-                    self.referenceVolumeNode,
-                    self.displacementFieldPath)
+                    self.referenceVolumeNode)
                 self.resultTransformNode.SetName(resultTransformName)
                 self.resultTransformSelector.setCurrentNode(self.resultTransformNode)
 
@@ -450,6 +844,7 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
             if self.resultVolumeNode is None:
                 self.floatingVolumeNode.SetAndObserveTransformNodeID(self.resultTransformNode.GetID())
                 fgVolume = self.floatingVolumeNode
+            self.updatePreviewButton()
 
         self.logic.setSlicesBackAndForeground(bgVolume=self.referenceVolumeNode,
                                               fgVolume=fgVolume,
@@ -460,25 +855,41 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
 
 
     def outputsExist(self):
-        """
-        We need this because it's not clear that blockmatching returns non-zero
-        when failed
-        """
-        if self.resultVolumeNode is not None:
-            if not Path(self.resPath).is_file():
-                return False
+        return self.registration.outputsExist(
+            checkResult=self.resultVolumeNode is not None and not self.resamplesInSlicer(),
+            checkTransform=self.resultTransformNode is not None)
 
-        if self.resultTransformNode is not None:
-            if not Path(self.resultTransformPath).is_file():
-                return False
 
-        return True
+    def updatePreviewButton(self):
+        transformNode = self.resultTransformSelector.currentNode()
+        isLinear = transformNode is not None and transformNode.IsLinear()
+        self.previewButton.setEnabled(isLinear
+                                      and self.referenceVolumeNode is not None
+                                      and self.floatingVolumeNode is not None)
+
+
+    def onPreview(self):
+        """
+        The floating volume is resampled only when asked, instead of after
+        every registration
+        """
+        self.readNodes()
+        matrix = self.logic.getMatricesFromTransformNodes([self.resultTransformNode])[0]
+        name = slicer.mrmlScene.GenerateUniqueName('{} preview'.format(self.floatingVolumeNode.GetName()))
+        previewNode = self.logic.resampleFloatingVolume(
+            self.floatingVolumeNode, self.referenceVolumeNode, matrix, name)
+        self.logic.setSlicesBackAndForeground(bgVolume=self.referenceVolumeNode,
+                                              fgVolume=previewNode,
+                                              opacity=0.5,
+                                              colors=True)
 
 
     def validateMatrices(self):
-        refQFormCode, refSFormCode = self.logic.getQFormAndSFormCodes(self.referenceVolumeNode)
-        floQFormCode, floSFormCode = self.logic.getQFormAndSFormCodes(self.floatingVolumeNode)
         validCodes = 1, 2, 3
+        refCodes = self.logic.getQFormAndSFormCodes(self.referenceVolumeNode)
+        floCodes = self.logic.getQFormAndSFormCodes(self.floatingVolumeNode)
+        refQFormCode = validCodes[0] if refCodes is None else refCodes[0]
+        floQFormCode = validCodes[0] if floCodes is None else floCodes[0]
         if refQFormCode != 0 and floQFormCode != 0: return
 
         messages = ['Registration results might be unexpected:', '\n']
@@ -495,46 +906,88 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
             slicer.util.warningDisplay('Reference and floating images are the same')
 
 
-    def validateDataTypes(self):
-        refDouble = self.logic.isDouble(self.referenceVolumeNode)
-        floDouble = self.logic.isDouble(self.floatingVolumeNode)
-
-        if not refDouble and not floDouble:
-            return True
-
-        messages = ['Data type not handled yet:', '\n']
-        if refDouble:
-            messages.append('Reference image does not have a valid data type')
-        if floDouble:
-            messages.append('Floating image does not have a valid data type')
-        message = '\n'.join(messages)
-        slicer.util.errorDisplay(message)
-        return False
+    def fitMemoryBudget(self):
+        """
+        Skips the finest pyramid levels if the registration would not fit in
+        the available memory, or refuses to run it if it would not fit at all
+        """
+        try:
+            parameters, estimate = self.logic.fitMemoryBudget(self.parameters,
+                                                              self.referenceVolumeNode,
+                                                              self.floatingVolumeNode)
+        except ValueError as e:
+            slicer.util.errorDisplay(str(e))
+            return False
+        print('Estimated peak memory: {}'.format(NiftyRegLib.formatBytes(estimate.peak)))
+        if parameters.pyramidLevels != self.parameters.pyramidLevels:
+            ln, lp = parameters.pyramidLevels
+            print('Only {} of {} pyramid levels will be performed to fit in the available memory'.format(lp, ln))
+        self.parameters = parameters
+        return True
 
 
     def validateParameters(self):
-        validDataTypes = self.validateDataTypes()
         self.validateRefIsFloating()
         self.validateMatrices()
 
-        return validDataTypes
+        return True
 
 
     ### Signals ###
-    def onInputModified(self):
-        self.readParameters()
+    def onInputModified(self, modifiedVolume=None):
+        """
+        modifiedVolume is 'reference' or 'floating' if one of the volume
+        selectors changed. If None, all the volume widgets are updated. Other
+        values, e.g. 'outputs', only update the buttons
+        """
+        self.readNodes()
 
         # Enable apply button
         validMinimumInputs = self.referenceVolumeNode and \
                              self.floatingVolumeNode and \
                              (self.resultVolumeNode or self.resultTransformNode)
         self.applyButton.setEnabled(validMinimumInputs)
+        self.quickRunButton.setEnabled(validMinimumInputs)
+        self.updateQuickResultCheckBox()
+        self.updatePreviewButton()
+
+        if modifiedVolume is None:
+            self.modifiedVolumes.update(('reference', 'floating'))
+        elif modifiedVolume in ('reference', 'floating'):
+            self.modifiedVolumes.add(modifiedVolume)
+        else:
+            return
+        self.inputTimer.start()
 
-        # Update pyramid widgets
-        self.referencePyramidMap = self.logic.getPyramidShapesMap(self.referenceVolumeNode)
-        self.floatingPyramidMap = self.logic.getPyramidShapesMap(self.floatingVolumeNode)
 
-        if self.referencePyramidMap is None:
+    def flushInputUpdates(self):
+        if self.inputTimer.isActive():
+            self.inputTimer.stop()
+            self.updateVolumeWidgets()
+        elif self.modifiedVolumes:
+            self.updateVolumeWidgets()
+
+
+    def updateVolumeWidgets(self):
+        """
+        Updates the pyramid and thresholds widgets of the volumes that changed
+        """
+        modifiedVolumes = self.modifiedVolumes
+        self.modifiedVolumes = set()
+        self.readNodes()
+
+        if 'reference' in modifiedVolumes:
+            self.referencePyramidMap = self.logic.getPyramidShapesMap(self.referenceVolumeNode)
+        if 'floating' in modifiedVolumes:
+            self.floatingPyramidMap = self.logic.getPyramidShapesMap(self.floatingVolumeNode)
+
+        self.updatePyramidWidgets()
+        self.updateThresholdsWidgets(modifiedVolumes)
+
+
+    def updatePyramidWidgets(self):
+        if self.pyramidHighestSpinBox is None: return
+        if self.referencePyramidMap is None or self.autoTuneCheckBox.checked:
             self.pyramidHighestSpinBox.setDisabled(True)
             self.pyramidLowestSpinBox.setDisabled(True)
         else:
@@ -543,34 +996,62 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
             self.pyramidHighestSpinBox.maximum = max(self.referencePyramidMap.keys())
         self.onPyramidLevelsChanged()
 
-        # Update thresholds sliders
-        if self.referenceVolumeNode is None:
-            self.referenceThresholdSlider.setDisabled(True)
-        else:
-            minValue, maxValue = self.logic.getRange(self.referenceVolumeNode)
-            self.referenceThresholdSlider.minimum = minValue
-            self.referenceThresholdSlider.maximum = maxValue
-            thresholdMin, thresholdMax = self.logic.getThresholdRange(self.referenceVolumeNode)
-            self.referenceThresholdSlider.minimumValue = thresholdMin
-            self.referenceThresholdSlider.maximumValue = thresholdMax
-            self.referenceThresholdSlider.setEnabled(True)
-
-        if self.floatingVolumeNode is None:
-            self.floatingThresholdSlider.setDisabled(True)
-        else:
-            minValue, maxValue = self.logic.getRange(self.floatingVolumeNode)
-            self.floatingThresholdSlider.minimum = minValue
-            self.floatingThresholdSlider.maximum = maxValue
-            thresholdMin, thresholdMax = self.logic.getThresholdRange(self.floatingVolumeNode)
-            self.floatingThresholdSlider.minimumValue = thresholdMin
-            self.floatingThresholdSlider.maximumValue = thresholdMax
-            self.floatingThresholdSlider.setEnabled(True)
+
+    def updateThresholdsWidgets(self, modifiedVolumes):
+        """
+        The sliders need the intensity statistics of the volumes, so they are
+        not updated until the thresholds tab has been shown
+        """
+        if self.referenceThresholdSlider is None: return
+        if 'reference' in modifiedVolumes:
+            self.updateThresholdSlider(self.referenceThresholdSlider, self.referenceVolumeNode)
+        if 'floating' in modifiedVolumes:
+            self.updateThresholdSlider(self.floatingThresholdSlider, self.floatingVolumeNode)
+        self.robustThresholdsButton.setEnabled(
+            self.referenceVolumeNode is not None or self.floatingVolumeNode is not None)
+
+
+    def updateThresholdSlider(self, slider, volumeNode):
+        if volumeNode is None:
+            slider.setDisabled(True)
+            return
+        statistics = self.logic.getIntensityStatistics(volumeNode)
+        minValue, maxValue = statistics.getRange()
+        slider.minimum = minValue
+        slider.maximum = maxValue
+        thresholdMin, thresholdMax = self.logic.getThresholdRange(volumeNode)
+        slider.minimumValue = thresholdMin
+        slider.maximumValue = thresholdMax
+        lines = ['Percentile {:g}: {:g}'.format(p, statistics.getPercentile(p)) for p in (1, 5, 50, 95, 99)]
+        slider.toolTip = '\n'.join(lines)
+        slider.setEnabled(True)
 
 
     def onTransformationTypeChanged(self):
         trsf = self.getSelectedTransformationType()
         self.resultTransformSelector.baseName = 'Output %s transform' % trsf
         self.resultVolumeSelector.baseName = 'Output %s volume' % trsf
+        self.updateQuickResultCheckBox()
+
+
+    def getMatchingQuickResult(self):
+        """
+        Returns the transform of the last quick run if it was computed with
+        the current inputs and transformation type
+        """
+        if self.quickResult is None: return None
+        referenceNode = self.referenceSelector.currentNode()
+        floatingNode = self.floatingSelector.currentNode()
+        if referenceNode is None or floatingNode is None: return None
+        key = referenceNode.GetID(), floatingNode.GetID(), self.getSelectedTransformationType()
+        quickKey, transformPath = self.quickResult
+        if key != quickKey or not Path(transformPath).is_file():
+            return None
+        return transformPath
+
+
+    def updateQuickResultCheckBox(self):
+        self.useQuickResultCheckBox.setEnabled(self.getMatchingQuickResult() is not None)
 
 
     def onPyramidLevelsChanged(self):
@@ -599,6 +1080,8 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
 
 
     def getPyramidLevels(self):
+        if self.pyramidHighestSpinBox is None:
+            return RegistrationParameters().pyramidLevels
         return self.pyramidHighestSpinBox.value, self.pyramidLowestSpinBox.value
 
 
@@ -622,42 +1105,583 @@ class NiftyRegWidget(ScriptedLoadableModuleWidget):
             displayNode.SetThreshold(thresMin, thresMax)
 
 
+    def onRobustThresholds(self):
+        for slider, volumeNode in ((self.referenceThresholdSlider, self.referenceVolumeNode),
+                                   (self.floatingThresholdSlider, self.floatingVolumeNode)):
+            if volumeNode is not None:
+                slider.setValues(*self.logic.getRobustThresholds(volumeNode))
+
+
+    def setRunning(self, running):
+        for widget in (self.inputsCollapsibleButton,
+                       self.parametersCollapsibleButton,
+                       self.outputsCollapsibleButton,
+                       self.applyButton,
+                       self.quickRunButton,
+                       self.useQuickResultCheckBox):
+            widget.setEnabled(not running)
+        self.progressBar.setVisible(running)
+        self.cancelButton.setVisible(running)
+        self.cancelButton.setEnabled(running)
+        if running:
+            self.progressBar.value = 0
+            self.progressBar.format = 'Starting...'
+            self.processTimer.start()
+        else:
+            self.processTimer.stop()
+            self.updateQuickResultCheckBox()
+        self.logic.widgetRunning = running
+        if not running:
+            self.logic.removeStaleExports()
+
+
     def onApply(self):
+        self.runRegistration(quick=False)
+
+
+    def onQuickRun(self):
+        self.runRegistration(quick=True)
+
+
+    def runRegistration(self, quick):
+        if not self.binariesReported:
+            # The binaries are only looked for when they are first needed
+            print(NiftyRegLib.getBinariesDescription())
+            self.binariesReported = True
+        self.flushInputUpdates()
         self.readParameters()
-        self.getCommandLineList()
+        if not self.fitMemoryBudget(): return
+        self.getCommandLineList(quick=quick)
         if not self.validateParameters(): return
+        self.isQuickRun = quick
+        self.stageIndex = -1
+        self.runNextStage()
+
+
+    def runNextStage(self):
+        """
+        Runs the registrations of the pipeline one after the other. There is
+        only one unless the previous stages are also run
+        """
+        self.stageIndex += 1
+        if self.stageIndex == len(self.stageRegistrations):
+            self.setRunning(False)
+            slicer.util.showStatusMessage('')
+            self.onRegistrationSucceeded()
+            return
+
+        registration = self.stageRegistrations[self.stageIndex]
         print('\n\n')
-        self.printCommandLine()
-        tIni = time.time()
+        if len(self.stageRegistrations) > 1:
+            print('Stage {} / {}: {}\n'.format(self.stageIndex + 1,
+                                               len(self.stageRegistrations),
+                                               registration.parameters.transformationType))
+        commandLineList = registration.getCommandLineList()
+        self.printCommandLine(commandLineList)
+
+        self.cacheKey = None
+        if self.useCacheCheckBox.checked:
+            self.cacheKey = self.logic.getCacheKey(registration,
+                                                   self.referenceVolumeNode,
+                                                   self.floatingVolumeNode)
+            if self.logic.resultCache.fetch(self.cacheKey, registration):
+                print('\nResults found in the cache')
+                registration.cached = True
+                registration.returnCode = 0
+                registration.elapsedTime = 0
+                self.logic.recordRun(registration, self.referenceVolumeNode, self.floatingVolumeNode)
+                self.finishStage(self.stageIndex)
+                self.runNextStage()
+                return
+
+        self.process = NiftyRegProcess(commandLineList,
+                                       onOutput=self.onProcessOutput,
+                                       onProgress=self.onProcessProgress,
+                                       onFinished=self.onProcessFinished,
+                                       onEvent=self.onProcessEvent,
+                                       eventsPath=registration.eventsPath,
+                                       logPath=registration.logPath)
         try:
-            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-            p = subprocess.Popen(self.commandLineList, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output = p.communicate()
-            print('\nBlockmatching returned {}'.format(p.returncode))
-            if p.returncode != 0 or not self.outputsExist():
-                # Newer versions of blockmatching return 0
-                # Apparently it always returns 0 :(
-                qt.QApplication.restoreOverrideCursor()
-                errorMessage = ''
-                if not self.outputsExist():
-                    errorMessage += 'Output volume not written on the disk\n\n'
-                errorMessage += output[1].decode()
-                slicer.util.errorDisplay(errorMessage, windowTitle="Registration error")
-            else:
-                tFin = time.time()
-                print('\nRegistration completed in {:.2f} seconds'.format(tFin - tIni))
-                self.repareResults()
-                self.loadResults()
+            registration.writeCommandLine()
+            registration.prepareInputs()
+        except (OSError, RuntimeError, ValueError) as e:
+            self.process = None
+            self.setRunning(False)
+            slicer.util.errorDisplay('The inputs could not be prepared:\n\n{}'.format(e),
+                                     windowTitle="Registration error")
+            return
+        try:
+            self.process.start()
         except OSError as e:
-            print(e)
-            print('Is blockmatching correctly installed?')
+            self.process = None
+            self.setRunning(False)
+            slicer.util.errorDisplay('{}\n\nIs NiftyReg correctly installed?'.format(e),
+                                     windowTitle="Registration error")
+            return
+        self.setRunning(True)
+
+
+    def getStageText(self):
+        if len(self.stageRegistrations) == 1:
+            return ''
+        return 'Stage {} / {} - '.format(self.stageIndex + 1, len(self.stageRegistrations))
+
+
+    def onRegistrationSucceeded(self):
+        if self.isQuickRun:
+            key = (self.referenceVolumeNode.GetID(),
+                   self.floatingVolumeNode.GetID(),
+                   self.parameters.transformationType)
+            self.quickResult = key, self.resultTransformPath
+            self.useQuickResultCheckBox.checked = True
+            self.updateQuickResultCheckBox()
+        self.repareResults()
+        self.loadResults()
+        if self.computeMetricsCheckBox.checked:
+            self.computeMetrics()
+
+
+    def computeMetrics(self):
+        resultArray = None
+        if self.resamplesInSlicer() and self.resultVolumeNode is not None:
+            resultArray = slicer.util.arrayFromVolume(self.resultVolumeNode)
+        elif self.resultVolumeNode is None and self.parameters.isLinear():
+            resultArray = sitk.GetArrayViewFromImage(self.registration.resampleFloating())
+        slicer.app.setOverrideCursor(qt.Qt.WaitCursor)
+        try:
+            metrics = self.registration.computeMetrics(resultArray=resultArray)
         finally:
-            qt.QApplication.restoreOverrideCursor()
+            slicer.app.restoreOverrideCursor()
+        print('\nQuality metrics:')
+        for name, value in sorted(metrics.items()):
+            print('{}: {:g}'.format(name, value))
+
+
+    def onCancel(self):
+        if self.process is not None:
+            self.cancelButton.setEnabled(False)
+            self.progressBar.format = 'Cancelling...'
+            self.process.cancel()
+
+
+    def onProcessTimer(self):
+        if self.process is not None:
+            self.process.poll()
+
+
+    def onProcessOutput(self, streamName, line):
+        print(line)
+
+
+    def onProcessProgress(self, level, numberOfLevels):
+        self.progressBar.value = int(100 * (level - 1) / numberOfLevels)
+        self.progressBar.format = self.getStageText() + 'Level {} / {}'.format(level, numberOfLevels)
+        slicer.util.showStatusMessage('NiftyReg: level {} / {}'.format(level, numberOfLevels))
+
+
+    def onProcessEvent(self, event):
+        if event['event'] == 'iteration':
+            self.progressBar.format = self.getStageText() + 'Level {} / {} - iteration {}'.format(
+                event['level'], self.process.parser.numberOfLevels, event['iteration'])
+        elif event['event'] == 'levelEnd':
+            self.progressBar.value = int(100 * event['level'] / event['numberOfLevels'])
+
+
+    def onProcessFinished(self, returnCode):
+        process = self.process
+        self.process = None
+        registration = self.stageRegistrations[self.stageIndex]
+        isLastStage = self.stageIndex == len(self.stageRegistrations) - 1
+        if process.cancelled:
+            self.setRunning(False)
+            slicer.util.showStatusMessage('')
+            print('\nRegistration cancelled')
+            return
+        print('\nNiftyReg returned {}'.format(returnCode))
+        uncropError = None
+        if returnCode == 0:
+            try:
+                registration.uncropOutputs()
+            except (OSError, RuntimeError, ValueError) as e:
+                uncropError = e
+        registration.returnCode = returnCode
+        registration.elapsedTime = process.getElapsedTime()
+        registration.levels = process.getLevels()
+        if isLastStage:
+            outputsExist = self.outputsExist()
+        else:
+            outputsExist = registration.outputsExist(checkResult=False)
+        if returnCode != 0 or uncropError is not None or not outputsExist:
+            # Apparently reg_aladin returns 0 even when it fails
+            self.setRunning(False)
+            slicer.util.showStatusMessage('')
+            errorMessage = ''
+            if uncropError is not None:
+                errorMessage += 'The outputs could not be uncropped: {}\n\n'.format(uncropError)
+            elif not outputsExist:
+                errorMessage += 'Output volume not written on the disk\n\n'
+            errorMessage += process.getErrorOutput()
+            if returnCode == 0:
+                registration.returnCode = None
+            self.logic.recordRun(registration, self.referenceVolumeNode, self.floatingVolumeNode)
+            slicer.util.errorDisplay(errorMessage, windowTitle="Registration error")
+        else:
+            print('\nRegistration completed in {:.2f} seconds'.format(registration.elapsedTime))
+            if registration.levels:
+                print(NiftyRegLib.getLevelsSummary(registration.levels))
+            self.logic.recordRun(registration, self.referenceVolumeNode, self.floatingVolumeNode)
+            if self.cacheKey is not None and registration.outputsExist():
+                self.logic.resultCache.store(self.cacheKey, registration)
+            self.finishStage(self.stageIndex)
+            self.runNextStage()
 
 
 
 class NiftyRegLogic(ScriptedLoadableModuleLogic):
 
+    def __init__(self):
+        ScriptedLoadableModuleLogic.__init__(self)
+        cacheDir = Path(slicer.app.temporaryPath) / 'NiftyReg' / 'cache'
+        self.resultCache = NiftyRegLib.ResultCache(cacheDir)
+        self.runDatabase = NiftyRegLib.RunDatabase(Path(slicer.app.temporaryPath) / 'NiftyReg' / 'runs.sqlite')
+        self.presetLibrary = NiftyRegLib.PresetLibrary(Path(slicer.app.temporaryPath) / 'NiftyReg' / 'presets')
+        self.tempDir = None
+        self.exportedVolumes = {}  # node ID -> (export key, path)
+        self.staleExports = []  # replaced exports that a running job may still read
+        self.widgetRunning = False
+        self.intensityStatistics = {}  # node ID -> (image data MTime, statistics)
+        self.pyramidShapesMaps = {}  # node ID -> (image data MTime, shapes map)
+        self.volumeDigests = {}  # node ID -> (export key, digest)
+        self.oneToManyTimers = []
+        self.machineProfilePath = Path(slicer.app.temporaryPath) / 'NiftyReg' / 'machine.json'
+        self.machineProfile = None
+        self.machineProfileRead = False
+
+
+    def getTempDirectory(self):
+        """
+        One directory per session, so that it can be removed when the module
+        is closed
+        """
+        if self.tempDir is None or not Path(self.tempDir).is_dir():
+            self.tempDir = str(slicer.util.tempDirectory('NiftyReg'))
+        return self.tempDir
+
+
+    def removeTempFiles(self):
+        self.exportedVolumes = {}
+        self.staleExports = []
+        if self.tempDir is not None:
+            shutil.rmtree(self.tempDir, ignore_errors=True)
+            self.tempDir = None
+
+
+    def getGeometry(self, volumeNode):
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        return tuple(ijkToRAS.GetElement(i, j) for i in range(4) for j in range(4))
+
+
+    def getExportKey(self, volumeNode):
+        return volumeNode.GetImageData().GetMTime(), self.getGeometry(volumeNode)
+
+
+    def getInputPath(self, volumeNode, directory, compress=False):
+        """
+        Returns the NIfTI file of the node if it is up to date and its data
+        type is not wider than needed (see NiftyRegLib.export). Otherwise, the
+        node is exported unless it has not been modified since the last export
+        """
+        path = self.getUpToDateNiftiPath(volumeNode)
+        if path is not None and not self.needsExport(volumeNode):
+            return path
+
+        extension = '.nii.gz' if compress else '.nii'
+        exportKey = self.getExportKey(volumeNode)
+        exported = self.exportedVolumes.get(volumeNode.GetID())
+        if exported is not None:
+            oldKey, oldPath = exported
+            if oldKey == exportKey and oldPath.endswith(extension) and Path(oldPath).is_file():
+                return oldPath
+            self.staleExports.append(oldPath)
+            self.removeStaleExports()
+
+        path = self.getTempPath(directory,
+                                extension,
+                                filename='{}_{}'.format(volumeNode.GetName(), volumeNode.GetID()),
+                                dateTime=datetime.datetime.now())
+        array = slicer.util.arrayFromVolume(volumeNode)
+        if array.ndim == 3:
+            NiftyRegLib.writeExportImage(path, array, affine=self.getIJKToRASAffine(volumeNode))
+        else:
+            image = su.PullFromSlicer(volumeNode.GetID())
+            sitk.WriteImage(image, path, compress)
+        self.exportedVolumes[volumeNode.GetID()] = exportKey, path
+        return path
+
+
+    def isRegistering(self):
+        return self.widgetRunning or bool(self.oneToManyTimers)
+
+
+    def removeStaleExports(self):
+        """
+        Removes the exports that have been replaced, unless a registration is
+        running, as it may still be reading them
+        """
+        if self.isRegistering():
+            return
+        for path in self.staleExports:
+            if Path(path).is_file():
+                Path(path).unlink()
+        self.staleExports = []
+
+
+    def getUpToDateNiftiPath(self, volumeNode):
+        """
+        Returns the NIfTI file the node was read from, or None if there is no
+        such file or the node has been modified since it was read
+        """
+        path = self.getNodeFilepath(volumeNode)
+        isUpToDate = (path
+                      and self.hasNiftiExtension(path)
+                      and Path(path).is_file()
+                      and not volumeNode.GetModifiedSinceRead())
+        return path if isUpToDate else None
+
+
+    def getIJKToRASAffine(self, volumeNode):
+        directions = np.zeros((3, 3))
+        volumeNode.GetIJKToRASDirections(directions)
+        affine = np.identity(4)
+        affine[:3, :3] = directions * volumeNode.GetSpacing()
+        affine[:3, 3] = volumeNode.GetOrigin()
+        return affine
+
+
+    def getLPSGrid(self, volumeNode):
+        """
+        Returns (size, origin, spacing, direction) of the volume in LPS
+        coordinates, as used by SimpleITK
+        """
+        rasToLPS = np.diag([-1, -1, 1])
+        directions = np.zeros((3, 3))
+        volumeNode.GetIJKToRASDirections(directions)
+        size = volumeNode.GetImageData().GetDimensions()
+        origin = rasToLPS.dot(volumeNode.GetOrigin())
+        direction = rasToLPS.dot(directions)
+        return size, origin.tolist(), volumeNode.GetSpacing(), direction.ravel().tolist()
+
+
+    def resampleFloatingVolume(self, floatingNode, referenceNode, matrix, name):
+        """
+        Resamples the floating volume on the grid of the reference volume with
+        a NiftyReg matrix, using SimpleITK in memory
+        """
+        floatingImage = su.PullFromSlicer(floatingNode.GetID())
+        grid = self.getLPSGrid(referenceNode)
+        resampledImage = NiftyRegLib.resampleWithMatrix(floatingImage, matrix, grid)
+        su.PushToSlicer(resampledImage, name, overwrite=True)
+        return slicer.util.getNode(name)
+
+
+    def getVolumeDigest(self, volumeNode):
+        """
+        The digest is computed again only if the volume changes, e.g. between
+        the stages of a pipeline it is computed once
+        """
+        exportKey = self.getExportKey(volumeNode)
+        cached = self.volumeDigests.get(volumeNode.GetID())
+        if cached is not None and cached[0] == exportKey:
+            return cached[1]
+        array = slicer.util.arrayFromVolume(volumeNode)
+        digest = NiftyRegLib.getArrayDigest(array, self.getGeometry(volumeNode))
+        self.volumeDigests[volumeNode.GetID()] = exportKey, digest
+        return digest
+
+
+    def getCacheKey(self, registration, referenceNode, floatingNode):
+        return self.resultCache.getKey(registration,
+                                       referenceDigest=self.getVolumeDigest(referenceNode),
+                                       floatingDigest=self.getVolumeDigest(floatingNode))
+
+
+    def recordRun(self, registration, referenceNode, floatingNode):
+        return self.runDatabase.record(registration,
+                                       referenceDigest=self.getVolumeDigest(referenceNode),
+                                       floatingDigest=self.getVolumeDigest(floatingNode))
+
+
+    def getWarmStart(self, referenceNode, floatingNode, parameters):
+        """
+        See NiftyRegLib.RunDatabase.getWarmStart
+        """
+        return self.runDatabase.getWarmStart(self.getVolumeDigest(referenceNode),
+                                             self.getVolumeDigest(floatingNode),
+                                             parameters)
+
+
+    def getMachineProfile(self):
+        """
+        Speed of NiftyReg on this machine. It is measured the first time it
+        is needed and stored, so the calibration only runs once per machine.
+        Returns None if NiftyReg could not be calibrated
+        """
+        if not self.machineProfileRead:
+            self.machineProfileRead = True
+            if not self.machineProfilePath.is_file():
+                slicer.util.showStatusMessage('Measuring the speed of NiftyReg on this machine...')
+                slicer.app.processEvents()
+            try:
+                self.machineProfile = NiftyRegLib.getMachineProfile(self.machineProfilePath)
+            except RuntimeError as e:
+                print(e)
+            slicer.util.showStatusMessage('')
+        return self.machineProfile
+
+
+    def getTunedParameters(self, parameters, referenceNode, floatingNode):
+        """
+        See NiftyRegLib.getTunedParameters
+        """
+        referenceImageData = referenceNode.GetImageData()
+        floatingImageData = floatingNode.GetImageData()
+        return NiftyRegLib.getTunedParameters(parameters,
+                                              referenceImageData.GetDimensions(),
+                                              floatingImageData.GetDimensions(),
+                                              profile=self.getMachineProfile(),
+                                              availableMemory=NiftyRegLib.getAvailableMemory(),
+                                              referenceItemSize=self.getInputItemSize(referenceNode),
+                                              floatingItemSize=self.getInputItemSize(floatingNode),
+                                              referenceSpacing=referenceNode.GetSpacing())
+
+
+    def fitMemoryBudget(self, parameters, referenceNode, floatingNode):
+        """
+        See NiftyRegLib.fitMemoryBudget. The budget is a fraction of the
+        available memory, and there is none if it is not known
+        """
+        availableMemory = NiftyRegLib.getAvailableMemory()
+        budget = None if availableMemory is None else NiftyRegLib.tuning.MEMORY_FRACTION * availableMemory
+        referenceImageData = referenceNode.GetImageData()
+        floatingImageData = floatingNode.GetImageData()
+        return NiftyRegLib.fitMemoryBudget(parameters,
+                                           referenceImageData.GetDimensions(),
+                                           floatingImageData.GetDimensions(),
+                                           budget,
+                                           referenceItemSize=self.getInputItemSize(referenceNode),
+                                           floatingItemSize=self.getInputItemSize(floatingNode),
+                                           referenceSpacing=referenceNode.GetSpacing())
+
+
+    def runBatch(self, jobs, outputDir=None, maxWorkers=None, onJobFinished=None):
+        """
+        See NiftyRegLib.runBatch
+        """
+        if outputDir is None:
+            outputDir = self.getTempDirectory()
+        return NiftyRegLib.runBatch(jobs, outputDir, maxWorkers=maxWorkers, onJobFinished=onJobFinished)
+
+
+    def registerFloatingVolumes(self, referenceNode, floatingNodes, parameters=None, maxWorkers=None,
+                                onVolumeRegistered=None, onFinished=None):
+        """
+        Registers many floating volumes to one reference. The reference is
+        exported, thresholded, cropped and masked only once, then the
+        floating volumes are registered by concurrent NiftyReg processes (see
+        NiftyRegLib.runOneToMany). The thresholds missing in the parameters
+        are read from the display nodes.
+        The processes are managed from a worker thread and each result is
+        loaded into the scene as soon as it is ready, from a timer on the main
+        thread. onVolumeRegistered(floatingNode, resultVolumeNode,
+        resultTransformNode) is called after each one, with None nodes if the
+        registration failed
+        """
+        if parameters is None:
+            parameters = RegistrationParameters()
+        tempDir = self.getTempDirectory()
+        refPath = self.getInputPath(referenceNode, tempDir)
+        if parameters.referenceThresholds is None:
+            parameters = parameters.copy(referenceThresholds=self.getThresholdRange(referenceNode))
+        floPaths = [self.getInputPath(node, tempDir) for node in floatingNodes]
+        floatingThresholds = None
+        if parameters.floatingThresholds is None:
+            floatingThresholds = [self.getThresholdRange(node) for node in floatingNodes]
+        outputDir = Path(tempDir) / datetime.datetime.now().strftime('oneToMany_%Y%m%d_%H%M%S')
+
+        results = queue.Queue()
+
+        def run():
+            try:
+                for result in NiftyRegLib.runOneToMany(refPath, floPaths, parameters, str(outputDir),
+                                                       maxWorkers=maxWorkers,
+                                                       floatingThresholds=floatingThresholds):
+                    results.put(result)
+            except Exception as e:
+                # Reported from the main thread, as failures of the missing results
+                results.put(e)
+            finally:
+                results.put(None)
+
+        registeredIndices = set()
+
+        def onTimer():
+            while not results.empty():
+                result = results.get()
+                if isinstance(result, Exception):
+                    print('Registration to {} failed:\n{}'.format(referenceNode.GetName(), result))
+                    for index, floatingNode in enumerate(floatingNodes):
+                        if index not in registeredIndices and onVolumeRegistered is not None:
+                            onVolumeRegistered(floatingNode, None, None)
+                    continue
+                if result is None:
+                    timer.stop()
+                    self.oneToManyTimers.remove(timer)
+                    self.removeStaleExports()
+                    if onFinished is not None:
+                        onFinished()
+                    return
+                registeredIndices.add(result.index)
+                floatingNode = floatingNodes[result.index]
+                resultVolumeNode, resultTransformNode = self.loadBatchResult(
+                    result, referenceNode, floatingNode, parameters.isLinear())
+                if onVolumeRegistered is not None:
+                    onVolumeRegistered(floatingNode, resultVolumeNode, resultTransformNode)
+
+        timer = qt.QTimer()
+        timer.setInterval(100)
+        timer.timeout.connect(onTimer)
+        self.oneToManyTimers.append(timer)  # keep a reference until it finishes
+        threading.Thread(target=run, daemon=True).start()
+        timer.start()
+
+
+    def loadBatchResult(self, result, referenceNode, floatingNode, isLinear):
+        """
+        Adds the result volume and transform of a BatchResult to the scene
+        """
+        name = '{}_on_{}'.format(floatingNode.GetName(), referenceNode.GetName())
+        if result.returnCode != 0:
+            print('Registration of {} failed:\n{}'.format(floatingNode.GetName(), result.errorOutput))
+            return None, None
+
+        if self.is2D(referenceNode):
+            su.PushToSlicer(sitk.ReadImage(result.resultPath), name, overwrite=True)
+            resultVolumeNode = slicer.util.getNode(name)
+        else:
+            resultVolumeNode = slicer.util.loadVolume(result.resultPath, returnNode=True)[1]
+        resultVolumeNode.SetName(name)
+
+        if isLinear:
+            matrix = self.readNiftyRegMatrix(result.transformPath)
+            resultTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+            resultTransformNode.SetMatrixTransformFromParent(self.getVTKMatrixFromNumpyMatrix(matrix))
+        else:
+            resultTransformNode = self.vectorfieldToDisplacementField(result.transformPath, referenceNode)
+        resultTransformNode.SetName('t_' + name)
+        return resultVolumeNode, resultTransformNode
+
+
     def getNodeFilepath(self, node):
         storageNode = node.GetStorageNode()
         if storageNode is None:
@@ -667,13 +1691,7 @@ class NiftyRegLogic(ScriptedLoadableModuleLogic):
 
 
     def getTempPath(self, directory, ext, length=10, filename=None, dateTime=None):
-        if filename is None:
-            filename = ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
-        filename = filename.replace(' ', '_')  # avoid errors when running a command with spaces
-        filename += ext
-        if dateTime is not None:
-            filename = '{}_{}'.format(dateTime.strftime("%Y%m%d_%H%M%S"), filename)
-        return str(Path(directory) / filename)
+        return NiftyRegLib.getTempPath(directory, ext, length=length, filename=filename, dateTime=dateTime)
 
 
     def centerViews(self):
@@ -713,136 +1731,136 @@ class NiftyRegLogic(ScriptedLoadableModuleLogic):
 
 
     def getNumpyMatrixFromVTKMatrix(self, vtkMatrix):
-        matrix = np.identity(4)
-        for row in range(4):
-            for col in range(4):
-                matrix[row,col] = vtkMatrix.GetElement(row,col)
-        return matrix
+        return NiftyRegLib.vtkmatrix.getNumpyMatrixFromVTKMatrix(vtkMatrix)
 
 
     def getVTKMatrixFromNumpyMatrix(self, numpyMatrix):
-        dimensions = len(numpyMatrix) - 1
-        if dimensions == 2:
-            vtkMatrix = vtk.vtkMatrix3x3()
-        elif dimensions == 3:
+        return NiftyRegLib.vtkmatrix.getVTKMatrixFromNumpyMatrix(numpyMatrix)
+
+
+    def getMatricesFromTransformNodes(self, transformNodes):
+        """
+        Returns an (N, 4, 4) array with the matrices from parent of the nodes
+        """
+        vtkMatrices = []
+        for transformNode in transformNodes:
             vtkMatrix = vtk.vtkMatrix4x4()
-        else:
-            raise ValueError('Unknown matrix dimensions.')
+            transformNode.GetMatrixTransformFromParent(vtkMatrix)
+            vtkMatrices.append(vtkMatrix)
+        return NiftyRegLib.vtkmatrix.getNumpyMatricesFromVTKMatrices(vtkMatrices)
 
-        for row in range(dimensions + 1):
-            for col in range(dimensions + 1):
-                vtkMatrix.SetElement(row, col, numpyMatrix[row,col])
-        return vtkMatrix
+
+    def setMatricesToTransformNodes(self, transformNodes, matrices):
+        vtkMatrices = NiftyRegLib.vtkmatrix.getVTKMatricesFromNumpyMatrices(matrices)
+        for transformNode, vtkMatrix in zip(transformNodes, vtkMatrices):
+            transformNode.SetMatrixTransformFromParent(vtkMatrix)
 
 
     def readNiftyRegMatrix(self, trsfPath):
-        with open(trsfPath) as f:
-            return np.loadtxt(f.readlines())
+        return NiftyRegLib.readNiftyRegMatrix(trsfPath)
+
+
+    def readNiftyRegMatrices(self, trsfPaths):
+        return NiftyRegLib.readNiftyRegMatrices(trsfPaths)
 
 
     def writeNiftyRegMatrix(self, transformNode, trsfPath):
-        vtkMatrix = vtk.vtkMatrix4x4()
-        transformNode.GetMatrixTransformFromParent(vtkMatrix)
-        matrix = self.getNumpyMatrixFromVTKMatrix(vtkMatrix)
-        lines = []
-        for row in matrix:
-            line = []
-            for n in row:
-                line.append('{:13.8f}'.format(n))
-            lines.append(''.join(line))
-        line = '\n'.join(lines)
-        with open(trsfPath, 'w') as f:
-            f.write(line)
-
-
-    def vectorfieldToDisplacementField(self, vectorfieldPath, referenceNode, displacementFieldPath):
-        stream = self.getDataStreamFromVectorField(vectorfieldPath)
-        referenceImage = su.PullFromSlicer(referenceNode.GetID())
-        shape = list(referenceImage.GetSize())
-        shape.reverse()
-
-        # Example of 2D shape at this point: [1, 540, 940]
-
-        # Blockmatching output might be 2D
-        is2D = shape[0] == 1
-        componentsPerVector = 2 if is2D else 3
-        shape.append(componentsPerVector)
-        reshaped = stream.reshape(shape)
-
-        # Force the output to be 3D
-        if is2D:
-            zeros = np.zeros_like(reshaped[..., :1])  # z component of the vectors
-            reshaped = np.concatenate((reshaped, zeros), axis=3)
-
-        reshaped[..., :2] *= -1  # RAS to LPS
-        displacementImage = sitk.GetImageFromArray(reshaped)
-        displacementImage.SetOrigin(referenceImage.GetOrigin())
-        displacementImage.SetDirection(referenceImage.GetDirection())
-        displacementImage.SetSpacing(referenceImage.GetSpacing())
-
-        # TODO: convert the image directly into a transform to save space and time
-        sitk.WriteImage(displacementImage, displacementFieldPath)
-        transformNode = slicer.util.loadTransform(displacementFieldPath, returnNode=True)[1]
+        self.writeNiftyRegMatrices([transformNode], [trsfPath])
+
+
+    def writeNiftyRegMatrices(self, transformNodes, trsfPaths):
+        matrices = self.getMatricesFromTransformNodes(transformNodes)
+        NiftyRegLib.writeNiftyRegMatrices(matrices, trsfPaths)
+
+
+    def vectorfieldToDisplacementField(self, vectorfieldPath, referenceNode):
+        """
+        Creates a B-spline transform node from a reg_f3d control point grid, or
+        a grid transform node from a dense vector field, without writing any
+        file
+        """
+        from vtk.util import numpy_support
+
+        referenceShape = referenceNode.GetImageData().GetDimensions()[::-1]
+        vectorField = NiftyRegLib.VectorField(vectorfieldPath, referenceShape=referenceShape)
+
+        # Fill the VTK array directly to avoid extra copies
+        numberOfPoints = int(np.prod(vectorField.shape))
+        vtkArray = vtk.vtkFloatArray()
+        vtkArray.SetNumberOfComponents(3)
+        vtkArray.SetNumberOfTuples(numberOfPoints)
+        vectorField.getDisplacement(out=numpy_support.vtk_to_numpy(vtkArray))
+
+        gridImage = vtk.vtkImageData()
+        gridImage.SetDimensions(vectorField.shape[::-1])
+        gridImage.SetOrigin(vectorField.origin)
+        gridImage.SetSpacing(vectorField.spacing)
+        gridImage.GetPointData().SetScalars(vtkArray)
+
+        direction = np.identity(4)
+        direction[:3, :3] = vectorField.direction
+        directionMatrix = self.getVTKMatrixFromNumpyMatrix(direction)
+
+        if vectorField.isSplineGrid:
+            transform = slicer.vtkOrientedBSplineTransform()
+            transform.SetCoefficientData(gridImage)
+            transform.SetBorderModeToZero()
+            nodeClass = 'vtkMRMLBSplineTransformNode'
+        else:
+            transform = slicer.vtkOrientedGridTransform()
+            transform.SetDisplacementGridData(gridImage)
+            transform.SetInterpolationModeToCubic()
+            nodeClass = 'vtkMRMLGridTransformNode'
+        transform.SetGridDirectionMatrix(directionMatrix)
+
+        # NiftyReg maps the reference space to the floating space
+        transformNode = slicer.mrmlScene.AddNewNodeByClass(nodeClass)
+        transformNode.SetAndObserveTransformFromParent(transform)
         return transformNode
 
 
     def getDataStreamFromVectorField(self, vectorfieldPath):
-        HEADER_SIZE = 256
-        with open(vectorfieldPath, mode='rb') as f:  # b is important -> binary
-            f.seek(HEADER_SIZE)
-            imageData = f.read()
-        imageData = np.frombuffer(imageData, dtype=np.float32)
-        return imageData
+        return NiftyRegLib.getDataStreamFromVectorField(vectorfieldPath)
 
 
     def getNIFTIHeader(self, volumeNode):
-        reader = vtk.vtkNIFTIImageReader()
-        filepath = self.getNodeFilepath(volumeNode)
-        reader.SetFileName(filepath)
-        reader.Update()
-        header = reader.GetNIFTIHeader()
-        return header
+        """
+        Returns the header of the file that will be passed to NiftyReg, or None
+        if the node is going to be exported. Only the header is read, and only
+        once per file unless the file changes
+        """
+        path = self.getUpToDateNiftiPath(volumeNode)
+        if path is None:
+            return None
+        return NiftyRegLib.getCachedNiftiHeader(path)
 
 
     def getQFormAndSFormCodes(self, volumeNode):
+        """
+        Returns None if the node is going to be exported, as the files written
+        by SimpleITK always have valid codes
+        """
         header = self.getNIFTIHeader(volumeNode)
-        qform_code = header.GetQFormCode()
-        sform_code = header.GetSFormCode()
-        return qform_code, sform_code
+        if header is None:
+            return None
+        return header.getQFormCode(), header.getSFormCode()
 
 
     def getPyramidShapesMap(self, volumeNode):
-
-        def halve(shape):
-            return [int(round(float(n)/2)) for n in shape]
-
         if volumeNode is None: return None
 
         imageData = volumeNode.GetImageData()
-        shape = list(imageData.GetDimensions())
-
-        level = 0
-        shapesMap = {level: shape}
-
-        lastLevel = False
-        while not lastLevel:
-            oldShape = shapesMap[level]
-            newShape = halve(oldShape)
-            level += 1
-
-            if min(newShape) < 32:
-                lastLevel = True
-            else:
-                shapesMap[level] = newShape
-
+        if imageData is None: return None
+        cached = self.pyramidShapesMaps.get(volumeNode.GetID())
+        if cached is not None and cached[0] == imageData.GetMTime():
+            return cached[1]
+        shapesMap = NiftyRegLib.getPyramidShapesMap(imageData.GetDimensions())
+        self.pyramidShapesMaps[volumeNode.GetID()] = imageData.GetMTime(), shapesMap
         return shapesMap
 
 
     def hasNiftiExtension(self, path):
-        for ext in '.hdr', '.img', '.img.gz', '.nii', '.nii.gz':
-            if path.endswith(ext):
-                return True
-        return False
+        return NiftyRegLib.hasNiftiExtension(path)
 
 
     def is2D(self, volumeNode):
@@ -855,15 +1873,50 @@ class NiftyRegLogic(ScriptedLoadableModuleLogic):
         return is2D
 
 
-    def isDouble(self, volumeNode):
+    def needsExport(self, volumeNode):
+        """
+        True if the data type of the volume is wider than NiftyReg needs,
+        e.g. double
+        """
         header = self.getNIFTIHeader(volumeNode)
-        return header.GetDataType() == 64
+        if header is not None:
+            return NiftyRegLib.needsExport(header.getNumpyDataType())
+        imageData = volumeNode.GetImageData()
+        return imageData is not None and imageData.GetScalarSize() > NiftyRegLib.export.MAXIMUM_ITEM_SIZE
+
+
+    def getInputItemSize(self, volumeNode):
+        """
+        Bytes per voxel of the NiftyReg input of the volume, as wider data
+        types are cast before running NiftyReg
+        """
+        itemSize = volumeNode.GetImageData().GetScalarSize()
+        return min(itemSize, NiftyRegLib.export.MAXIMUM_ITEM_SIZE)
+
+
+    def getIntensityStatistics(self, volumeNode):
+        """
+        The statistics are computed again only if the image data changes
+        """
+        if volumeNode is None: return None
+        key = volumeNode.GetImageData().GetMTime()
+        cached = self.intensityStatistics.get(volumeNode.GetID())
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        array = slicer.util.arrayFromVolume(volumeNode)
+        statistics = NiftyRegLib.computeIntensityStatistics(array)
+        self.intensityStatistics[volumeNode.GetID()] = key, statistics
+        return statistics
 
 
     def getRange(self, volumeNode):
         if volumeNode is None: return None
-        array = slicer.util.array(volumeNode.GetID())
-        return array.min(), array.max()
+        return self.getIntensityStatistics(volumeNode).getRange()
+
+
+    def getRobustThresholds(self, volumeNode):
+        if volumeNode is None: return None
+        return self.getIntensityStatistics(volumeNode).getRobustThresholds()
 
 
     def getThresholdRange(self, volumeNode):
@@ -0,0 +1,115 @@
+"""
+Slicer-independent part of the NiftyReg module. It can be used from the
+module, from scripts or from the command line (python -m NiftyRegLib)
+
+The submodules are imported the first time one of their names is used, so
+importing the package does not load NumPy or SimpleITK. This keeps the
+startup of Slicer fast, as the module is imported even if it is not used
+"""
+
+import importlib
+
+EXPORTS = (
+    ('parameters', (
+        'RegistrationParameters',
+        'TRANSFORMATION_TYPES',
+        'PERFORMANCE_OPTIONS',
+    )),
+    ('presets', ('PRESETS', 'DEFAULT_PRESET', 'PresetLibrary', 'readPreset', 'writePreset', 'getPresetDict')),
+    ('process', ('NiftyRegProcess',)),
+    ('progress', ('OutputParser', 'EventLog', 'readEventLog', 'getLevelsSummary')),
+    ('matrix', (
+        'readNiftyRegMatrix',
+        'writeNiftyRegMatrix',
+        'readNiftyRegMatrices',
+        'writeNiftyRegMatrices',
+    )),
+    ('nifti', (
+        'NiftiHeader',
+        'hasNiftiExtension',
+        'getNiftiStem',
+        'readNiftiHeader',
+        'getCachedNiftiHeader',
+        'clearNiftiHeaderCache',
+        'readNiftiArray',
+        'writeNiftiArray',
+        'makeNiftiHeader',
+        'iterNiftiChunks',
+        'getDataStreamFromVectorField',
+    )),
+    ('export', ('getExportDataType', 'needsExport', 'writeExportImage', 'exportNiftiFile')),
+    ('resampling', (
+        'getSimpleITKAffineTransform',
+        'resampleWithMatrix',
+        'resampleWithTransform',
+        'resampleFloating',
+    )),
+    ('vectorfield', (
+        'VectorField',
+        'ReferenceDisplacementField',
+        'getDisplacementFieldImage',
+        'writeDisplacementField',
+        'resampleWithVectorField',
+    )),
+    ('statistics', (
+        'ROBUST_PERCENTILES',
+        'IntensityStatistics',
+        'computeIntensityStatistics',
+        'readIntensityStatistics',
+    )),
+    ('cropping', ('getBoundingBox', 'getCropBox', 'prepareInput', 'padControlPointGrid')),
+    ('cache', ('ResultCache', 'getFileDigest', 'getArrayDigest')),
+    ('binaries', ('findBinary', 'getBinaryVersion', 'getBinariesDescription')),
+    ('registration', (
+        'TRANSFORMATIONS_MAP',
+        'BatchResult',
+        'Registration',
+        'getBinaryPath',
+        'getTempPath',
+        'getTransformExtension',
+        'getCommandLineList',
+        'getThreadsPerJob',
+        'runBatch',
+        'runOneToMany',
+    )),
+    ('pipeline', ('Pipeline', 'getPipelineStages')),
+    ('memory', ('MemoryEstimate', 'estimateMemory', 'fitMemoryBudget', 'formatBytes')),
+    ('tuning', (
+        'MachineProfile',
+        'getPyramidShapesMap',
+        'getAvailableMemory',
+        'calibrate',
+        'getMachineProfile',
+        'getTunedParameters',
+        'getTuningDescription',
+    )),
+    ('metrics', (
+        'computeSimilarityMetrics',
+        'computeJacobianStatistics',
+        'computeDisplacementFieldJacobianStatistics',
+        'computeRegistrationMetrics',
+    )),
+    ('database', ('RunDatabase', 'WarmStart')),
+    ('lazy', ('LazyModule',)),
+)
+
+NAMES_MODULES = {name: module for module, names in EXPORTS for name in names}
+SUBMODULES = tuple(module for module, names in EXPORTS) + ('vtkmatrix',)
+
+__all__ = sorted(NAMES_MODULES)
+
+
+def __getattr__(name):
+    if name in NAMES_MODULES:
+        module = importlib.import_module('.' + NAMES_MODULES[name], __name__)
+        value = getattr(module, name)
+    elif name in SUBMODULES:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(NAMES_MODULES) | set(SUBMODULES))
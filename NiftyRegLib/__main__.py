@@ -0,0 +1,320 @@
+import sys
+import argparse
+
+from .parameters import RegistrationParameters, TRANSFORMATION_TYPES, SIMILARITY_MEASURES, INTERPOLATION_ORDERS
+from .presets import PRESETS, PresetLibrary, readPreset, writePreset, getPresetDict
+from .cache import ResultCache, getFileDigest
+from .database import RunDatabase, getRunsTable
+from .progress import getLevelsSummary
+from .statistics import ROBUST_PERCENTILES, readIntensityStatistics
+from .registration import Registration
+from .pipeline import Pipeline
+from .binaries import getBinariesDescription
+from .nifti import readNiftiHeader
+from .tuning import getMachineProfile, getTunedParameters, getTuningDescription, getAvailableMemory, MEMORY_FRACTION
+from .memory import fitMemoryBudget, formatBytes
+
+
+# Command line destinations of the performance options
+PERFORMANCE_ARGUMENTS = (
+    ('linear_iterations', 'linearIterations'),
+    ('blocks', 'blocksPercentage'),
+    ('inliers', 'inliersPercentage'),
+    ('nonlinear_iterations', 'nonLinearIterations'),
+    ('bending_energy', 'bendingEnergyWeight'),
+    ('spacing', 'controlPointSpacing'),
+    ('similarity', 'similarityMeasure'),
+    ('bins', 'histogramBins'),
+    ('lncc_sd', 'lnccStandardDeviation'),
+    ('interpolation', 'interpolationOrder'),
+)
+
+
+class BinariesVersionAction(argparse.Action):
+    """
+    Prints the NiftyReg binaries and their versions. They are only run if
+    the option is used
+    """
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None):
+        super(BinariesVersionAction, self).__init__(
+            option_strings, dest=dest, default=default, nargs=0, help=help)
+
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print(getBinariesDescription())
+        parser.exit()
+
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        prog='python -m NiftyRegLib',
+        description='Run a NiftyReg registration without Slicer')
+    parser.add_argument('--version', action=BinariesVersionAction,
+                        help='show the NiftyReg binaries that are used and exit')
+    parser.add_argument('reference', help='reference image')
+    parser.add_argument('floating', help='floating image')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='directory for the output files [%(default)s]')
+    parser.add_argument('-p', '--parameters',
+                        help='JSON file with the registration parameters. '
+                             'The options below override its values')
+    parser.add_argument('-t', '--type', choices=TRANSFORMATION_TYPES,
+                        help='transformation type')
+    parser.add_argument('--reference-thresholds', nargs=2, type=float, metavar=('LOW', 'UP'))
+    parser.add_argument('--floating-thresholds', nargs=2, type=float, metavar=('LOW', 'UP'))
+    parser.add_argument('--robust-thresholds', action='store_true',
+                        help='use the {} and {} intensity percentiles as thresholds '
+                             'for the images without explicit thresholds'.format(*ROBUST_PERCENTILES))
+    parser.add_argument('--crop', action='store_true',
+                        help='crop the inputs to the voxels within the thresholds before running NiftyReg')
+    parser.add_argument('--crop-margin', type=float, metavar='MM',
+                        help='margin around the cropped region, in mm [{}]'.format(
+                            RegistrationParameters().cropMargin))
+    parser.add_argument('--masks', action='store_true',
+                        help='use the voxels within the thresholds as masks (-rmask and -fmask)')
+    parser.add_argument('--levels', nargs=2, type=int, metavar=('LN', 'LP'),
+                        help='number of pyramid levels to create and to use')
+    parser.add_argument('--threads', type=int, help='number of OpenMP threads')
+
+    performance = parser.add_argument_group(
+        'performance options', 'Options that trade accuracy for speed. By default, the NiftyReg defaults are used')
+    performance.add_argument('--auto-tune', action='store_true',
+                             help='choose the pyramid levels and, unless they are given, the threads and the '
+                                  'control point spacing from the image sizes, the cores and the available memory')
+    performance.add_argument('--calibration', metavar='PATH',
+                             help='JSON file with the speed of NiftyReg on this machine, used by --auto-tune '
+                                  'to fit the levels in a time budget. It is measured and written if missing')
+    performance.add_argument('--memory-budget', type=float, metavar='GIB',
+                             help='skip the finest pyramid levels, or refuse to run, if the estimated peak memory '
+                                  'is larger than this [{:g} %% of the available memory]'.format(100 * MEMORY_FRACTION))
+    performance.add_argument('--no-memory-guard', action='store_true',
+                             help='run even if the registration might not fit in memory')
+    performance.add_argument('--preset',
+                             help='built-in preset ({}) or JSON preset file. '
+                                  'The options below override its values'.format(', '.join(PRESETS)))
+    performance.add_argument('--save-preset', metavar='PATH',
+                             help='write the performance options to a JSON preset file instead of running a registration')
+    performance.add_argument('--linear-iterations', type=int, metavar='N',
+                             help='maximum number of iterations per level of reg_aladin (-maxit)')
+    performance.add_argument('--blocks', type=int, metavar='PERCENT',
+                             help='percentage of blocks used by reg_aladin (-pv)')
+    performance.add_argument('--inliers', type=int, metavar='PERCENT',
+                             help='percentage of blocks considered as inliers by reg_aladin (-pi)')
+    performance.add_argument('--nonlinear-iterations', type=int, metavar='N',
+                             help='maximum number of iterations per level of reg_f3d (-maxit)')
+    performance.add_argument('--bending-energy', type=float, metavar='WEIGHT',
+                             help='weight of the bending energy of reg_f3d (-be)')
+    performance.add_argument('--spacing', type=float,
+                             help='control point spacing of reg_f3d in mm, or in voxels if negative (-sx)')
+    performance.add_argument('--smoothing', nargs=2, type=float, metavar=('REF', 'FLO'),
+                             help='standard deviations in mm of the Gaussian smoothing (-smooR, -smooF)')
+    performance.add_argument('--similarity', choices=SIMILARITY_MEASURES,
+                             help='similarity measure of reg_f3d (--nmi, --lncc)')
+    performance.add_argument('--bins', type=int,
+                             help='number of histogram bins for NMI (--rbn, --fbn)')
+    performance.add_argument('--lncc-sd', type=float, metavar='MM',
+                             help='standard deviation of the LNCC kernel')
+    performance.add_argument('--interpolation', type=int, choices=INTERPOLATION_ORDERS,
+                             help='interpolation order used by NiftyReg (-interp)')
+    parser.add_argument('--initial-transform',
+                        help='NiftyReg affine matrix used for initialization')
+    parser.add_argument('--initial-control-point-grid',
+                        help='reg_f3d control point grid used for initialization')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run the rigid and affine stages before the selected transformation type, '
+                             'each one initialized with the result of the previous one')
+    parser.add_argument('--quick', action='store_true',
+                        help='only use the coarsest pyramid level, to get an approximate result quickly')
+    parser.add_argument('--displacement-field',
+                        help='write the non-linear result as an LPS displacement field')
+    parser.add_argument('--metrics', action='store_true',
+                        help='compute NCC, NMI, MSD and, for non-linear results, Jacobian determinant statistics')
+    parser.add_argument('--cache-dir',
+                        help='reuse the outputs of identical registrations stored in this directory')
+    parser.add_argument('--cache-size', type=float, default=4,
+                        help='maximum size of the cache in GiB [%(default)s]')
+    parser.add_argument('--database',
+                        help='SQLite file where the runs are recorded')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='initialize with the closest earlier result for the same images in the database')
+    parser.add_argument('--list-runs', action='store_true',
+                        help='list the runs of these images in the database instead of running a registration')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the NiftyReg output')
+    return parser
+
+
+def getParameters(args):
+    if args.parameters is None:
+        parameters = RegistrationParameters()
+    else:
+        parameters = RegistrationParameters.read(args.parameters)
+    if args.preset is not None:
+        if args.preset in PRESETS:
+            preset = PresetLibrary().get(args.preset)
+        else:
+            preset = readPreset(args.preset)
+        parameters = parameters.applyPreset(preset)
+
+    overrides = {}
+    for argument, option in PERFORMANCE_ARGUMENTS:
+        value = getattr(args, argument)
+        if value is not None:
+            overrides[option] = value
+    if args.smoothing is not None:
+        overrides['referenceSmoothing'], overrides['floatingSmoothing'] = args.smoothing
+    if args.type is not None:
+        overrides['transformationType'] = args.type
+    if args.reference_thresholds is not None:
+        overrides['referenceThresholds'] = args.reference_thresholds
+    elif args.robust_thresholds:
+        overrides['referenceThresholds'] = readIntensityStatistics(args.reference).getRobustThresholds()
+    if args.floating_thresholds is not None:
+        overrides['floatingThresholds'] = args.floating_thresholds
+    elif args.robust_thresholds:
+        overrides['floatingThresholds'] = readIntensityStatistics(args.floating).getRobustThresholds()
+    if args.crop:
+        overrides['cropToThresholds'] = True
+    if args.crop_margin is not None:
+        overrides['cropMargin'] = args.crop_margin
+    if args.masks:
+        overrides['useMasks'] = True
+    if args.levels is not None:
+        overrides['pyramidLevels'] = args.levels
+    if args.threads is not None:
+        overrides['threads'] = args.threads
+    parameters = parameters.copy(**overrides)
+    if args.auto_tune:
+        profile = None if args.calibration is None else getMachineProfile(args.calibration)
+        shapes, memoryOptions = getMemoryOptions(args)
+        parameters = getTunedParameters(parameters, *shapes, profile=profile, availableMemory=getAvailableMemory(),
+                                        **memoryOptions)
+        print(getTuningDescription(parameters))
+    if args.quick:
+        parameters = parameters.getQuickRunParameters()
+    return parameters
+
+
+def getMemoryOptions(args):
+    """
+    Shapes (x, y, z) and bytes per voxel of the inputs, for estimateMemory
+    """
+    referenceHeader, floatingHeader = readNiftiHeader(args.reference), readNiftiHeader(args.floating)
+    shapes = referenceHeader.getDimensions()[:3], floatingHeader.getDimensions()[:3]
+    options = {
+        'referenceItemSize': referenceHeader.getNumpyDataType().itemsize,
+        'floatingItemSize': floatingHeader.getNumpyDataType().itemsize,
+    }
+    return shapes, options
+
+
+def main(argv=None):
+    parser = getParser()
+    args = parser.parse_args(argv)
+    if args.pipeline and args.initial_control_point_grid is not None:
+        parser.error('--initial-control-point-grid can not be used with --pipeline, '
+                     'as the grid already includes the linear stages')
+    if args.list_runs and args.database is None:
+        parser.error('--list-runs requires --database')
+    if args.list_runs:
+        database = RunDatabase(args.database)
+        print(getRunsTable(database.query(getFileDigest(args.reference), getFileDigest(args.floating))))
+        return 0
+    parameters = getParameters(args)
+    if args.save_preset is not None:
+        writePreset(args.save_preset, getPresetDict(parameters))
+        print('Preset written to {}'.format(args.save_preset))
+        return 0
+    if not args.no_memory_guard:
+        if args.memory_budget is None:
+            availableMemory = getAvailableMemory()
+            budget = None if availableMemory is None else MEMORY_FRACTION * availableMemory
+        else:
+            budget = args.memory_budget * 2**30
+        shapes, memoryOptions = getMemoryOptions(args)
+        try:
+            fitted, estimate = fitMemoryBudget(parameters, shapes[0], shapes[1], budget, **memoryOptions)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+        if fitted.pyramidLevels != parameters.pyramidLevels:
+            print('Only {1} of {0} pyramid levels will be performed to fit in the memory budget'.format(
+                *fitted.pyramidLevels))
+        print('Estimated peak memory: {}'.format(formatBytes(estimate.peak)))
+        parameters = fitted
+    onOutput = None if args.quiet else lambda streamName, line: print(line)
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResultCache(args.cache_dir, maxSize=int(args.cache_size * 2**30))
+    database = digests = None
+    if args.database is not None:
+        database = RunDatabase(args.database)
+        digests = getFileDigest(args.reference), getFileDigest(args.floating)
+    if args.warm_start and database is not None \
+            and args.initial_transform is None and args.initial_control_point_grid is None:
+        warmStart = database.getWarmStart(digests[0], digests[1], parameters)
+        if warmStart is not None:
+            print('Starting from the {} result of run {}'.format(warmStart.transformationType, warmStart.runId))
+            args.initial_transform = warmStart.initialTransformPath
+            args.initial_control_point_grid = warmStart.initialControlPointGridPath
+
+    # A warm start may have given a control point grid, which replaces the
+    # linear stages, as in the module
+    if args.pipeline and args.initial_control_point_grid is None:
+        pipeline = Pipeline(args.reference,
+                            args.floating,
+                            parameters,
+                            outputDir=args.output_dir,
+                            initialTransformPath=args.initial_transform)
+
+        def onStageStarted(index, registration):
+            print('Stage {} / {}: {}'.format(index + 1, len(pipeline), registration.parameters.transformationType))
+
+        pipeline.run(onOutput=onOutput, cache=cache, onStageStarted=onStageStarted)
+        registration = pipeline.lastRegistration
+        registrations = pipeline.registrations[:pipeline.registrations.index(registration) + 1]
+    else:
+        registration = Registration(args.reference,
+                                    args.floating,
+                                    parameters,
+                                    outputDir=args.output_dir,
+                                    initialTransformPath=args.initial_transform,
+                                    initialControlPointGridPath=args.initial_control_point_grid)
+        registration.run(onOutput=onOutput, cache=cache)
+        registrations = [registration]
+
+    if args.metrics and registration.succeeded():
+        registration.computeMetrics()
+    if database is not None:
+        for stageRegistration in registrations:
+            database.record(stageRegistration, *digests)
+
+    if not registration.succeeded():
+        print(registration.errorOutput, file=sys.stderr)
+        print('Registration failed', file=sys.stderr)
+        return 1
+
+    if registration.cached:
+        print('Results found in the cache')
+    else:
+        print('Registration completed in {:.2f} seconds'.format(registration.elapsedTime))
+        if registration.levels:
+            print(getLevelsSummary(registration.levels))
+    print('Result: {}'.format(registration.resPath))
+    print('Transform: {}'.format(registration.resultTransformPath))
+    if not registration.cached:
+        print('Events: {}'.format(registration.eventsPath))
+    if args.metrics:
+        metrics = registration.metrics
+        for name, value in sorted(metrics.items()):
+            print('{}: {:g}'.format(name, value))
+        print('Metrics: {}'.format(registration.metricsPath))
+    if args.displacement_field is not None and not parameters.isLinear():
+        registration.writeDisplacementField(args.displacement_field)
+        print('Displacement field: {}'.format(args.displacement_field))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
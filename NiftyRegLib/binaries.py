@@ -0,0 +1,55 @@
+"""
+Discovery of the NiftyReg binaries. The PATH is only searched the first time
+a binary is needed, and the version is only asked once per session
+"""
+
+import shutil
+import functools
+import subprocess
+
+
+BINARY_NAMES = 'reg_aladin', 'reg_f3d'
+
+
+@functools.lru_cache(maxsize=None)
+def findBinary(name):
+    """
+    Returns the path of a binary, or None if it is not in the PATH.
+    Names that are already paths are checked directly
+    """
+    return shutil.which(name)
+
+
+@functools.lru_cache(maxsize=None)
+def getBinaryVersion(name):
+    """
+    Returns the version reported by a binary, or None if it is not found or
+    it does not report one
+    """
+    path = findBinary(name)
+    if path is None:
+        return None
+    try:
+        completed = subprocess.run([path, '--version'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True,
+                                   timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        return None
+    return lines[-1].strip()
+
+
+def getBinariesDescription(names=BINARY_NAMES):
+    lines = []
+    for name in names:
+        path = findBinary(name)
+        if path is None:
+            lines.append('{}: not found'.format(name))
+        else:
+            version = getBinaryVersion(name) or 'unknown version'
+            lines.append('{}: {} ({})'.format(name, path, version))
+    return '\n'.join(lines)
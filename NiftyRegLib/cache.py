@@ -0,0 +1,199 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+
+CHUNK_SIZE = 2**24  # 16 MiB
+PATH_PLACEHOLDERS = (
+    ('refPath', '<reference>'),
+    ('floPath', '<floating>'),
+    ('resPath', '<result>'),
+    ('resultTransformPath', '<transform>'),
+    ('initialTransformPath', '<initial>'),
+    ('initialControlPointGridPath', '<initial grid>'),
+    ('croppedRefPath', '<cropped reference>'),
+    ('croppedFloPath', '<cropped floating>'),
+    ('croppedResPath', '<cropped result>'),
+    ('croppedTransformPath', '<cropped transform>'),
+    ('refMaskPath', '<reference mask>'),
+    ('floMaskPath', '<floating mask>'),
+)
+
+
+def getHasher():
+    return hashlib.blake2b(digest_size=20)
+
+
+def getFileDigest(path):
+    hasher = getHasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def getArrayDigest(array, *geometry):
+    """
+    Digest of the voxel data plus anything that changes its meaning in world
+    space (e.g. origin, spacing and direction)
+    """
+    hasher = getHasher()
+    hasher.update(str(array.dtype).encode())
+    hasher.update(str(array.shape).encode())
+    hasher.update(repr(geometry).encode())
+    flat = array.reshape(-1)
+    step = max(1, CHUNK_SIZE // max(1, array.itemsize))
+    for start in range(0, flat.size, step):
+        hasher.update(memoryview(flat[start:start + step].copy(order='C')).cast('B'))
+    return hasher.hexdigest()
+
+
+def getCommandKey(registration):
+    """
+    Command line of a registration with its filepaths replaced by placeholders
+    and without the options that do not change the results
+    """
+    placeholders = {}
+    for attribute, placeholder in PATH_PLACEHOLDERS:
+        path = getattr(registration, attribute)
+        if path is not None:
+            placeholders[path] = placeholder
+    cmd = [placeholders.get(arg, arg) for arg in registration.getCommandLineList()]
+    if '-omp' in cmd:
+        index = cmd.index('-omp')
+        del cmd[index:index + 2]
+    return cmd
+
+
+def getPreparationKey(parameters):
+    """
+    Options that change the cropped inputs and the masks, which are written
+    to temporary files and so do not appear in the command key
+    """
+    if not parameters.preparesInputs():
+        return None
+    return {
+        'cropToThresholds': parameters.cropToThresholds,
+        'cropMargin': parameters.cropMargin,
+        'useMasks': parameters.useMasks,
+        'referenceThresholds': parameters.referenceThresholds,
+        'floatingThresholds': parameters.floatingThresholds,
+    }
+
+
+class ResultCache(object):
+    """
+    Content-addressed cache of NiftyReg outputs. Each entry is a directory
+    named after the key, and its modification time is used to evict the least
+    recently used entries when the cache is larger than maxSize bytes
+    """
+
+    RESULT_NAME = 'result'
+    TRANSFORM_NAME = 'transform'
+
+    def __init__(self, directory, maxSize=4 * 2**30):
+        self.directory = Path(directory)
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+
+
+    def getKey(self, registration, referenceDigest=None, floatingDigest=None):
+        if referenceDigest is None:
+            referenceDigest = getFileDigest(registration.refPath)
+        if floatingDigest is None:
+            floatingDigest = getFileDigest(registration.floPath)
+        initialDigests = []
+        for path in registration.initialTransformPath, registration.initialControlPointGridPath:
+            initialDigests.append(None if path is None else getFileDigest(path))
+        keyDict = {
+            'reference': referenceDigest,
+            'floating': floatingDigest,
+            'initial': initialDigests,
+            'command': getCommandKey(registration),
+            'preparation': getPreparationKey(registration.parameters),
+        }
+        hasher = getHasher()
+        hasher.update(json.dumps(keyDict, sort_keys=True).encode())
+        return hasher.hexdigest()
+
+
+    def getEntryPaths(self, key, registration):
+        entryDir = self.directory / key
+        resultSuffix = ''.join(Path(registration.resPath).suffixes)
+        transformSuffix = ''.join(Path(registration.resultTransformPath).suffixes)
+        resultPath = entryDir / (self.RESULT_NAME + resultSuffix)
+        transformPath = entryDir / (self.TRANSFORM_NAME + transformSuffix)
+        return entryDir, resultPath, transformPath
+
+
+    def fetch(self, key, registration):
+        """
+        Copies the cached outputs to the output paths of the registration.
+        Returns True if the key was in the cache
+        """
+        entryDir, resultPath, transformPath = self.getEntryPaths(key, registration)
+        if not (resultPath.is_file() and transformPath.is_file()):
+            self.misses += 1
+            return False
+        Path(registration.resPath).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(resultPath, registration.resPath)
+        shutil.copyfile(transformPath, registration.resultTransformPath)
+        os.utime(str(entryDir))
+        self.hits += 1
+        return True
+
+
+    def store(self, key, registration):
+        entryDir, resultPath, transformPath = self.getEntryPaths(key, registration)
+        tempDir = entryDir.with_name('{}.{}.tmp'.format(key, os.getpid()))
+        if tempDir.exists():
+            shutil.rmtree(str(tempDir))
+        tempDir.mkdir(parents=True)
+        shutil.copyfile(registration.resPath, tempDir / resultPath.name)
+        shutil.copyfile(registration.resultTransformPath, tempDir / transformPath.name)
+        if entryDir.exists():
+            shutil.rmtree(str(entryDir))
+        tempDir.rename(entryDir)
+        self.evict()
+
+
+    def getEntries(self):
+        if not self.directory.is_dir(): return []
+        entries = []
+        for entryDir in self.directory.iterdir():
+            if not entryDir.is_dir() or entryDir.suffix == '.tmp':
+                continue
+            size = sum(f.stat().st_size for f in entryDir.iterdir() if f.is_file())
+            entries.append((entryDir.stat().st_mtime, size, entryDir))
+        return entries
+
+
+    def getSize(self):
+        return sum(size for _, size, _ in self.getEntries())
+
+
+    def evict(self):
+        entries = sorted(self.getEntries())  # least recently used first
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, entryDir in entries:
+            if totalSize <= self.maxSize:
+                break
+            shutil.rmtree(str(entryDir), ignore_errors=True)
+            totalSize -= size
+
+
+    def clear(self):
+        for _, _, entryDir in self.getEntries():
+            shutil.rmtree(str(entryDir), ignore_errors=True)
+
+
+    def getStatistics(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.getEntries()),
+            'size': self.getSize(),
+        }
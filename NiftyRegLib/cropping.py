@@ -0,0 +1,138 @@
+"""
+Preparation of the NiftyReg inputs for images with large empty margins.
+The inputs are cropped to the bounding box of the voxels within the
+thresholds, plus a margin, and optionally these voxels are used as masks
+(-rmask and -fmask). The cropped images keep their world geometry, so the
+matrices written by NiftyReg are also valid for the full images. Control
+point grids only cover the cropped reference, so they are extended to the
+whole reference (see padControlPointGrid)
+"""
+
+import math
+
+import numpy as np
+import SimpleITK as sitk
+
+from .nifti import readNiftiHeader, readNiftiArray, writeNiftiArray
+from .metrics import SLAB_SIZE, iterSlabs
+
+
+def getBoundingBox(array, thresholds, slabSize=SLAB_SIZE):
+    """
+    Smallest box that contains the voxels within the thresholds, as
+    (start, stop) pairs in (x, y, z) order, or None if there are no such
+    voxels. The array (z, y, x) is read one slab at a time, so it can be a
+    memory map
+    """
+    while array.ndim > 3 and array.shape[0] == 1:
+        array = array[0]
+    if array.ndim > 3:
+        raise ValueError('Only scalar images can be cropped')
+    array = array.reshape((1,) * (3 - array.ndim) + array.shape)
+    low, up = thresholds
+    insideZ = np.zeros(array.shape[0], dtype=bool)
+    insideY = np.zeros(array.shape[1], dtype=bool)
+    insideX = np.zeros(array.shape[2], dtype=bool)
+    for slab in iterSlabs(array.shape, array.itemsize, slabSize=slabSize):
+        data = array[slab]
+        inside = (data >= low) & (data <= up)
+        insideZ[slab] = inside.any(axis=(1, 2))
+        insideY |= inside.any(axis=(0, 2))
+        insideX |= inside.any(axis=(0, 1))
+    if not insideZ.any():
+        return None
+    box = []
+    for inside in insideX, insideY, insideZ:
+        indices = np.flatnonzero(inside)
+        box.append((int(indices[0]), int(indices[-1]) + 1))
+    return tuple(box)
+
+
+def getCropBox(image, thresholds, margin=0):
+    """
+    Bounding box of the voxels of a SimpleITK image within the thresholds,
+    extended by margin mm on each side and clipped to the image.
+    Returns None if no voxels are within the thresholds
+    """
+    box = getBoundingBox(sitk.GetArrayViewFromImage(image), thresholds)
+    if box is None:
+        return None
+    size = tuple(image.GetSize()) + (1,)
+    spacing = tuple(image.GetSpacing()) + (1,)
+    paddedBox = []
+    for (start, stop), n, s in zip(box, size, spacing):
+        padding = int(math.ceil(margin / s))
+        paddedBox.append((max(0, start - padding), min(n, stop + padding)))
+    return tuple(paddedBox)
+
+
+def prepareInput(path, thresholds, margin=0, croppedPath=None, maskPath=None):
+    """
+    Writes the image cropped to the voxels within the thresholds to
+    croppedPath and the mask of these voxels to maskPath, if given.
+    The mask is on the grid of the cropped image if there is one.
+    Without thresholds, or if no voxels are within them, the image is not
+    cropped and the mask includes all the voxels. Returns the crop box
+    """
+    image = sitk.ReadImage(str(path))
+    box = None
+    if croppedPath is not None:
+        if thresholds is not None:
+            box = getCropBox(image, thresholds, margin=margin)
+        if box is not None:
+            dimension = image.GetDimension()
+            index = [start for start, stop in box[:dimension]]
+            size = [stop - start for start, stop in box[:dimension]]
+            image = sitk.RegionOfInterest(image, size, index)
+        sitk.WriteImage(image, str(croppedPath))
+    if maskPath is not None:
+        if thresholds is None:
+            mask = sitk.Image(image.GetSize(), sitk.sitkUInt8) + 1
+            mask.CopyInformation(image)
+        else:
+            low, up = thresholds
+            mask = sitk.BinaryThreshold(image, low, up, 1, 0)
+        sitk.WriteImage(mask, str(maskPath))
+    return box
+
+
+def padControlPointGrid(gridPath, referencePath, outputPath, matrix=None):
+    """
+    Extends a reg_f3d control point grid so that it covers the whole
+    reference image. The control points are only optimized within the
+    cropped region, so the new ones are placed with the matrix, e.g. the
+    affine initialization of reg_f3d, or not moved if there is none
+    """
+    header = readNiftiHeader(gridPath)
+    nx, ny, nz, nt, numberOfComponents = (list(header.getDimensions()) + [1] * 5)[:5]
+    grid = readNiftiArray(gridPath, header=header, mmap=False)
+    grid = grid.reshape(numberOfComponents, nz, ny, nx)
+    gridAffine = header.getAffine()
+
+    # Reference corners in the index space of the grid
+    referenceHeader = readNiftiHeader(referencePath)
+    referenceSize = (list(referenceHeader.getDimensions()) + [1, 1])[:3]
+    corners = np.array([[i, j, k, 1]
+                        for i in (0, referenceSize[0] - 1)
+                        for j in (0, referenceSize[1] - 1)
+                        for k in (0, referenceSize[2] - 1)], dtype=np.float64).T
+    indices = np.linalg.inv(gridAffine).dot(referenceHeader.getAffine()).dot(corners)[:3]
+    # The cubic B-splines need one more control point on each side
+    start = np.minimum(np.floor(indices.min(axis=1)).astype(int) - 1, 0)
+    stop = np.maximum(np.ceil(indices.max(axis=1)).astype(int) + 2, [nx, ny, nz])
+    if nz == 1:
+        start[2], stop[2] = 0, 1
+
+    k, j, i = np.meshgrid(*[np.arange(a, b) for a, b in zip(start[::-1], stop[::-1])], indexing='ij')
+    positions = np.tensordot(gridAffine[:3, :3], np.stack([i, j, k]), axes=1)
+    positions += gridAffine[:3, 3].reshape(3, 1, 1, 1)
+    if matrix is not None:
+        positions = np.tensordot(matrix[:3, :3], positions, axes=1) + matrix[:3, 3].reshape(3, 1, 1, 1)
+    padded = positions[:numberOfComponents].astype(grid.dtype)
+    x0, y0, z0 = -start
+    padded[:, z0:z0 + nz, y0:y0 + ny, x0:x0 + nx] = grid
+
+    affine = gridAffine.copy()
+    affine[:, 3] = gridAffine.dot(list(start) + [1])
+    shape = (numberOfComponents, nt) + padded.shape[1:]
+    writeNiftiArray(outputPath, header, padded.reshape(shape), affine=affine)
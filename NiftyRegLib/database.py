@@ -0,0 +1,197 @@
+import json
+import shutil
+import sqlite3
+import datetime
+import contextlib
+import collections
+from pathlib import Path
+
+from .parameters import RegistrationParameters
+
+
+LINEAR_TYPES = 'Rigid', 'Affine'
+
+WarmStart = collections.namedtuple('WarmStart', ['runId',
+                                                 'transformationType',
+                                                 'initialTransformPath',
+                                                 'initialControlPointGridPath'])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    referencePath TEXT,
+    floatingPath TEXT,
+    referenceDigest TEXT,
+    floatingDigest TEXT,
+    transformationType TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    commandLine TEXT NOT NULL,
+    returnCode INTEGER,
+    elapsedTime REAL,
+    cached INTEGER NOT NULL,
+    resultPath TEXT,
+    transformPath TEXT,
+    storedTransformPath TEXT,
+    eventsPath TEXT,
+    logPath TEXT,
+    levels TEXT,
+    metrics TEXT
+);
+CREATE INDEX IF NOT EXISTS runsPair ON runs (referenceDigest, floatingDigest);
+CREATE INDEX IF NOT EXISTS runsTimestamp ON runs (timestamp);
+'''
+
+JSON_COLUMNS = 'parameters', 'commandLine', 'levels', 'metrics'
+
+
+class RunDatabase(object):
+    """
+    History of the registrations in an SQLite file. The transforms of the
+    successful runs are copied next to it, so that they can be used to
+    initialize later registrations of the same images even after the
+    temporary files have been removed
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.transformsDir = self.path.parent / (self.path.stem + '_transforms')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as connection:
+            connection.executescript(SCHEMA)
+
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        One connection per operation, so that the database can be used from
+        the threads of runBatch
+        """
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+    def record(self, registration, referenceDigest=None, floatingDigest=None):
+        """
+        Adds a run and returns its ID
+        """
+        row = collections.OrderedDict([
+            ('timestamp', datetime.datetime.now().isoformat()),
+            ('referencePath', registration.refPath),
+            ('floatingPath', registration.floPath),
+            ('referenceDigest', referenceDigest),
+            ('floatingDigest', floatingDigest),
+            ('transformationType', registration.parameters.transformationType),
+            ('parameters', json.dumps(registration.parameters.toDict())),
+            ('commandLine', json.dumps(registration.getCommandLineList())),
+            ('returnCode', registration.returnCode),
+            ('elapsedTime', registration.elapsedTime),
+            ('cached', int(registration.cached)),
+            ('resultPath', registration.resPath),
+            ('transformPath', registration.resultTransformPath),
+            ('eventsPath', registration.eventsPath),
+            ('logPath', registration.logPath),
+            ('levels', json.dumps(registration.levels)),
+            ('metrics', json.dumps(registration.metrics)),
+        ])
+        query = 'INSERT INTO runs ({}) VALUES ({})'.format(', '.join(row), ', '.join('?' * len(row)))
+        with self.connect() as connection:
+            runId = connection.execute(query, list(row.values())).lastrowid
+            if registration.succeeded() and Path(registration.resultTransformPath).is_file():
+                self.transformsDir.mkdir(parents=True, exist_ok=True)
+                suffix = ''.join(Path(registration.resultTransformPath).suffixes)
+                storedPath = self.transformsDir / '{}{}'.format(runId, suffix)
+                shutil.copyfile(registration.resultTransformPath, str(storedPath))
+                connection.execute('UPDATE runs SET storedTransformPath = ? WHERE id = ?',
+                                   (str(storedPath), runId))
+        return runId
+
+
+    def query(self, referenceDigest=None, floatingDigest=None, transformationType=None,
+              succeeded=None, limit=None):
+        """
+        Returns the matching runs as dictionaries, the most recent first
+        """
+        conditions, values = [], []
+        for column, value in (('referenceDigest', referenceDigest),
+                              ('floatingDigest', floatingDigest),
+                              ('transformationType', transformationType)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                values.append(value)
+        if succeeded is not None:
+            conditions.append('returnCode = 0' if succeeded else '(returnCode IS NULL OR returnCode != 0)')
+        query = 'SELECT * FROM runs'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY timestamp DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT {:d}'.format(limit)
+        with self.connect() as connection:
+            rows = connection.execute(query, values).fetchall()
+        return [self.getRunDict(row) for row in rows]
+
+
+    def getRunDict(self, row):
+        run = dict(row)
+        for column in JSON_COLUMNS:
+            if run[column] is not None:
+                run[column] = json.loads(run[column])
+        return run
+
+
+    def getWarmStart(self, referenceDigest, floatingDigest, parameters):
+        """
+        Returns the closest earlier result for the same images that can
+        initialize a registration with the given parameters, or None.
+        Results of the same transformation type come first, then the ones
+        whose parameters differ less, then the most recent ones.
+        Non-linear registrations can start from a control point grid (-incpp)
+        or from a matrix (-aff). Linear ones can only start from a matrix
+        """
+        targetType = parameters.transformationType
+        if targetType in LINEAR_TYPES:
+            candidateTypes = LINEAR_TYPES
+        else:
+            candidateTypes = ('Non-linear',) + LINEAR_TYPES
+        targetParameters = parameters.toDict()
+
+        def getScore(run):
+            runParameters = RegistrationParameters.fromDict(run['parameters']).toDict()
+            differences = sum(runParameters[key] != value for key, value in targetParameters.items())
+            return run['transformationType'] != targetType, differences
+
+        candidates = []
+        for run in self.query(referenceDigest, floatingDigest, succeeded=True):
+            path = run['storedTransformPath']
+            if run['transformationType'] in candidateTypes and path and Path(path).is_file():
+                candidates.append(run)
+        if not candidates:
+            return None
+        # The runs are sorted by date and sorted() is stable
+        run = sorted(candidates, key=getScore)[0]
+        path = run['storedTransformPath']
+        if run['transformationType'] == 'Non-linear':
+            return WarmStart(run['id'], run['transformationType'], None, path)
+        return WarmStart(run['id'], run['transformationType'], path, None)
+
+
+def getRunsTable(runs):
+    lines = ['{:>5}  {:<19}  {:<10}  {:>8}  {:>6}  {}'.format(
+        'ID', 'Date', 'Type', 'Time (s)', 'Return', 'Floating -> reference')]
+    for run in runs:
+        lines.append('{:>5}  {:<19}  {:<10}  {:>8.1f}  {:>6}  {} -> {}'.format(
+            run['id'],
+            run['timestamp'][:19],
+            run['transformationType'],
+            run['elapsedTime'] or 0,
+            str(run['returnCode']),
+            Path(run['floatingPath']).name,
+            Path(run['referencePath']).name))
+    return '\n'.join(lines)
+
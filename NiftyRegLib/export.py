@@ -0,0 +1,82 @@
+"""
+Conversion of the NiftyReg inputs to narrower data types. NiftyReg converts
+the images to float32 when it reads them, so wider data types only make the
+temporary files larger and slower to write and read. Images are written as
+int16 if it represents all their values exactly, and as float32 otherwise.
+The arrays are checked and cast one slab at a time, so they can be memory
+maps or views of the scene data and no full-size copy is made
+"""
+
+import numpy as np
+
+from .nifti import readNiftiHeader, readNiftiArray, writeNiftiArray, makeNiftiHeader
+from .metrics import SLAB_SIZE, iterSlabs
+
+
+MAXIMUM_ITEM_SIZE = 4  # float32
+INT16_RANGE = np.iinfo(np.int16).min, np.iinfo(np.int16).max
+
+
+def isLosslessInt16(array, slabSize=SLAB_SIZE):
+    """
+    True if all the values of the array are integers in the int16 range
+    """
+    if array.dtype.kind in 'ui':
+        info = np.iinfo(array.dtype)
+        if INT16_RANGE[0] <= info.min and info.max <= INT16_RANGE[1]:
+            return True
+    elif array.dtype.kind != 'f':
+        return False
+    low, up = INT16_RANGE
+    for slab in iterSlabs(array.shape, array.itemsize, slabSize=slabSize):
+        data = array[slab]
+        # NaN fails all the comparisons
+        if not ((data >= low) & (data <= up)).all():
+            return False
+        if data.dtype.kind == 'f' and not (np.floor(data) == data).all():
+            return False
+    return True
+
+
+def getExportDataType(array, slabSize=SLAB_SIZE):
+    """
+    Data type of the NiftyReg input for the array. Data types of up to four
+    bytes are kept, wider ones become int16 if lossless and float32 otherwise
+    """
+    if array.dtype.itemsize <= MAXIMUM_ITEM_SIZE or array.dtype.kind not in 'uif':
+        return array.dtype.newbyteorder('=')
+    if isLosslessInt16(array, slabSize=slabSize):
+        return np.dtype(np.int16)
+    return np.dtype(np.float32)
+
+
+def needsExport(dataType):
+    """
+    True if images of this data type are cast before running NiftyReg
+    """
+    return np.dtype(dataType).itemsize > MAXIMUM_ITEM_SIZE
+
+
+def writeExportImage(path, array, affine=None, header=None):
+    """
+    Writes the array (z, y, x) with the data type given by getExportDataType.
+    The geometry is taken from the NIfTI-1 header if given, and otherwise from
+    the voxel to RAS affine, which must not have shear. Returns the data type
+    """
+    if header is None:
+        header = makeNiftiHeader(affine)
+    dtype = getExportDataType(array)
+    writeNiftiArray(path, header, array, dtype=dtype)
+    return dtype
+
+
+def exportNiftiFile(path, outputPath):
+    """
+    Writes a copy of a NIfTI image for NiftyReg (see writeExportImage).
+    Returns the data type of the copy
+    """
+    header = readNiftiHeader(path)
+    array = readNiftiArray(path, header=header)
+    if header.getVersion() != 1:
+        header = makeNiftiHeader(header.getAffine())
+    return writeExportImage(outputPath, array, header=header)
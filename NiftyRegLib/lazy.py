@@ -0,0 +1,23 @@
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported when one of its attributes
+    is used, e.g. np = LazyModule('numpy')
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+    def __repr__(self):
+        state = 'not imported' if self.module is None else 'imported'
+        return '<lazy module {!r} ({})>'.format(self.name, state)
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+ROW_FORMAT = '{:13.8f}' * 4
+
+
+def readNiftyRegMatrix(trsfPath):
+    with open(trsfPath) as f:
+        rows = [line.split() for line in f if line.strip()]
+    return np.array(rows, dtype=np.float64)
+
+
+def readNiftyRegMatrices(trsfPaths):
+    """
+    Returns an (N, 4, 4) array with the matrices in the files
+    """
+    tokens = []
+    for trsfPath in trsfPaths:
+        with open(trsfPath) as f:
+            tokens.extend(f.read().split())
+    return np.array(tokens, dtype=np.float64).reshape(-1, 4, 4)
+
+
+def getNiftyRegMatrixString(matrix):
+    return '\n'.join(ROW_FORMAT.format(*row) for row in np.asarray(matrix).tolist())
+
+
+def writeNiftyRegMatrix(matrix, trsfPath):
+    with open(trsfPath, 'w') as f:
+        f.write(getNiftyRegMatrixString(matrix))
+
+
+def writeNiftyRegMatrices(matrices, trsfPaths):
+    matrices = np.asarray(matrices).reshape(-1, 4, 4)
+    trsfPaths = list(trsfPaths)
+    if len(trsfPaths) != len(matrices):
+        raise ValueError('{} matrices but {} paths'.format(len(matrices), len(trsfPaths)))
+    for matrix, trsfPath in zip(matrices, trsfPaths):
+        writeNiftyRegMatrix(matrix, trsfPath)
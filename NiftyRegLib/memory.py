@@ -0,0 +1,144 @@
+"""
+Estimation of the peak memory of a registration, so that runs that would
+exhaust the memory of the machine can be adapted or refused before they
+start instead of failing after a long time.
+The model counts the images that NiftyReg keeps: the inputs, the pyramid
+levels that are performed (as float32, with their masks), the working
+arrays of the finest level and the control point grids of reg_f3d. After
+NiftyReg finishes, the module loads the result and converts the control
+point grid (see NiftyRegLogic.vectorfieldToDisplacementField)
+"""
+
+import math
+import collections
+
+from .nifti import CHUNK_SIZE
+from .tuning import getPyramidShapesMap, getNumberOfVoxels
+
+
+FLOAT_SIZE = 4
+MASK_SIZE = 4  # NiftyReg masks are int
+OVERHEAD = 64 * 2**20  # binary, libraries and small buffers
+
+# Arrays allocated by NiftyReg on the grid of the level being registered,
+# in bytes per voxel. reg_aladin is symmetric by default, so they are
+# allocated for both images
+WORKING_BYTES = {
+    # Warped image, deformation field and block matching results
+    'linear': FLOAT_SIZE * (1 + 3 + 2),
+    # Warped image, deformation field, warped gradient and voxel-based gradient
+    'non-linear': FLOAT_SIZE * (1 + 3 + 3 + 3),
+}
+# Full resolution warped image and deformation field, computed at the end
+FINAL_BYTES = FLOAT_SIZE * (1 + 3)
+# Control point grids used by the optimizer of reg_f3d (positions, best
+# positions, gradient and conjugate gradients)
+CONTROL_POINT_GRIDS = 6
+DEFAULT_SPACING = 5  # voxels
+
+MemoryEstimate = collections.namedtuple('MemoryEstimate', ['niftyReg', 'module', 'peak'])
+
+
+def getLevelShape(shapesMap, level):
+    """
+    NiftyReg does not downsample images below the minimum level size, so the
+    levels beyond the last one have its shape
+    """
+    return shapesMap[min(level, max(shapesMap))]
+
+
+def getNumberOfControlPoints(shape, spacing=None, voxelSpacing=None):
+    """
+    Control points of reg_f3d for a reference of this shape (x, y, z).
+    Negative spacings are in voxels, as in NiftyReg
+    """
+    if spacing is None:
+        spacing = -DEFAULT_SPACING
+    if voxelSpacing is None:
+        voxelSpacing = (1,) * len(shape)
+    numberOfPoints = 1
+    for n, s in zip(shape, voxelSpacing):
+        spacingVoxels = -spacing if spacing < 0 else spacing / float(s)
+        numberOfPoints *= int(math.ceil(n / spacingVoxels)) + 3
+    return numberOfPoints
+
+
+def estimateMemory(parameters, referenceShape, floatingShape,
+                   referenceItemSize=FLOAT_SIZE, floatingItemSize=FLOAT_SIZE,
+                   referenceSpacing=None):
+    """
+    Returns the estimated peak memory in bytes of NiftyReg, of the module
+    once NiftyReg has finished, and the largest of both. The shapes are in
+    (x, y, z) order and the item sizes are the bytes per voxel of the inputs
+    """
+    kind = 'linear' if parameters.isLinear() else 'non-linear'
+    referenceMap = getPyramidShapesMap(referenceShape)
+    floatingMap = getPyramidShapesMap(floatingShape)
+    numberOfLevels, levelsToPerform = parameters.pyramidLevels or (3, 3)
+    levelsToPerform = max(1, min(levelsToPerform, numberOfLevels))
+    performedLevels = range(numberOfLevels - levelsToPerform, numberOfLevels)
+
+    referenceVoxels = getNumberOfVoxels(referenceShape)
+    floatingVoxels = getNumberOfVoxels(floatingShape)
+    inputs = referenceVoxels * referenceItemSize + floatingVoxels * floatingItemSize
+
+    pyramid = 0
+    for level in performedLevels:
+        levelVoxels = (getNumberOfVoxels(getLevelShape(referenceMap, level))
+                       + getNumberOfVoxels(getLevelShape(floatingMap, level)))
+        pyramid += levelVoxels * (FLOAT_SIZE + MASK_SIZE)
+
+    finestLevel = performedLevels[0]
+    workingVoxels = getNumberOfVoxels(getLevelShape(referenceMap, finestLevel))
+    if parameters.isLinear():
+        workingVoxels += getNumberOfVoxels(getLevelShape(floatingMap, finestLevel))
+    working = max(workingVoxels * WORKING_BYTES[kind], referenceVoxels * FINAL_BYTES)
+
+    controlPoints = 0
+    if not parameters.isLinear():
+        numberOfPoints = getNumberOfControlPoints(referenceShape,
+                                                  spacing=parameters.controlPointSpacing,
+                                                  voxelSpacing=referenceSpacing)
+        controlPoints = numberOfPoints * 3 * FLOAT_SIZE
+
+    niftyReg = inputs + pyramid + working + CONTROL_POINT_GRIDS * controlPoints + OVERHEAD
+
+    # The result is read by SimpleITK and copied into the scene. The control
+    # point grid is read in chunks into the VTK array of the transform
+    module = 2 * referenceVoxels * FLOAT_SIZE
+    if not parameters.isLinear():
+        module += controlPoints + CHUNK_SIZE
+    return MemoryEstimate(niftyReg, module, max(niftyReg, module))
+
+
+def fitMemoryBudget(parameters, referenceShape, floatingShape, budget, **kwargs):
+    """
+    Returns the parameters, with the finest pyramid levels skipped if needed,
+    so that the estimated peak memory is within the budget, and the
+    estimate. The keyword arguments are passed to estimateMemory.
+    Raises ValueError if the registration does not fit even at the coarsest
+    level
+    """
+    estimate = estimateMemory(parameters, referenceShape, floatingShape, **kwargs)
+    if budget is None or estimate.peak <= budget:
+        return parameters, estimate
+    numberOfLevels, levelsToPerform = parameters.pyramidLevels or (3, 3)
+    while levelsToPerform > 1:
+        levelsToPerform -= 1
+        fitted = parameters.copy(pyramidLevels=(numberOfLevels, levelsToPerform))
+        estimate = estimateMemory(fitted, referenceShape, floatingShape, **kwargs)
+        if estimate.peak <= budget:
+            return fitted, estimate
+    message = 'The registration needs about {} but only {} are available'.format(
+        formatBytes(estimate.peak), formatBytes(budget))
+    raise ValueError(message)
+
+
+def formatBytes(numberOfBytes):
+    for units in 'bytes', 'KiB', 'MiB', 'GiB':
+        if abs(numberOfBytes) < 1024:
+            break
+        numberOfBytes /= 1024.
+    else:
+        units = 'TiB'
+    return '{:.1f} {}'.format(numberOfBytes, units)
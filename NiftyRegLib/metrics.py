@@ -0,0 +1,211 @@
+import numpy as np
+import SimpleITK as sitk
+
+from .nifti import hasNiftiExtension, readNiftiArray
+from .statistics import getRange
+from .vectorfield import ReferenceDisplacementField
+
+
+SLAB_SIZE = 2**24  # bytes of the input per slab
+NUMBER_OF_BINS = 64
+
+
+def iterSlabs(shape, itemsize, slabSize=SLAB_SIZE):
+    """
+    Yields slices along the first axis with about slabSize bytes each
+    """
+    bytesPerSlice = itemsize * int(np.prod(shape[1:], dtype=np.int64))
+    step = max(1, slabSize // max(1, bytesPerSlice))
+    for start in range(0, shape[0], step):
+        yield slice(start, min(start + step, shape[0]))
+
+
+def getEntropy(histogram):
+    p = histogram[histogram > 0] / float(histogram.sum())
+    return -np.sum(p * np.log(p))
+
+
+def computeSimilarityMetrics(referenceArray, resultArray, referenceThresholds=None,
+                             numberOfBins=NUMBER_OF_BINS, slabSize=SLAB_SIZE):
+    """
+    Normalized cross correlation, normalized mutual information
+    ((H(R) + H(F)) / H(R, F), as in NiftyReg) and mean squared difference
+    between the reference and the resampled floating image, in the voxels
+    of the reference that are within its thresholds.
+    The arrays can be memory maps, as they are read one slab at a time
+    """
+    if referenceArray.shape != resultArray.shape:
+        raise ValueError('The result must be on the reference grid: {} != {}'.format(
+            resultArray.shape, referenceArray.shape))
+
+    if referenceThresholds is None:
+        referenceRange = getRange(referenceArray)
+    else:
+        referenceRange = referenceThresholds
+    resultRange = getRange(resultArray)
+    histogramRange = [[float(r) for r in referenceRange], [float(r) for r in resultRange]]
+    for r in histogramRange:
+        if r[1] <= r[0]:
+            r[1] = r[0] + 1
+
+    n = 0
+    sums = np.zeros(5)  # x, y, xx, yy, xy
+    squaredDifferences = 0.
+    jointHistogram = np.zeros((numberOfBins, numberOfBins))
+    itemsize = max(referenceArray.itemsize, resultArray.itemsize)
+    for slab in iterSlabs(referenceArray.shape, itemsize, slabSize=slabSize):
+        x = np.asarray(referenceArray[slab], dtype=np.float64).ravel()
+        y = np.asarray(resultArray[slab], dtype=np.float64).ravel()
+        if referenceThresholds is not None:
+            low, up = referenceThresholds
+            mask = (x >= low) & (x <= up)
+            x, y = x[mask], y[mask]
+        if not x.size:
+            continue
+        n += x.size
+        sums += x.sum(), y.sum(), np.dot(x, x), np.dot(y, y), np.dot(x, y)
+        difference = x - y
+        squaredDifferences += np.dot(difference, difference)
+        jointHistogram += np.histogram2d(x, y, bins=numberOfBins, range=histogramRange)[0]
+
+    if n == 0:
+        raise ValueError('No reference voxels within the thresholds')
+    meanX, meanY = sums[0] / n, sums[1] / n
+    covariance = sums[4] / n - meanX * meanY
+    varianceX = sums[2] / n - meanX ** 2
+    varianceY = sums[3] / n - meanY ** 2
+    denominator = np.sqrt(max(varianceX, 0) * max(varianceY, 0))
+    ncc = covariance / denominator if denominator > 0 else 0.
+
+    jointEntropy = getEntropy(jointHistogram)
+    marginalEntropies = getEntropy(jointHistogram.sum(axis=1)) + getEntropy(jointHistogram.sum(axis=0))
+    nmi = marginalEntropies / jointEntropy if jointEntropy > 0 else 1.
+
+    return {
+        'numberOfVoxels': int(n),
+        'ncc': float(ncc),
+        'nmi': float(nmi),
+        'msd': float(squaredDifferences / n),
+    }
+
+
+def getIndexGradient(field, axis):
+    """
+    Central differences along an axis of a (z, y, x, 3) field, or zero if
+    the axis has a single sample (2D images)
+    """
+    if field.shape[axis] < 2:
+        return np.zeros(field.shape)
+    return np.gradient(field, axis=axis)
+
+
+def computeJacobianStatistics(displacement, spacing, direction, referenceArray=None, referenceThresholds=None,
+                              slabSize=SLAB_SIZE):
+    """
+    Statistics of the determinant of the Jacobian of x -> x + u(x), where u
+    is a (z, y, x, 3) displacement field in world coordinates on a grid with
+    the given spacing (x, y, z) and direction (3 x 3, axes as columns).
+    If the reference array and thresholds are given, only the voxels of the
+    reference within the thresholds are included, as in
+    computeSimilarityMetrics.
+    Each slab is read with one extra slice on each side so that the central
+    differences are the same as for the whole field. The displacement can
+    be any array that can be sliced along the first axis, such as a
+    ReferenceDisplacementField
+    """
+    indexToWorld = np.asarray(direction, dtype=np.float64).reshape(3, 3) * np.asarray(spacing, dtype=np.float64)
+    worldToIndex = np.linalg.inv(indexToWorld)
+    shape = displacement.shape[:3]
+    if referenceThresholds is not None:
+        referenceArray = referenceArray.reshape(shape)
+
+    n = 0
+    total = totalSquared = 0.
+    minimum, maximum = np.inf, -np.inf
+    numberOfFolds = 0
+    bytesPerVoxel = 3 * 8 * 4  # displacement and the three gradients
+    for slab in iterSlabs(shape, bytesPerVoxel, slabSize=slabSize):
+        start = max(0, slab.start - 1)
+        stop = min(shape[0], slab.stop + 1)
+        field = np.asarray(displacement[start:stop], dtype=np.float64)
+        # gradients[..., component, axis] with the axes in (x, y, z) order
+        gradients = np.stack([getIndexGradient(field, axis) for axis in (2, 1, 0)], axis=-1)
+        gradients = gradients[slab.start - start:slab.stop - start]
+        jacobians = np.matmul(gradients, worldToIndex)
+        jacobians += np.identity(3)
+        determinants = np.linalg.det(jacobians.reshape(-1, 3, 3))
+        if referenceThresholds is not None:
+            low, up = referenceThresholds
+            x = np.asarray(referenceArray[slab]).ravel()
+            determinants = determinants[(x >= low) & (x <= up)]
+            if not determinants.size:
+                continue
+        n += determinants.size
+        total += determinants.sum()
+        totalSquared += np.dot(determinants, determinants)
+        minimum = min(minimum, determinants.min())
+        maximum = max(maximum, determinants.max())
+        numberOfFolds += int(np.count_nonzero(determinants <= 0))
+
+    if n == 0:
+        raise ValueError('No reference voxels within the thresholds')
+    mean = total / n
+    return {
+        'jacobianMin': float(minimum),
+        'jacobianMax': float(maximum),
+        'jacobianMean': float(mean),
+        'jacobianStd': float(np.sqrt(max(totalSquared / n - mean ** 2, 0))),
+        'jacobianFoldingFraction': numberOfFolds / float(n),
+    }
+
+
+def computeDisplacementFieldJacobianStatistics(displacementImage, slabSize=SLAB_SIZE):
+    """
+    Same as computeJacobianStatistics, for a SimpleITK displacement field
+    """
+    if displacementImage.GetDimension() == 2:
+        raise ValueError('Use a 3D displacement field')
+    displacement = sitk.GetArrayViewFromImage(displacementImage)
+    return computeJacobianStatistics(displacement,
+                                     displacementImage.GetSpacing(),
+                                     displacementImage.GetDirection(),
+                                     slabSize=slabSize)
+
+
+def readImageArray(path):
+    """
+    NIfTI files are memory-mapped if possible, other formats are read with
+    SimpleITK
+    """
+    path = str(path)
+    if hasNiftiExtension(path):
+        return readNiftiArray(path)
+    return sitk.GetArrayViewFromImage(sitk.ReadImage(path))
+
+
+def computeRegistrationMetrics(referencePath, resultPath=None, transformPath=None,
+                               referenceThresholds=None, resultArray=None):
+    """
+    Similarity metrics if there is a result image (or array) and Jacobian
+    statistics if there is a non-linear transform, both in the voxels of the
+    reference within its thresholds. The displacement field of the transform
+    is computed one slab at a time
+    """
+    metrics = {}
+    referenceArray = None
+    if referenceThresholds is not None or resultPath is not None or resultArray is not None:
+        referenceArray = readImageArray(referencePath)
+    if resultPath is not None or resultArray is not None:
+        if resultArray is None:
+            resultArray = readImageArray(resultPath)
+        metrics.update(computeSimilarityMetrics(referenceArray,
+                                                resultArray.reshape(referenceArray.shape),
+                                                referenceThresholds=referenceThresholds))
+    if transformPath is not None:
+        displacement = ReferenceDisplacementField(transformPath, referencePath)
+        metrics.update(computeJacobianStatistics(displacement,
+                                                 displacement.spacing,
+                                                 displacement.direction,
+                                                 referenceArray=referenceArray,
+                                                 referenceThresholds=referenceThresholds))
+    return metrics
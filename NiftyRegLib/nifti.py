@@ -0,0 +1,466 @@
+import os
+import gzip
+from pathlib import Path
+
+import numpy as np
+
+
+NIFTI_EXTENSIONS = '.nii.gz', '.img.gz', '.nii', '.hdr', '.img'
+
+NIFTI1_HEADER_DTYPE = np.dtype([
+    ('sizeof_hdr', 'i4'),
+    ('data_type', 'S10'),
+    ('db_name', 'S18'),
+    ('extents', 'i4'),
+    ('session_error', 'i2'),
+    ('regular', 'S1'),
+    ('dim_info', 'u1'),
+    ('dim', 'i2', (8,)),
+    ('intent_p1', 'f4'),
+    ('intent_p2', 'f4'),
+    ('intent_p3', 'f4'),
+    ('intent_code', 'i2'),
+    ('datatype', 'i2'),
+    ('bitpix', 'i2'),
+    ('slice_start', 'i2'),
+    ('pixdim', 'f4', (8,)),
+    ('vox_offset', 'f4'),
+    ('scl_slope', 'f4'),
+    ('scl_inter', 'f4'),
+    ('slice_end', 'i2'),
+    ('slice_code', 'u1'),
+    ('xyzt_units', 'u1'),
+    ('cal_max', 'f4'),
+    ('cal_min', 'f4'),
+    ('slice_duration', 'f4'),
+    ('toffset', 'f4'),
+    ('glmax', 'i4'),
+    ('glmin', 'i4'),
+    ('descrip', 'S80'),
+    ('aux_file', 'S24'),
+    ('qform_code', 'i2'),
+    ('sform_code', 'i2'),
+    ('quatern_b', 'f4'),
+    ('quatern_c', 'f4'),
+    ('quatern_d', 'f4'),
+    ('qoffset_x', 'f4'),
+    ('qoffset_y', 'f4'),
+    ('qoffset_z', 'f4'),
+    ('srow_x', 'f4', (4,)),
+    ('srow_y', 'f4', (4,)),
+    ('srow_z', 'f4', (4,)),
+    ('intent_name', 'S16'),
+    ('magic', 'S4'),
+])
+
+NIFTI2_HEADER_DTYPE = np.dtype([
+    ('sizeof_hdr', 'i4'),
+    ('magic', 'S8'),
+    ('datatype', 'i2'),
+    ('bitpix', 'i2'),
+    ('dim', 'i8', (8,)),
+    ('intent_p1', 'f8'),
+    ('intent_p2', 'f8'),
+    ('intent_p3', 'f8'),
+    ('pixdim', 'f8', (8,)),
+    ('vox_offset', 'i8'),
+    ('scl_slope', 'f8'),
+    ('scl_inter', 'f8'),
+    ('cal_max', 'f8'),
+    ('cal_min', 'f8'),
+    ('slice_duration', 'f8'),
+    ('toffset', 'f8'),
+    ('slice_start', 'i8'),
+    ('slice_end', 'i8'),
+    ('descrip', 'S80'),
+    ('aux_file', 'S24'),
+    ('qform_code', 'i4'),
+    ('sform_code', 'i4'),
+    ('quatern_b', 'f8'),
+    ('quatern_c', 'f8'),
+    ('quatern_d', 'f8'),
+    ('qoffset_x', 'f8'),
+    ('qoffset_y', 'f8'),
+    ('qoffset_z', 'f8'),
+    ('srow_x', 'f8', (4,)),
+    ('srow_y', 'f8', (4,)),
+    ('srow_z', 'f8', (4,)),
+    ('slice_code', 'i4'),
+    ('xyzt_units', 'i4'),
+    ('intent_code', 'i4'),
+    ('intent_name', 'S16'),
+    ('dim_info', 'u1'),
+    ('unused_str', 'S15'),
+])
+
+HEADER_DTYPES = {
+    NIFTI1_HEADER_DTYPE.itemsize: NIFTI1_HEADER_DTYPE,
+    NIFTI2_HEADER_DTYPE.itemsize: NIFTI2_HEADER_DTYPE,
+}
+
+CHUNK_SIZE = 2**24  # bytes
+
+DATA_TYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+
+
+def hasNiftiExtension(path):
+    for ext in NIFTI_EXTENSIONS:
+        if path.endswith(ext):
+            return True
+    return False
+
+
+def getNiftiStem(path):
+    name = Path(path).name
+    for ext in NIFTI_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return Path(path).stem
+
+
+def isCompressed(path):
+    return str(path).endswith('.gz')
+
+
+def openNifti(path):
+    return gzip.open(str(path), 'rb') if isCompressed(path) else open(str(path), 'rb')
+
+
+def getImagePath(headerPath):
+    """
+    Analyze-style pairs store the voxels in a separate .img file
+    """
+    headerPath = str(headerPath)
+    for headerExt, imageExt in ('.hdr', '.img'), ('.hdr.gz', '.img.gz'):
+        if headerPath.endswith(headerExt):
+            return headerPath[:-len(headerExt)] + imageExt
+    return headerPath
+
+
+class NiftiHeader(object):
+    """
+    Fields of a NIfTI-1 or NIfTI-2 header. Both versions use the same field
+    names, so the rest of the code does not need to know which one it is
+    """
+
+    def __init__(self, fields, path=None):
+        self.fields = fields
+        self.path = None if path is None else str(path)
+
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+
+    @classmethod
+    def read(cls, path):
+        with openNifti(path) as f:
+            sizeBytes = f.read(4)
+            if len(sizeBytes) < 4:
+                raise ValueError('File too small to be NIfTI: {}'.format(path))
+            for byteOrder in '<', '>':
+                size = int(np.frombuffer(sizeBytes, dtype=byteOrder + 'i4')[0])
+                if size in HEADER_DTYPES:
+                    break
+            else:
+                raise ValueError('Not a NIfTI file: {}'.format(path))
+            data = sizeBytes + f.read(size - 4)
+        if len(data) < size:
+            raise ValueError('Truncated NIfTI header: {}'.format(path))
+        headerDtype = HEADER_DTYPES[size].newbyteorder(byteOrder)
+        fields = np.frombuffer(data, dtype=headerDtype)[0]
+        return cls(fields, path)
+
+
+    def getVersion(self):
+        return 1 if self.fields['sizeof_hdr'] == NIFTI1_HEADER_DTYPE.itemsize else 2
+
+
+    def getByteOrder(self):
+        byteOrder = self.fields.dtype['sizeof_hdr'].byteorder
+        return '<' if byteOrder == '=' and np.little_endian else byteOrder
+
+
+    def getDimensions(self):
+        """
+        Size of each dimension, from x to the last one used
+        """
+        dim = self.fields['dim']
+        numberOfDimensions = int(dim[0])
+        return tuple(int(n) for n in dim[1:numberOfDimensions + 1])
+
+
+    def getDataType(self):
+        return int(self.fields['datatype'])
+
+
+    def getNumpyDataType(self):
+        dataType = self.getDataType()
+        if dataType not in DATA_TYPES:
+            raise ValueError('NIfTI data type not supported: {}'.format(dataType))
+        return np.dtype(DATA_TYPES[dataType]).newbyteorder(self.getByteOrder())
+
+
+    def getDataOffset(self):
+        if getImagePath(self.path) != self.path:
+            return 0
+        return int(self.fields['vox_offset'])
+
+
+    def getScaling(self):
+        slope = float(self.fields['scl_slope'])
+        intercept = float(self.fields['scl_inter'])
+        if slope in (0, 1) and intercept == 0:
+            return None
+        return (1 if slope == 0 else slope), intercept
+
+
+    def getIntentName(self):
+        return self.fields['intent_name'].split(b'\0')[0].decode(errors='replace')
+
+
+    def getQFormCode(self):
+        return int(self.fields['qform_code'])
+
+
+    def getSFormCode(self):
+        return int(self.fields['sform_code'])
+
+
+    def getAffine(self):
+        """
+        Voxel to RAS matrix, using the sform if set and the qform otherwise
+        """
+        pixdim = self.fields['pixdim'].astype(np.float64)
+        affine = np.identity(4)
+        if self.getSFormCode() > 0:
+            affine[0] = self.fields['srow_x']
+            affine[1] = self.fields['srow_y']
+            affine[2] = self.fields['srow_z']
+        elif self.getQFormCode() > 0:
+            b, c, d = [float(self.fields[k]) for k in ('quatern_b', 'quatern_c', 'quatern_d')]
+            a = np.sqrt(max(0, 1 - (b * b + c * c + d * d)))
+            rotation = np.array([
+                [a*a + b*b - c*c - d*d, 2*(b*c - a*d), 2*(b*d + a*c)],
+                [2*(b*c + a*d), a*a + c*c - b*b - d*d, 2*(c*d - a*b)],
+                [2*(b*d - a*c), 2*(c*d + a*b), a*a + d*d - c*c - b*b],
+            ])
+            qfac = -1 if pixdim[0] < 0 else 1
+            scales = pixdim[1:4] * [1, 1, qfac]
+            affine[:3, :3] = rotation * scales
+            affine[:3, 3] = [self.fields[k] for k in ('qoffset_x', 'qoffset_y', 'qoffset_z')]
+        else:
+            affine[:3, :3] = np.diag(pixdim[1:4])
+        return affine
+
+
+def readNiftiHeader(path):
+    return NiftiHeader.read(path)
+
+
+_headerCache = {}  # path -> (modification time, size, header)
+
+
+def getCachedNiftiHeader(path):
+    """
+    Like readNiftiHeader, but the header is only read again if the file has
+    been modified since the last call
+    """
+    path = str(path)
+    stat = os.stat(path)
+    cached = _headerCache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    header = readNiftiHeader(path)
+    _headerCache[path] = stat.st_mtime_ns, stat.st_size, header
+    return header
+
+
+def clearNiftiHeaderCache():
+    _headerCache.clear()
+
+
+def getNumberOfVoxels(header):
+    return int(np.prod(header.getDimensions(), dtype=np.int64))
+
+
+def readNiftiArray(path, header=None, mmap=True):
+    """
+    Returns the voxels in C order, i.e. the shape is the reversed NIfTI
+    dimensions: (..., z, y, x).
+    Uncompressed files are memory-mapped, so the returned array is a
+    read-only view of the file that does not use memory until it is read.
+    Compressed files are decompressed into a single array
+    """
+    if header is None:
+        header = readNiftiHeader(path)
+    dtype = header.getNumpyDataType()
+    shape = header.getDimensions()[::-1]
+    imagePath = getImagePath(path)
+    if mmap and not isCompressed(imagePath):
+        array = np.memmap(imagePath, dtype=dtype, mode='r', offset=header.getDataOffset(), shape=shape)
+    else:
+        array = np.empty(shape, dtype=dtype)
+        with openNifti(imagePath) as f:
+            f.seek(header.getDataOffset())
+            readInto(f, array.reshape(-1).view(np.uint8))
+    scaling = header.getScaling()
+    if scaling is not None:
+        slope, intercept = scaling
+        array = array * slope + intercept
+    return array
+
+
+def getQuaternion(rotation):
+    """
+    Parameters (b, c, d) of the NIfTI quaternion of a proper rotation matrix
+    """
+    (r11, r12, r13), (r21, r22, r23), (r31, r32, r33) = rotation
+    a = r11 + r22 + r33 + 1
+    if a > 0.5:
+        a = 0.5 * np.sqrt(a)
+        b = 0.25 * (r32 - r23) / a
+        c = 0.25 * (r13 - r31) / a
+        d = 0.25 * (r21 - r12) / a
+    else:
+        xd = 1 + r11 - (r22 + r33)
+        yd = 1 + r22 - (r11 + r33)
+        zd = 1 + r33 - (r11 + r22)
+        if xd > 1:
+            b = 0.5 * np.sqrt(xd)
+            c = 0.25 * (r12 + r21) / b
+            d = 0.25 * (r13 + r31) / b
+            a = 0.25 * (r32 - r23) / b
+        elif yd > 1:
+            c = 0.5 * np.sqrt(yd)
+            b = 0.25 * (r12 + r21) / c
+            d = 0.25 * (r23 + r32) / c
+            a = 0.25 * (r13 - r31) / c
+        else:
+            d = 0.5 * np.sqrt(zd)
+            b = 0.25 * (r13 + r31) / d
+            c = 0.25 * (r23 + r32) / d
+            a = 0.25 * (r21 - r12) / d
+        if a < 0:
+            b, c, d = -b, -c, -d
+    return b, c, d
+
+
+def makeNiftiHeader(affine):
+    """
+    NIfTI-1 header whose qform and sform are the voxel to RAS affine, which
+    must not have shear. The dimensions and the data type are set by
+    writeNiftiArray
+    """
+    fields = np.zeros(1, NIFTI1_HEADER_DTYPE)[0]
+    fields['sizeof_hdr'] = NIFTI1_HEADER_DTYPE.itemsize
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    rotation = affine[:3, :3] / spacing
+    qfac = 1
+    if np.linalg.det(rotation) < 0:
+        qfac = -1
+        rotation[:, 2] *= -1
+    fields['pixdim'][:4] = [qfac] + list(spacing)
+    fields['quatern_b'], fields['quatern_c'], fields['quatern_d'] = getQuaternion(rotation)
+    for row, key in enumerate(('qoffset_x', 'qoffset_y', 'qoffset_z')):
+        fields[key] = affine[row, 3]
+    for row, key in enumerate(('srow_x', 'srow_y', 'srow_z')):
+        fields[key] = affine[row]
+    fields['qform_code'] = 1  # NIFTI_XFORM_SCANNER_ANAT
+    fields['sform_code'] = 1
+    fields['xyzt_units'] = 2 | 8  # mm and s
+    fields['magic'] = b'n+1'
+    return NiftiHeader(fields)
+
+
+def writeNiftiArray(path, header, array, affine=None, dtype=None, chunkSize=CHUNK_SIZE):
+    """
+    Writes a single-file NIfTI-1 image with the fields of the given header,
+    updated for the shape and data type of the array, which is in C order
+    as returned by readNiftiArray. If an affine is given, it replaces the
+    sform and the qform offset, so it must have the rotation of the qform.
+    If a dtype is given, the array is cast to it. The array is written in
+    slabs of about chunkSize bytes, so it can be a memory map or a view and
+    no full-size copy is made
+    """
+    if header.getVersion() != 1:
+        raise ValueError('Only NIfTI-1 headers can be written: {}'.format(header.path))
+    dataTypes = {np.dtype(numpyType): code for code, numpyType in DATA_TYPES.items()}
+    dtype = np.dtype(array.dtype if dtype is None else dtype).newbyteorder('=')
+    if dtype not in dataTypes:
+        raise ValueError('NIfTI data type not supported: {}'.format(array.dtype))
+    fields = np.array([header.fields])[0]
+    fields['dim'] = 1
+    fields['dim'][0] = array.ndim
+    fields['dim'][1:array.ndim + 1] = array.shape[::-1]
+    fields['datatype'] = dataTypes[dtype]
+    fields['bitpix'] = 8 * dtype.itemsize
+    fields['vox_offset'] = NIFTI1_HEADER_DTYPE.itemsize + 4
+    fields['scl_slope'] = 0
+    fields['scl_inter'] = 0
+    fields['magic'] = b'n+1'
+    if affine is not None:
+        for row, key in enumerate(('srow_x', 'srow_y', 'srow_z')):
+            fields[key] = affine[row]
+        for row, key in enumerate(('qoffset_x', 'qoffset_y', 'qoffset_z')):
+            fields[key] = affine[row, 3]
+    fileDtype = dtype.newbyteorder(header.getByteOrder())
+    array = array.reshape((1,) * (1 - array.ndim) + array.shape)
+    bytesPerSlice = dtype.itemsize * int(np.prod(array.shape[1:], dtype=np.int64))
+    step = max(1, chunkSize // max(1, bytesPerSlice))
+    with (gzip.open(str(path), 'wb') if isCompressed(path) else open(str(path), 'wb')) as f:
+        f.write(fields.tobytes())
+        f.write(b'\0' * 4)  # no extensions
+        for start in range(0, array.shape[0], step):
+            data = np.ascontiguousarray(array[start:start + step], dtype=fileDtype)
+            f.write(memoryview(data.reshape(-1)).cast('B'))
+
+
+def iterNiftiChunks(path, header=None, chunkSize=CHUNK_SIZE):
+    """
+    Yields (start, chunk), where chunk is a 1D array with the voxels from the
+    flat index start, in the order of the file. Compressed files are
+    decompressed as they are read, so only one chunk is in memory at a time
+    """
+    if header is None:
+        header = readNiftiHeader(path)
+    dtype = header.getNumpyDataType()
+    scaling = header.getScaling()
+    numberOfVoxels = getNumberOfVoxels(header)
+    voxelsPerChunk = max(1, chunkSize // dtype.itemsize)
+    imagePath = getImagePath(path)
+    with openNifti(imagePath) as f:
+        f.seek(header.getDataOffset())
+        for start in range(0, numberOfVoxels, voxelsPerChunk):
+            chunk = np.empty(min(voxelsPerChunk, numberOfVoxels - start), dtype=dtype)
+            readInto(f, chunk.view(np.uint8))
+            if scaling is not None:
+                slope, intercept = scaling
+                chunk = chunk * slope + intercept
+            yield start, chunk
+
+
+def readInto(f, buffer):
+    view = memoryview(buffer).cast('B')
+    numberOfBytes = len(view)
+    position = 0
+    while position < numberOfBytes:
+        n = f.readinto(view[position:])
+        if not n:
+            raise ValueError('Unexpected end of NIfTI data in {}'.format(f.name))
+        position += n
+
+
+def getDataStreamFromVectorField(vectorfieldPath):
+    return readNiftiArray(vectorfieldPath).reshape(-1)
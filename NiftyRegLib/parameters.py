@@ -0,0 +1,185 @@
+import json
+import collections
+
+
+TRANSFORMATION_TYPES = 'Rigid', 'Affine', 'Non-linear'
+SIMILARITY_MEASURES = 'NMI', 'LNCC'
+INTERPOLATION_ORDERS = 0, 1, 3
+
+# Options that trade accuracy for speed, which are saved in the presets.
+# None means the NiftyReg default. The number of threads (-omp) depends on
+# the machine, so it is not part of the presets
+PERFORMANCE_OPTIONS = (
+    'linearIterations',         # reg_aladin -maxit
+    'blocksPercentage',         # reg_aladin -pv
+    'inliersPercentage',        # reg_aladin -pi
+    'nonLinearIterations',      # reg_f3d -maxit
+    'bendingEnergyWeight',      # reg_f3d -be
+    'controlPointSpacing',      # reg_f3d -sx, negative values are in voxels
+    'referenceSmoothing',       # -smooR, mm
+    'floatingSmoothing',        # -smooF, mm
+    'similarityMeasure',        # reg_f3d --nmi or --lncc
+    'histogramBins',            # reg_f3d --rbn and --fbn, for NMI
+    'lnccStandardDeviation',    # reg_f3d --lncc, in mm
+    'interpolationOrder',       # -interp
+)
+
+
+class RegistrationParameters(object):
+    """
+    Options of a NiftyReg registration that do not depend on the input and
+    output filepaths
+    """
+
+    def __init__(self,
+                 transformationType='Rigid',
+                 referenceThresholds=None,
+                 floatingThresholds=None,
+                 pyramidLevels=(3, 2),
+                 threads=None,
+                 cropToThresholds=False,
+                 cropMargin=10,
+                 useMasks=False,
+                 linearIterations=None,
+                 blocksPercentage=None,
+                 inliersPercentage=None,
+                 nonLinearIterations=None,
+                 bendingEnergyWeight=None,
+                 controlPointSpacing=None,
+                 referenceSmoothing=None,
+                 floatingSmoothing=None,
+                 similarityMeasure=None,
+                 histogramBins=None,
+                 lnccStandardDeviation=None,
+                 interpolationOrder=None):
+        if transformationType not in TRANSFORMATION_TYPES:
+            raise ValueError('Unknown transformation type: {}'.format(transformationType))
+        if similarityMeasure is not None and similarityMeasure not in SIMILARITY_MEASURES:
+            raise ValueError('Unknown similarity measure: {}'.format(similarityMeasure))
+        if interpolationOrder is not None and interpolationOrder not in INTERPOLATION_ORDERS:
+            raise ValueError('Interpolation order must be one of {}'.format(INTERPOLATION_ORDERS))
+        self.transformationType = transformationType
+        self.referenceThresholds = self._getPair(referenceThresholds)
+        self.floatingThresholds = self._getPair(floatingThresholds)
+        self.pyramidLevels = self._getPair(pyramidLevels, int)
+        self.threads = None if threads is None else int(threads)
+        self.cropToThresholds = bool(cropToThresholds)
+        self.cropMargin = float(cropMargin)  # mm
+        self.useMasks = bool(useMasks)
+        self.linearIterations = self._getOptional(linearIterations, int)
+        self.blocksPercentage = self._getOptional(blocksPercentage, int)
+        self.inliersPercentage = self._getOptional(inliersPercentage, int)
+        self.nonLinearIterations = self._getOptional(nonLinearIterations, int)
+        self.bendingEnergyWeight = self._getOptional(bendingEnergyWeight)
+        self.controlPointSpacing = self._getOptional(controlPointSpacing)
+        self.referenceSmoothing = self._getOptional(referenceSmoothing)
+        self.floatingSmoothing = self._getOptional(floatingSmoothing)
+        self.similarityMeasure = similarityMeasure
+        self.histogramBins = self._getOptional(histogramBins, int)
+        self.lnccStandardDeviation = self._getOptional(lnccStandardDeviation)
+        self.interpolationOrder = self._getOptional(interpolationOrder, int)
+
+
+    def __repr__(self):
+        arguments = ', '.join('{}={!r}'.format(k, v) for k, v in self.toDict().items())
+        return '{}({})'.format(self.__class__.__name__, arguments)
+
+
+    def __eq__(self, other):
+        return isinstance(other, RegistrationParameters) and self.toDict() == other.toDict()
+
+
+    def _getPair(self, values, function=float):
+        if values is None: return None
+        first, second = values
+        return function(first), function(second)
+
+
+    def _getOptional(self, value, function=float):
+        return None if value is None else function(value)
+
+
+    def isLinear(self):
+        return self.transformationType != 'Non-linear'
+
+
+    def preparesInputs(self):
+        """
+        True if the inputs are cropped to the voxels within the thresholds or
+        these voxels are used as masks (see cropping.py)
+        """
+        return self.cropToThresholds or self.useMasks
+
+
+    def getQuickRunParameters(self, levelsToPerform=1):
+        """
+        Same pyramid, but only the coarsest levels are used, to get an
+        approximate result quickly
+        """
+        if self.pyramidLevels is None:
+            return self.copy()
+        ln, lp = self.pyramidLevels
+        return self.copy(pyramidLevels=(ln, min(lp, levelsToPerform)))
+
+
+    def getPerformanceOptions(self):
+        return collections.OrderedDict((name, getattr(self, name)) for name in PERFORMANCE_OPTIONS)
+
+
+    def applyPreset(self, preset):
+        """
+        Returns a copy with the performance options of the preset. The
+        options missing in the preset are set to the NiftyReg defaults
+        """
+        unknown = set(preset) - set(PERFORMANCE_OPTIONS)
+        if unknown:
+            raise ValueError('Unknown performance options: {}'.format(', '.join(sorted(unknown))))
+        options = collections.OrderedDict((name, preset.get(name)) for name in PERFORMANCE_OPTIONS)
+        return self.copy(**options)
+
+
+    def copy(self, **kwargs):
+        parametersDict = self.toDict()
+        parametersDict.update(kwargs)
+        return self.fromDict(parametersDict)
+
+
+    def toDict(self):
+        return collections.OrderedDict([
+            ('transformationType', self.transformationType),
+            ('referenceThresholds', self.referenceThresholds),
+            ('floatingThresholds', self.floatingThresholds),
+            ('pyramidLevels', self.pyramidLevels),
+            ('threads', self.threads),
+            ('cropToThresholds', self.cropToThresholds),
+            ('cropMargin', self.cropMargin),
+            ('useMasks', self.useMasks),
+            ('linearIterations', self.linearIterations),
+            ('blocksPercentage', self.blocksPercentage),
+            ('inliersPercentage', self.inliersPercentage),
+            ('nonLinearIterations', self.nonLinearIterations),
+            ('bendingEnergyWeight', self.bendingEnergyWeight),
+            ('controlPointSpacing', self.controlPointSpacing),
+            ('referenceSmoothing', self.referenceSmoothing),
+            ('floatingSmoothing', self.floatingSmoothing),
+            ('similarityMeasure', self.similarityMeasure),
+            ('histogramBins', self.histogramBins),
+            ('lnccStandardDeviation', self.lnccStandardDeviation),
+            ('interpolationOrder', self.interpolationOrder),
+        ])
+
+
+    @classmethod
+    def fromDict(cls, parametersDict):
+        return cls(**parametersDict)
+
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.toDict(), f, indent=2)
+
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as f:
+            return cls.fromDict(json.load(f))
@@ -0,0 +1,101 @@
+from pathlib import Path
+
+from .parameters import TRANSFORMATION_TYPES
+from .registration import Registration, getTempPath
+
+
+def getPipelineStages(transformationType):
+    """
+    Transformation types from rigid up to the given one,
+    e.g. ('Rigid', 'Affine') for 'Affine'
+    """
+    index = TRANSFORMATION_TYPES.index(transformationType)
+    return tuple(TRANSFORMATION_TYPES[:index + 1])
+
+
+class Pipeline(object):
+    """
+    Registrations run back to back, each one initialized with the transform
+    written by the previous one (-inaff for reg_aladin, -aff for reg_f3d).
+    NiftyReg includes the initialization in its outputs, so the transform of
+    the last stage is the composition of all the stages.
+    The resampled images of the intermediate stages are not used, so they
+    are all written to the same scratch file, which is removed after each
+    stage, and they are not resampled again if the inputs are cropped
+    """
+
+    def __init__(self, refPath, floPath, parameters, outputDir=None, stages=None,
+                 initialTransformPath=None, refName=None, floName=None, dateTime=None):
+        if stages is None:
+            stages = getPipelineStages(parameters.transformationType)
+        self.stages = tuple(stages)
+        self.registrations = []
+        self.scratchPath = None
+        previousTransformPath = initialTransformPath
+        for index, stage in enumerate(self.stages):
+            registration = Registration(refPath,
+                                        floPath,
+                                        parameters.copy(transformationType=stage),
+                                        outputDir=outputDir,
+                                        initialTransformPath=previousTransformPath,
+                                        refName=refName,
+                                        floName=floName,
+                                        prefix=None if self.isLastStage(index) else 'stage{}'.format(index + 1),
+                                        dateTime=dateTime)
+            if not self.isLastStage(index):
+                if self.scratchPath is None:
+                    self.scratchPath = getTempPath(registration.outputDir, '.nii',
+                                                   filename='{}_pipeline'.format(Path(registration.resPath).stem),
+                                                   dateTime=dateTime)
+                registration.resPath = self.scratchPath
+                registration.needsResult = False
+            self.registrations.append(registration)
+            previousTransformPath = registration.resultTransformPath
+        self.lastRegistration = None
+        self.elapsedTime = 0
+
+
+    def __len__(self):
+        return len(self.registrations)
+
+
+    def isLastStage(self, index):
+        return index == len(self.stages) - 1
+
+
+    def getResult(self):
+        """
+        Registration of the last stage, whose transform is the composite one
+        """
+        return self.registrations[-1]
+
+
+    def finishStage(self, index):
+        if not self.isLastStage(index) and Path(self.scratchPath).is_file():
+            Path(self.scratchPath).unlink()
+
+
+    def run(self, onOutput=None, onProgress=None, cache=None, onEvent=None, onStageStarted=None):
+        """
+        Stops at the first stage that fails and returns its return code.
+        lastRegistration is the last stage that was run
+        """
+        self.elapsedTime = 0
+        returnCode = None
+        for index, registration in enumerate(self.registrations):
+            self.lastRegistration = registration
+            if onStageStarted is not None:
+                onStageStarted(index, registration)
+            returnCode = registration.run(onOutput=onOutput,
+                                          onProgress=onProgress,
+                                          cache=cache,
+                                          onEvent=onEvent)
+            self.elapsedTime += registration.elapsedTime or 0
+            self.finishStage(index)
+            if not registration.succeeded():
+                break
+        return returnCode
+
+
+    def succeeded(self):
+        return all(registration.succeeded() for registration in self.registrations)
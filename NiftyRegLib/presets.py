@@ -0,0 +1,104 @@
+"""
+Performance presets, i.e. values of the options that trade accuracy for
+speed (see PERFORMANCE_OPTIONS). The options missing in a preset use the
+NiftyReg defaults. Presets can be saved as JSON files in a directory
+"""
+
+import json
+import collections
+from pathlib import Path
+
+from .parameters import PERFORMANCE_OPTIONS
+
+
+PRESETS = collections.OrderedDict([
+    ('Fast preview', collections.OrderedDict([
+        ('linearIterations', 3),
+        ('blocksPercentage', 30),
+        ('nonLinearIterations', 50),
+        ('controlPointSpacing', -10),
+        ('histogramBins', 32),
+        ('interpolationOrder', 1),
+    ])),
+    ('Balanced', collections.OrderedDict()),
+    ('Accurate', collections.OrderedDict([
+        ('linearIterations', 10),
+        ('blocksPercentage', 80),
+        ('nonLinearIterations', 300),
+        ('controlPointSpacing', -4),
+        ('interpolationOrder', 3),
+    ])),
+])
+DEFAULT_PRESET = 'Balanced'
+
+
+def getPresetDict(parameters):
+    """
+    Performance options of the parameters that are not the NiftyReg defaults
+    """
+    options = parameters.getPerformanceOptions()
+    return collections.OrderedDict((k, v) for k, v in options.items() if v is not None)
+
+
+def writePreset(path, preset):
+    unknown = set(preset) - set(PERFORMANCE_OPTIONS)
+    if unknown:
+        raise ValueError('Unknown performance options: {}'.format(', '.join(sorted(unknown))))
+    with open(str(path), 'w') as f:
+        json.dump(preset, f, indent=2)
+
+
+def readPreset(path):
+    with open(str(path)) as f:
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
+
+
+class PresetLibrary(object):
+    """
+    The built-in presets and the ones saved in a directory, one JSON file
+    per preset. Saved presets can not replace the built-in ones
+    """
+
+    def __init__(self, directory=None):
+        self.directory = None if directory is None else Path(directory)
+
+
+    def getPath(self, name):
+        return self.directory / '{}.json'.format(name)
+
+
+    def getNames(self):
+        names = list(PRESETS)
+        if self.directory is not None and self.directory.is_dir():
+            names += sorted(path.stem for path in self.directory.glob('*.json') if path.stem not in PRESETS)
+        return names
+
+
+    def isBuiltIn(self, name):
+        return name in PRESETS
+
+
+    def get(self, name):
+        if name in PRESETS:
+            return PRESETS[name]
+        if self.directory is not None and self.getPath(name).is_file():
+            return readPreset(self.getPath(name))
+        raise KeyError('Unknown preset: {}'.format(name))
+
+
+    def save(self, name, parameters):
+        """
+        Saves the performance options of the parameters as a preset
+        """
+        if not name or name in PRESETS:
+            raise ValueError('Invalid preset name: {!r}'.format(name))
+        if self.directory is None:
+            raise ValueError('The library has no directory to save presets to')
+        self.directory.mkdir(parents=True, exist_ok=True)
+        writePreset(self.getPath(name), getPresetDict(parameters))
+
+
+    def remove(self, name):
+        if name in PRESETS:
+            raise ValueError('Built-in presets can not be removed')
+        self.getPath(name).unlink()
@@ -0,0 +1,177 @@
+import os
+import time
+import queue
+import shutil
+import threading
+import subprocess
+
+from .progress import OutputParser, EventLog
+
+
+class NiftyRegProcess(object):
+    """
+    Runs a NiftyReg binary without blocking the caller. The output is read
+    line by line in worker threads and the callbacks are only called from
+    poll(), so that they run on the caller's thread (e.g. from a QTimer).
+    The output is also parsed into events (see OutputParser), which are
+    passed to onEvent and written to eventsPath if given. The output lines
+    are written to logPath if given
+    """
+
+    def __init__(self, commandLineList, onOutput=None, onProgress=None, onFinished=None,
+                 onEvent=None, eventsPath=None, logPath=None):
+        self.commandLineList = commandLineList
+        self.onOutput = onOutput
+        self.onProgress = onProgress
+        self.onFinished = onFinished
+        self.onEvent = onEvent
+        self.eventLog = None if eventsPath is None else EventLog(eventsPath)
+        self.logPath = None if logPath is None else str(logPath)
+        self.logFile = None
+        self.parser = None
+        self.popen = None
+        self.readers = []
+        self.lines = queue.Queue()
+        self.errorLines = []
+        self.cancelled = False
+        self.finished = False
+        self.returnCode = None
+        self.tIni = None
+        self.tFin = None
+
+
+    def getPopenCommand(self):
+        """
+        NiftyReg prints with printf, which is block-buffered when writing to a
+        pipe. stdbuf makes it line-buffered so that the lines arrive on time
+        """
+        stdbuf = shutil.which('stdbuf') if os.name == 'posix' else None
+        if stdbuf is None:
+            return list(self.commandLineList)
+        return [stdbuf, '-oL', '-eL'] + list(self.commandLineList)
+
+
+    def start(self):
+        self.tIni = time.time()
+        self.parser = OutputParser(startTime=self.tIni)
+        self.popen = subprocess.Popen(self.getPopenCommand(),
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      universal_newlines=True,
+                                      bufsize=1)
+        # Opened once the process exists, so that it is not leaked if the
+        # binary can not be run
+        if self.logPath is not None:
+            self.logFile = open(self.logPath, 'w')
+        for streamName, stream in ('stdout', self.popen.stdout), ('stderr', self.popen.stderr):
+            reader = threading.Thread(target=self.readStream, args=(streamName, stream))
+            reader.daemon = True
+            reader.start()
+            self.readers.append(reader)
+        self.dispatchEvent({
+            'event': 'runStart',
+            'time': 0,
+            'commandLineList': list(self.commandLineList),
+        })
+
+
+    def readStream(self, streamName, stream):
+        for line in iter(stream.readline, ''):
+            self.lines.put((streamName, line.rstrip('\n'), time.time()))
+        stream.close()
+
+
+    def poll(self):
+        """
+        Dispatches the pending output lines and returns True while the process
+        is running
+        """
+        if self.finished:
+            return False
+        while True:
+            try:
+                streamName, line, now = self.lines.get_nowait()
+            except queue.Empty:
+                break
+            self.processLine(streamName, line, now)
+
+        if self.popen.poll() is None or any(reader.is_alive() for reader in self.readers):
+            return True
+        if not self.lines.empty():
+            return True
+
+        self.finished = True
+        self.tFin = time.time()
+        self.returnCode = self.popen.returncode
+        for event in self.parser.finish(self.tFin):
+            self.dispatchEvent(event)
+        self.dispatchEvent({
+            'event': 'runEnd',
+            'time': self.tFin - self.tIni,
+            'returnCode': self.returnCode,
+            'cancelled': self.cancelled,
+        })
+        if self.eventLog is not None:
+            self.eventLog.close()
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+        if self.onFinished is not None:
+            self.onFinished(self.returnCode)
+        return False
+
+
+    def processLine(self, streamName, line, now=None):
+        if streamName == 'stderr':
+            self.errorLines.append(line)
+        if self.logFile is not None:
+            self.logFile.write(line + '\n')
+        if self.onOutput is not None:
+            self.onOutput(streamName, line)
+        for event in self.parser.parseLine(line, now):
+            self.dispatchEvent(event)
+
+
+    def dispatchEvent(self, event):
+        if self.eventLog is not None:
+            self.eventLog.write(event)
+        if self.onEvent is not None:
+            self.onEvent(event)
+        if event['event'] == 'levelStart' and self.onProgress is not None:
+            self.onProgress(event['level'], event['numberOfLevels'])
+
+
+    def getLevels(self):
+        """
+        Returns the 'levelEnd' events, which contain the time per level
+        """
+        return [] if self.parser is None else list(self.parser.levels)
+
+
+    def wait(self):
+        """
+        Blocks until the process has finished, dispatching the output
+        """
+        while self.poll():
+            time.sleep(0.05)
+        return self.returnCode
+
+
+    def cancel(self):
+        if self.popen is None or self.popen.poll() is not None:
+            return
+        self.cancelled = True
+        self.popen.terminate()
+
+
+    def isRunning(self):
+        return self.popen is not None and not self.finished
+
+
+    def getErrorOutput(self):
+        return '\n'.join(self.errorLines)
+
+
+    def getElapsedTime(self):
+        tFin = time.time() if self.tFin is None else self.tFin
+        return tFin - self.tIni
@@ -0,0 +1,120 @@
+import re
+import json
+import time
+
+
+class OutputParser(object):
+    """
+    Converts the lines printed by reg_aladin and reg_f3d into events, which
+    are dictionaries with an 'event' key and the elapsed 'time' in seconds.
+    The events are 'levelStart', 'iteration' and 'levelEnd'
+    """
+
+    LEVEL_PATTERN = re.compile(r'Current level:?\s*(\d+)\s*/\s*(\d+)')
+    OBJECTIVE_PATTERN = re.compile(
+        r'\[(\d+)\]\s*(?:Current|Initial)\s+objective function:\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+
+    def __init__(self, startTime=None):
+        self.startTime = time.time() if startTime is None else startTime
+        self.level = None
+        self.numberOfLevels = None
+        self.levelStartTime = None
+        self.iterations = 0
+        self.objective = None
+        self.levels = []
+
+
+    def getElapsedTime(self, now=None):
+        return (time.time() if now is None else now) - self.startTime
+
+
+    def parseLine(self, line, now=None):
+        """
+        now is the time at which the line was printed, if known
+        """
+        events = []
+        match = self.LEVEL_PATTERN.search(line)
+        if match is not None:
+            events += self.finish(now)
+            self.level, self.numberOfLevels = [int(n) for n in match.groups()]
+            self.levelStartTime = self.getElapsedTime(now)
+            self.iterations = 0
+            self.objective = None
+            events.append({
+                'event': 'levelStart',
+                'time': self.levelStartTime,
+                'level': self.level,
+                'numberOfLevels': self.numberOfLevels,
+            })
+            return events
+
+        match = self.OBJECTIVE_PATTERN.search(line)
+        if match is not None:
+            iteration = int(match.group(1))
+            self.iterations = max(self.iterations, iteration)
+            self.objective = float(match.group(2))
+            events.append({
+                'event': 'iteration',
+                'time': self.getElapsedTime(now),
+                'level': self.level,
+                'iteration': iteration,
+                'objective': self.objective,
+            })
+        return events
+
+
+    def finish(self, now=None):
+        """
+        Closes the current level, if any
+        """
+        if self.level is None:
+            return []
+        elapsed = self.getElapsedTime(now)
+        event = {
+            'event': 'levelEnd',
+            'time': elapsed,
+            'level': self.level,
+            'numberOfLevels': self.numberOfLevels,
+            'duration': elapsed - self.levelStartTime,
+            'iterations': self.iterations,
+            'objective': self.objective,
+        }
+        self.levels.append(event)
+        self.level = None
+        return [event]
+
+
+class EventLog(object):
+    """
+    Writes events to a JSON lines file. The file of a previous run with the
+    same path is overwritten
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.file = None
+
+
+    def write(self, event):
+        if self.file is None:
+            self.file = open(self.path, 'w')
+        self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def readEventLog(path):
+    with open(str(path)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def getLevelsSummary(levels):
+    lines = []
+    for event in levels:
+        lines.append('Level {level} / {numberOfLevels}: {duration:.2f} s, {iterations} iterations'.format(**event))
+    return '\n'.join(lines)
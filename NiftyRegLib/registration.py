@@ -0,0 +1,546 @@
+import os
+import json
+import time
+import shlex
+import random
+import string
+import collections
+import concurrent.futures
+from pathlib import Path
+
+from .nifti import getNiftiStem
+from .binaries import findBinary
+from .matrix import readNiftyRegMatrix
+from .cropping import prepareInput, padControlPointGrid
+from .process import NiftyRegProcess
+from .metrics import computeRegistrationMetrics
+from .resampling import resampleFloating
+from .vectorfield import writeDisplacementField, resampleWithVectorField
+from .parameters import RegistrationParameters
+
+
+# Binary names or paths, found in the PATH when they are first used
+TRANSFORMATIONS_MAP = collections.OrderedDict([('Rigid', 'reg_aladin'),
+                                               ('Affine', 'reg_aladin'),
+                                               ('Non-linear', 'reg_f3d')])
+# reg_f3d needs the width of the LNCC kernel, in mm
+LNCC_STANDARD_DEVIATION = 5
+BatchResult = collections.namedtuple('BatchResult', ['index',
+                                                     'referencePath',
+                                                     'floatingPath',
+                                                     'resultPath',
+                                                     'transformPath',
+                                                     'returnCode',
+                                                     'elapsedTime',
+                                                     'errorOutput'])
+
+
+def getTempPath(directory, ext, length=10, filename=None, dateTime=None):
+    if filename is None:
+        filename = ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
+    filename = filename.replace(' ', '_')  # avoid errors when running a command with spaces
+    filename += ext
+    if dateTime is not None:
+        filename = '{}_{}'.format(dateTime.strftime("%Y%m%d_%H%M%S"), filename)
+    return str(Path(directory) / filename)
+
+
+def getTransformExtension(trsfType):
+    return '.txt' if trsfType != 'Non-linear' else '.nii'
+
+
+def getBinaryPath(trsfType):
+    """
+    Path of the binary for a transformation type. If it is not found, the
+    name is returned so that starting the process fails with a clear error
+    """
+    name = TRANSFORMATIONS_MAP[trsfType]
+    return findBinary(name) or name
+
+
+def getCommandLineList(parameters, refPath, floPath, resPath, resultTransformPath,
+                       initialTransformPath=None, initialControlPointGridPath=None,
+                       refMaskPath=None, floMaskPath=None):
+    trsfType = parameters.transformationType
+    binaryPath = getBinaryPath(trsfType)
+
+    cmd = [binaryPath]
+    cmd += ['-ref', refPath]
+    cmd += ['-flo', floPath]
+    cmd += ['-res', resPath]
+    if parameters.isLinear():
+        if trsfType == 'Rigid':
+            cmd += ['-rigOnly']
+        elif trsfType == 'Affine':
+            cmd += ['-affDirect']
+        cmd += ['-aff', resultTransformPath]
+        thresholdFlags = '-refLowThr', '-refUpThr', '-floLowThr', '-floUpThr'
+    else:
+        cmd += ['-cpp', resultTransformPath]
+        thresholdFlags = '-rLwTh', '-rUpTh', '-fLwTh', '-fUpTh'
+
+    if parameters.referenceThresholds is not None:
+        refThreshMin, refThreshMax = parameters.referenceThresholds
+        cmd += [thresholdFlags[0], str(refThreshMin)]
+        cmd += [thresholdFlags[1], str(refThreshMax)]
+    if parameters.floatingThresholds is not None:
+        floThreshMin, floThreshMax = parameters.floatingThresholds
+        cmd += [thresholdFlags[2], str(floThreshMin)]
+        cmd += [thresholdFlags[3], str(floThreshMax)]
+
+    if refMaskPath is not None:
+        cmd += ['-rmask', refMaskPath]
+    if floMaskPath is not None:
+        cmd += ['-fmask', floMaskPath]
+
+    if parameters.pyramidLevels is not None:
+        ln, lp = parameters.pyramidLevels
+        cmd += ['-ln', str(ln)]
+        cmd += ['-lp', str(lp)]
+
+    if parameters.isLinear():
+        options = [('-maxit', parameters.linearIterations),
+                   ('-pv', parameters.blocksPercentage),
+                   ('-pi', parameters.inliersPercentage)]
+    else:
+        options = [('-maxit', parameters.nonLinearIterations),
+                   ('-be', parameters.bendingEnergyWeight),
+                   ('-sx', parameters.controlPointSpacing)]
+    options += [('-smooR', parameters.referenceSmoothing),
+                ('-smooF', parameters.floatingSmoothing),
+                ('-interp', parameters.interpolationOrder)]
+    for flag, value in options:
+        if value is not None:
+            cmd += [flag, str(value)]
+
+    if not parameters.isLinear():
+        if parameters.similarityMeasure == 'LNCC':
+            standardDeviation = parameters.lnccStandardDeviation
+            if standardDeviation is None:
+                standardDeviation = LNCC_STANDARD_DEVIATION
+            cmd += ['--lncc', str(standardDeviation)]
+        else:
+            if parameters.similarityMeasure == 'NMI':
+                cmd += ['--nmi']
+            if parameters.histogramBins is not None:
+                cmd += ['--rbn', str(parameters.histogramBins)]
+                cmd += ['--fbn', str(parameters.histogramBins)]
+
+    if initialControlPointGridPath is not None and not parameters.isLinear():
+        # The grid already includes the affine part of the transformation
+        cmd += ['-incpp', initialControlPointGridPath]
+    elif initialTransformPath is not None:
+        if parameters.isLinear():
+            cmd += ['-inaff', initialTransformPath]
+        else:
+            cmd += ['-aff', initialTransformPath]
+
+    if parameters.threads is not None:
+        cmd += ['-omp', str(parameters.threads)]
+
+    return cmd
+
+
+def getThreadsPerJob(numberOfWorkers, numberOfCores=None):
+    if numberOfCores is None:
+        numberOfCores = os.cpu_count() or 1
+    return max(1, numberOfCores // numberOfWorkers)
+
+
+class Registration(object):
+    """
+    A single NiftyReg run on files. It does not need Slicer, so it can be used
+    from scripts or from the command line
+    """
+
+    def __init__(self, refPath, floPath, parameters=None, outputDir=None,
+                 initialTransformPath=None, refName=None, floName=None,
+                 prefix=None, dateTime=None, initialControlPointGridPath=None):
+        self.refPath = str(refPath)
+        self.floPath = str(floPath)
+        self.parameters = RegistrationParameters() if parameters is None else parameters
+        self.outputDir = str(Path.cwd() if outputDir is None else outputDir)
+        self.initialTransformPath = None if initialTransformPath is None else str(initialTransformPath)
+        self.initialControlPointGridPath = None
+        if initialControlPointGridPath is not None:
+            self.initialControlPointGridPath = str(initialControlPointGridPath)
+        self.returnCode = None
+        self.errorOutput = ''
+        self.elapsedTime = None
+        self.cached = False
+
+        refName = getNiftiStem(self.refPath) if refName is None else refName
+        floName = getNiftiStem(self.floPath) if floName is None else floName
+        trsfType = self.parameters.transformationType
+        if prefix is not None:
+            refName, floName = '{}_{}'.format(prefix, refName), '{}_{}'.format(prefix, floName)
+
+        self.resPath = getTempPath(self.outputDir,
+                                   '.nii',
+                                   filename='{}_on_{}'.format(floName, refName),
+                                   dateTime=dateTime)
+
+        self.resultTransformPath = getTempPath(self.outputDir,
+                                               getTransformExtension(trsfType),
+                                               filename='t_ref-{}_flo-{}'.format(refName, floName),
+                                               dateTime=dateTime)
+
+        # Save the command line for debugging
+        self.cmdPath = getTempPath(self.outputDir,
+                                   '.txt',
+                                   filename='cmd_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
+                                   dateTime=dateTime)
+
+        self.logPath = getTempPath(self.outputDir,
+                                   '.txt',
+                                   filename='log_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
+                                   dateTime=dateTime)
+
+        self.eventsPath = getTempPath(self.outputDir,
+                                      '.jsonl',
+                                      filename='events_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
+                                      dateTime=dateTime)
+        self.metricsPath = getTempPath(self.outputDir,
+                                       '.json',
+                                       filename='metrics_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
+                                       dateTime=dateTime)
+        self.levels = []
+        self.metrics = None
+        # False if the resampled floating image is not used, e.g. in the
+        # intermediate stages of a pipeline. Then only the transform is
+        # uncropped and resPath may not exist
+        self.needsResult = True
+
+        # Inputs and outputs of NiftyReg if the inputs are cropped or masked
+        self.croppedRefPath = self.croppedFloPath = None
+        self.croppedResPath = self.croppedTransformPath = None
+        self.refMaskPath = self.floMaskPath = None
+        self.referencePrepared = False
+        if self.parameters.cropToThresholds:
+            self.croppedRefPath = getTempPath(self.outputDir,
+                                              '.nii',
+                                              filename='cropped_ref-{}_flo-{}_{}_reference'.format(refName, floName, trsfType),
+                                              dateTime=dateTime)
+            self.croppedFloPath = getTempPath(self.outputDir,
+                                              '.nii',
+                                              filename='cropped_ref-{}_flo-{}_{}_floating'.format(refName, floName, trsfType),
+                                              dateTime=dateTime)
+            self.croppedResPath = getTempPath(self.outputDir,
+                                              '.nii',
+                                              filename='cropped_{}_on_{}'.format(floName, refName),
+                                              dateTime=dateTime)
+            if self.parameters.isLinear():
+                # The matrices do not depend on the cropping
+                self.croppedTransformPath = self.resultTransformPath
+            else:
+                self.croppedTransformPath = getTempPath(self.outputDir,
+                                                        getTransformExtension(trsfType),
+                                                        filename='cropped_t_ref-{}_flo-{}'.format(refName, floName),
+                                                        dateTime=dateTime)
+        if self.parameters.useMasks:
+            self.refMaskPath = getTempPath(self.outputDir,
+                                           '.nii',
+                                           filename='mask_ref-{}_flo-{}_{}_reference'.format(refName, floName, trsfType),
+                                           dateTime=dateTime)
+            self.floMaskPath = getTempPath(self.outputDir,
+                                           '.nii',
+                                           filename='mask_ref-{}_flo-{}_{}_floating'.format(refName, floName, trsfType),
+                                           dateTime=dateTime)
+
+
+    def getCommandLineList(self):
+        return getCommandLineList(self.parameters,
+                                  self.croppedRefPath or self.refPath,
+                                  self.croppedFloPath or self.floPath,
+                                  self.croppedResPath or self.resPath,
+                                  self.croppedTransformPath or self.resultTransformPath,
+                                  initialTransformPath=self.initialTransformPath,
+                                  initialControlPointGridPath=self.initialControlPointGridPath,
+                                  refMaskPath=self.refMaskPath,
+                                  floMaskPath=self.floMaskPath)
+
+
+    def prepareInputs(self):
+        """
+        Writes the cropped inputs and the masks, if the parameters use them.
+        This must be called before running NiftyReg
+        """
+        if not self.parameters.preparesInputs(): return
+        self.prepareReference()
+        prepareInput(self.floPath, self.parameters.floatingThresholds, margin=self.parameters.cropMargin,
+                     croppedPath=self.croppedFloPath, maskPath=self.floMaskPath)
+
+
+    def prepareReference(self):
+        if not self.parameters.preparesInputs() or self.referencePrepared: return
+        prepareInput(self.refPath, self.parameters.referenceThresholds, margin=self.parameters.cropMargin,
+                     croppedPath=self.croppedRefPath, maskPath=self.refMaskPath)
+        self.referencePrepared = True
+
+
+    def shareReference(self, registration):
+        """
+        Uses the cropped reference and the mask of another registration with
+        the same reference and parameters instead of writing new ones
+        """
+        self.croppedRefPath = registration.croppedRefPath
+        self.refMaskPath = registration.refMaskPath
+        self.referencePrepared = registration.referencePrepared
+
+
+    def uncropOutputs(self):
+        """
+        Writes the outputs for the whole reference from the outputs of
+        NiftyReg on the cropped inputs. This must be called after NiftyReg
+        succeeds
+        """
+        if not self.parameters.cropToThresholds: return
+        if not Path(self.croppedTransformPath).is_file(): return
+        if self.parameters.isLinear():
+            if self.needsResult:
+                resampleFloating(self.refPath, self.floPath, self.resultTransformPath, outputPath=self.resPath)
+        else:
+            matrix = None
+            if self.initialTransformPath is not None and self.initialControlPointGridPath is None:
+                matrix = readNiftyRegMatrix(self.initialTransformPath)
+            padControlPointGrid(self.croppedTransformPath, self.refPath, self.resultTransformPath, matrix=matrix)
+            if self.needsResult:
+                resampleWithVectorField(self.refPath, self.floPath, self.resultTransformPath, outputPath=self.resPath)
+        if Path(self.croppedResPath).is_file():
+            Path(self.croppedResPath).unlink()
+
+
+    def writeCommandLine(self):
+        """
+        Writes the command line to cmdPath, so that it can be run again from
+        a terminal
+        """
+        with open(self.cmdPath, 'w') as f:
+            f.write(' '.join(shlex.quote(arg) for arg in self.getCommandLineList()) + '\n')
+
+
+    def outputsExist(self, checkResult=True, checkTransform=True):
+        """
+        We need this because it's not clear that reg_aladin returns non-zero
+        when failed
+        """
+        if checkResult and not Path(self.resPath).is_file():
+            return False
+        if checkTransform and not Path(self.resultTransformPath).is_file():
+            return False
+        return True
+
+
+    def run(self, onOutput=None, onProgress=None, cache=None, onEvent=None):
+        """
+        If a ResultCache is given, NiftyReg is not run when the same inputs
+        and options have already been registered
+        """
+        Path(self.outputDir).mkdir(parents=True, exist_ok=True)
+        cacheKey = None
+        if cache is not None:
+            cacheKey = cache.getKey(self)
+            if cache.fetch(cacheKey, self):
+                self.cached = True
+                self.returnCode = 0
+                self.errorOutput = ''
+                self.elapsedTime = 0
+                return self.returnCode
+
+        process = NiftyRegProcess(self.getCommandLineList(),
+                                  onOutput=onOutput,
+                                  onProgress=onProgress,
+                                  onEvent=onEvent,
+                                  eventsPath=self.eventsPath,
+                                  logPath=self.logPath)
+        try:
+            self.writeCommandLine()
+            self.prepareInputs()
+            process.start()
+            self.returnCode = process.wait()
+            self.errorOutput = process.getErrorOutput()
+            self.elapsedTime = process.getElapsedTime()
+            self.levels = process.getLevels()
+        except (OSError, RuntimeError, ValueError) as e:
+            # e.g. a missing binary or an input that SimpleITK can not crop
+            self.returnCode = None
+            self.errorOutput = str(e)
+            self.elapsedTime = 0
+
+        if self.returnCode == 0:
+            try:
+                self.uncropOutputs()
+            except (OSError, RuntimeError, ValueError) as e:
+                self.returnCode = None
+                self.errorOutput = str(e)
+
+        if self.returnCode == 0 and not self.outputsExist(checkResult=self.needsResult):
+            self.returnCode = None
+            self.errorOutput = 'Outputs not written on the disk\n\n' + self.errorOutput
+        if cacheKey is not None and self.succeeded() and self.outputsExist():
+            cache.store(cacheKey, self)
+        return self.returnCode
+
+
+    def succeeded(self):
+        return self.returnCode == 0
+
+
+    def readMatrix(self):
+        if not self.parameters.isLinear():
+            raise ValueError('Non-linear registrations do not have a matrix')
+        return readNiftyRegMatrix(self.resultTransformPath)
+
+
+    def resampleFloating(self, outputPath=None, interpolation='linear'):
+        """
+        Resamples the floating image with the result matrix, without reading
+        the image written by NiftyReg
+        """
+        if not self.parameters.isLinear():
+            raise ValueError('Only linear results can be resampled in-process')
+        return resampleFloating(self.refPath, self.floPath, self.resultTransformPath,
+                                outputPath=outputPath, interpolation=interpolation)
+
+
+    def computeMetrics(self, resultArray=None, write=True):
+        """
+        Quality metrics of the result (see computeRegistrationMetrics), also
+        written to metricsPath. resultArray can be given if the result was
+        resampled in memory
+        """
+        resultPath = self.resPath if resultArray is None and Path(self.resPath).is_file() else None
+        transformPath = None if self.parameters.isLinear() else self.resultTransformPath
+        self.metrics = computeRegistrationMetrics(self.refPath,
+                                                  resultPath=resultPath,
+                                                  transformPath=transformPath,
+                                                  referenceThresholds=self.parameters.referenceThresholds,
+                                                  resultArray=resultArray)
+        if write:
+            with open(self.metricsPath, 'w') as f:
+                json.dump(self.metrics, f, indent=2)
+        return self.metrics
+
+
+    def writeDisplacementField(self, displacementFieldPath):
+        if self.parameters.isLinear():
+            raise ValueError('Linear registrations do not have a displacement field')
+        writeDisplacementField(self.resultTransformPath, self.refPath, displacementFieldPath)
+
+
+def getBatchParameters(parameters, threads):
+    if parameters is None:
+        parameters = RegistrationParameters()
+    elif not isinstance(parameters, RegistrationParameters):
+        parameters = RegistrationParameters.fromDict(parameters)
+    if parameters.threads is None:
+        parameters = parameters.copy(threads=threads)
+    return parameters
+
+
+def runBatchJob(index, registration):
+    tIni = time.time()
+    registration.run()
+    elapsedTime = time.time() - tIni
+    return BatchResult(index=index,
+                       referencePath=registration.refPath,
+                       floatingPath=registration.floPath,
+                       resultPath=registration.resPath,
+                       transformPath=registration.resultTransformPath,
+                       returnCode=registration.returnCode,
+                       elapsedTime=elapsedTime,
+                       errorOutput=registration.errorOutput)
+
+
+def getNumberOfWorkers(numberOfJobs, maxWorkers=None):
+    """
+    Returns the number of workers and the OpenMP threads of each one, so
+    that the total number of threads does not exceed the number of cores
+    """
+    numberOfCores = os.cpu_count() or 1
+    if maxWorkers is None:
+        maxWorkers = numberOfCores
+    numberOfWorkers = max(1, min(maxWorkers, numberOfJobs))
+    return numberOfWorkers, getThreadsPerJob(numberOfWorkers, numberOfCores)
+
+
+def runRegistrations(registrations, numberOfWorkers, onJobFinished=None):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+        futures = [executor.submit(runBatchJob, index, registration)
+                   for index, registration in enumerate(registrations)]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if onJobFinished is not None:
+                onJobFinished(result)
+            yield result
+
+
+def runBatch(jobs, outputDir, maxWorkers=None, onJobFinished=None):
+    """
+    Runs many registrations through a bounded pool of NiftyReg processes.
+    Each job is a tuple (referencePath, floatingPath, parameters), where
+    parameters is a RegistrationParameters instance or a dictionary.
+    The OpenMP threads are split among the workers so that the total
+    number of threads does not exceed the number of cores.
+    This is a generator that yields a BatchResult as each job finishes.
+    """
+    jobs = list(jobs)
+    if not jobs: return
+    Path(outputDir).mkdir(parents=True, exist_ok=True)
+    numberOfWorkers, threads = getNumberOfWorkers(len(jobs), maxWorkers)
+    registrations = []
+    for index, (refPath, floPath, parameters) in enumerate(jobs):
+        registration = Registration(refPath, floPath, getBatchParameters(parameters, threads),
+                                    outputDir=outputDir,
+                                    prefix='{:04d}'.format(index))
+        registrations.append(registration)
+    for result in runRegistrations(registrations, numberOfWorkers, onJobFinished=onJobFinished):
+        yield result
+
+
+def runOneToMany(refPath, floPaths, parameters, outputDir, maxWorkers=None, onJobFinished=None,
+                 floatingThresholds=None):
+    """
+    Registers many floating images to one reference, like runBatch. The
+    reference is cropped and masked only once, if the parameters use them.
+    floatingThresholds is an optional list with the thresholds of each
+    floating image, which replace the ones in the parameters.
+    This is a generator that yields a BatchResult as each job finishes,
+    whose index is the index of the floating image. If the reference can
+    not be prepared, every result is a failure with the error as output
+    """
+    floPaths = list(floPaths)
+    if not floPaths: return
+    Path(outputDir).mkdir(parents=True, exist_ok=True)
+    numberOfWorkers, threads = getNumberOfWorkers(len(floPaths), maxWorkers)
+    parameters = getBatchParameters(parameters, threads)
+    registrations = []
+    for index, floPath in enumerate(floPaths):
+        jobParameters = parameters
+        if floatingThresholds is not None and floatingThresholds[index] is not None:
+            jobParameters = parameters.copy(floatingThresholds=floatingThresholds[index])
+        registration = Registration(refPath, floPath, jobParameters,
+                                    outputDir=outputDir,
+                                    prefix='{:04d}'.format(index))
+        registrations.append(registration)
+    try:
+        registrations[0].prepareReference()
+    except (OSError, RuntimeError, ValueError) as e:
+        # No floating image can be registered without the reference
+        for index, registration in enumerate(registrations):
+            result = BatchResult(index=index,
+                                 referencePath=registration.refPath,
+                                 floatingPath=registration.floPath,
+                                 resultPath=registration.resPath,
+                                 transformPath=registration.resultTransformPath,
+                                 returnCode=None,
+                                 elapsedTime=0,
+                                 errorOutput=str(e))
+            if onJobFinished is not None:
+                onJobFinished(result)
+            yield result
+        return
+    for registration in registrations[1:]:
+        registration.shareReference(registrations[0])
+    for result in runRegistrations(registrations, numberOfWorkers, onJobFinished=onJobFinished):
+        yield result
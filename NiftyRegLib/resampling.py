@@ -0,0 +1,87 @@
+import numpy as np
+import SimpleITK as sitk
+
+from .matrix import readNiftyRegMatrix
+
+
+RAS_TO_LPS = np.diag([-1, -1, 1, 1])
+
+INTERPOLATORS = {
+    'nearest': sitk.sitkNearestNeighbor,
+    'linear': sitk.sitkLinear,
+    'cubic': sitk.sitkBSpline,
+}
+
+
+def getSimpleITKAffineTransform(matrix, dimension=3):
+    """
+    NiftyReg matrices map points from the reference space to the floating
+    space in RAS coordinates, which is also what ITK resamplers expect from
+    a transform, but in LPS coordinates
+    """
+    matrix = RAS_TO_LPS.dot(np.asarray(matrix, dtype=np.float64)).dot(RAS_TO_LPS)
+    if dimension == 2:
+        indices = [0, 1, 3]
+        matrix = matrix[np.ix_(indices, indices)]
+    transform = sitk.AffineTransform(dimension)
+    transform.SetMatrix(matrix[:dimension, :dimension].ravel().tolist())
+    transform.SetTranslation(matrix[:dimension, dimension].tolist())
+    return transform
+
+
+def getGrid(image):
+    """
+    Geometry of an image, as expected by sitk.Resample
+    """
+    return image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection()
+
+
+def readGrid(path):
+    """
+    Geometry of an image file, read without its voxels
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return reader.GetSize(), reader.GetOrigin(), reader.GetSpacing(), reader.GetDirection()
+
+
+def resampleWithMatrix(floatingImage, matrix, grid, interpolation='linear', defaultValue=0):
+    """
+    Resamples the floating image on the reference grid, given as
+    (size, origin, spacing, direction) in LPS coordinates, so that the
+    reference voxels do not need to be loaded. SimpleITK uses all the
+    available cores
+    """
+    transform = getSimpleITKAffineTransform(matrix, dimension=floatingImage.GetDimension())
+    return resampleWithTransform(floatingImage, transform, grid,
+                                 interpolation=interpolation, defaultValue=defaultValue)
+
+
+def resampleWithTransform(floatingImage, transform, grid, interpolation='linear', defaultValue=0):
+    """
+    Same as resampleWithMatrix, with any SimpleITK transform (LPS)
+    """
+    size, origin, spacing, direction = grid
+    return sitk.Resample(floatingImage,
+                         [int(n) for n in size],
+                         transform,
+                         INTERPOLATORS[interpolation],
+                         [float(x) for x in origin],
+                         [float(x) for x in spacing],
+                         [float(x) for x in direction],
+                         defaultValue,
+                         floatingImage.GetPixelID())
+
+
+def resampleFloating(referencePath, floatingPath, matrixPath, outputPath=None, interpolation='linear'):
+    """
+    Same result as the -res output of reg_aladin, computed without NiftyReg
+    """
+    grid = readGrid(referencePath)
+    floatingImage = sitk.ReadImage(str(floatingPath))
+    matrix = readNiftyRegMatrix(str(matrixPath))
+    resampledImage = resampleWithMatrix(floatingImage, matrix, grid, interpolation=interpolation)
+    if outputPath is not None:
+        sitk.WriteImage(resampledImage, str(outputPath))
+    return resampledImage
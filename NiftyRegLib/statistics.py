@@ -0,0 +1,116 @@
+import numpy as np
+
+from .nifti import readNiftiArray
+
+
+CHUNK_SIZE = 2**24  # bytes
+MAX_SAMPLES = 2**20
+SAMPLING_SEED = 0  # the same voxels are sampled every time
+NUMBER_OF_BINS = 256
+ROBUST_PERCENTILES = 0.5, 99.5
+PERCENTILES = tuple(np.linspace(0, 100, 201).tolist())  # every 0.5 %
+
+
+class IntensityStatistics(object):
+    """
+    Intensity range, percentiles and histogram of an image.
+    The range is exact. The percentiles and the histogram are computed from
+    a random subsample of at most maxSamples voxels, which is enough for
+    threshold hints and keeps large volumes fast
+    """
+
+    def __init__(self, minimum, maximum, percentiles, histogram, binEdges, numberOfSamples):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentiles = percentiles  # percentile -> value
+        self.histogram = histogram
+        self.binEdges = binEdges
+        self.numberOfSamples = numberOfSamples
+
+
+    def __repr__(self):
+        return 'IntensityStatistics(minimum={}, maximum={}, percentiles={})'.format(
+            self.minimum, self.maximum, self.percentiles)
+
+
+    def getRange(self):
+        return self.minimum, self.maximum
+
+
+    def getPercentile(self, percentile):
+        """
+        Percentiles that were not precomputed are interpolated
+        """
+        if percentile in self.percentiles:
+            return self.percentiles[percentile]
+        keys = sorted(self.percentiles)
+        values = [self.percentiles[k] for k in keys]
+        return float(np.interp(percentile, keys, values))
+
+
+    def getRobustThresholds(self, percentiles=ROBUST_PERCENTILES):
+        """
+        Lower and upper thresholds that ignore the outliers
+        """
+        lower, upper = percentiles
+        return self.getPercentile(lower), self.getPercentile(upper)
+
+
+def getRange(array, chunkSize=CHUNK_SIZE):
+    """
+    Minimum and maximum in one pass over chunks small enough to stay in
+    the CPU cache, instead of two passes over the whole array. The chunks
+    are slabs along the first axis, so views are not copied
+    """
+    array = array.reshape((1,) * (1 - array.ndim) + array.shape)
+    bytesPerSlice = array.itemsize * int(np.prod(array.shape[1:], dtype=np.int64))
+    step = max(1, chunkSize // max(1, bytesPerSlice))
+    minimum = maximum = None
+    for start in range(0, array.shape[0], step):
+        chunk = array[start:start + step]
+        chunkMin, chunkMax = chunk.min(), chunk.max()
+        minimum = chunkMin if minimum is None else min(minimum, chunkMin)
+        maximum = chunkMax if maximum is None else max(maximum, chunkMax)
+    return minimum, maximum
+
+
+def getSample(array, maxSamples=MAX_SAMPLES, seed=SAMPLING_SEED):
+    """
+    All the voxels of small arrays, otherwise maxSamples voxels drawn
+    uniformly with a fixed seed. A regular stride would sample the same few
+    columns if it shared a factor with the row or slice length. The indices
+    are sorted so that memory maps are read in order
+    """
+    if array.size <= maxSamples:
+        return np.ravel(array)
+    randomState = np.random.RandomState(seed)
+    flatIndices = np.sort(randomState.randint(0, array.size, size=maxSamples, dtype=np.int64))
+    return array[np.unravel_index(flatIndices, array.shape)]
+
+
+def computeIntensityStatistics(array,
+                               percentiles=PERCENTILES,
+                               numberOfBins=NUMBER_OF_BINS,
+                               maxSamples=MAX_SAMPLES,
+                               chunkSize=CHUNK_SIZE):
+    if array.size == 0:
+        raise ValueError('Cannot compute statistics of an empty image')
+    minimum, maximum = getRange(array, chunkSize=chunkSize)
+    minimum, maximum = float(minimum), float(maximum)
+    sample = getSample(array, maxSamples=maxSamples)
+
+    percentiles = sorted(set(percentiles) | {0, 100})
+    values = np.percentile(sample, percentiles) if percentiles else []
+    percentilesMap = dict(zip(percentiles, [float(v) for v in values]))
+
+    upper = maximum if maximum > minimum else minimum + 1
+    histogram, binEdges = np.histogram(sample, bins=numberOfBins, range=(minimum, upper))
+    return IntensityStatistics(minimum, maximum, percentilesMap, histogram, binEdges, sample.size)
+
+
+def readIntensityStatistics(path, **kwargs):
+    """
+    Statistics of a NIfTI file. Uncompressed files are memory-mapped, so
+    only the subsample and one chunk at a time are loaded
+    """
+    return computeIntensityStatistics(readNiftiArray(path), **kwargs)
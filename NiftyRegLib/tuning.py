@@ -0,0 +1,314 @@
+"""
+Automatic choice of the pyramid levels, the control point spacing and the
+number of threads from the image sizes, the number of cores and the
+available memory. The speed of NiftyReg on a machine is measured once with
+a small synthetic registration (see calibrate) and stored in a JSON file
+"""
+
+import os
+import json
+import math
+import socket
+import operator
+import functools
+import platform
+import datetime
+import tempfile
+import collections
+from pathlib import Path
+
+from .binaries import findBinary
+from .parameters import RegistrationParameters
+
+
+MINIMUM_LEVEL_SIZE = 32  # voxels per side of the coarsest level
+DEFAULT_SPACING = 5  # voxels, as reg_f3d
+MAXIMUM_CONTROL_POINTS = 40 ** 3
+TIME_BUDGET = 600  # seconds
+MEMORY_FRACTION = 0.8
+
+# NiftyReg defaults (-maxit)
+DEFAULT_ITERATIONS = {'linear': 5, 'non-linear': 150}
+
+CALIBRATION_SIZE = 64
+CALIBRATION_ITERATIONS = {'linear': 5, 'non-linear': 20}
+SPEEDUP_TOLERANCE = 0.9
+
+
+def getPyramidShapesMap(shape, minimumSize=MINIMUM_LEVEL_SIZE):
+    """
+    Shapes of the pyramid levels, halving the image until a side is smaller
+    than minimumSize. The full resolution shape is level 0
+    """
+
+    def halve(shape):
+        return [int(round(float(n)/2)) for n in shape]
+
+    level = 0
+    shapesMap = {level: list(shape)}
+    while True:
+        newShape = halve(shapesMap[level])
+        if min(newShape) < minimumSize:
+            break
+        level += 1
+        shapesMap[level] = newShape
+    return shapesMap
+
+
+def getNumberOfVoxels(shape):
+    return functools.reduce(operator.mul, shape, 1)
+
+
+def getAvailableMemory():
+    """
+    Memory that can be used without swapping, in bytes, or None if it is
+    not known
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def getMachineDescription():
+    return collections.OrderedDict([
+        ('node', socket.gethostname()),
+        ('system', platform.system()),
+        ('processor', platform.machine()),
+        ('cores', os.cpu_count() or 1),
+    ])
+
+
+class MachineProfile(object):
+    """
+    Speed of NiftyReg on a machine: the time of the calibration registration
+    for each number of threads, and the voxels times iterations processed
+    per second by each binary with the best number of threads
+    """
+
+    def __init__(self, machine, threadTimes, voxelIterationsPerSecond, date=None):
+        self.machine = collections.OrderedDict(machine)
+        self.threadTimes = {int(k): float(v) for k, v in threadTimes.items()}
+        self.voxelIterationsPerSecond = dict(voxelIterationsPerSecond)
+        self.date = datetime.datetime.now().isoformat() if date is None else date
+
+
+    def isCurrentMachine(self):
+        return self.machine == getMachineDescription()
+
+
+    def getBestThreads(self, tolerance=SPEEDUP_TOLERANCE):
+        """
+        Fewest threads that are nearly as fast as the fastest number of
+        threads, as more threads than that only keep the cores busy
+        """
+        if not self.threadTimes:
+            return self.machine['cores']
+        bestTime = min(self.threadTimes.values())
+        for threads in sorted(self.threadTimes):
+            if bestTime / self.threadTimes[threads] >= tolerance:
+                return threads
+
+
+    def estimateTime(self, kind, numberOfVoxels, iterations=None):
+        """
+        Seconds for a registration level, or None if the binary was not
+        calibrated. kind is 'linear' or 'non-linear'
+        """
+        speed = self.voxelIterationsPerSecond.get(kind)
+        if not speed:
+            return None
+        if iterations is None:
+            iterations = DEFAULT_ITERATIONS[kind]
+        return numberOfVoxels * iterations / speed
+
+
+    def toDict(self):
+        return collections.OrderedDict([
+            ('machine', self.machine),
+            ('date', self.date),
+            ('threadTimes', {str(k): v for k, v in sorted(self.threadTimes.items())}),
+            ('voxelIterationsPerSecond', self.voxelIterationsPerSecond),
+        ])
+
+
+    def write(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(path), 'w') as f:
+            json.dump(self.toDict(), f, indent=2)
+
+
+    @classmethod
+    def read(cls, path):
+        with open(str(path)) as f:
+            return cls(**json.load(f))
+
+
+def writeCalibrationImages(directory, size=CALIBRATION_SIZE):
+    """
+    Writes a smooth blob and a translated copy of it
+    """
+    import numpy as np
+    import SimpleITK as sitk
+
+    paths = []
+    grid = np.indices((size, size, size), dtype=np.float32)
+    for name, shift in (('reference', 0), ('floating', 3)):
+        center = size / 2. + shift
+        distances = sum((g - center)**2 for g in grid)
+        array = 1000 * np.exp(-distances / (2 * (size / 6.)**2))
+        path = str(Path(directory) / '{}.nii'.format(name))
+        sitk.WriteImage(sitk.GetImageFromArray(array.astype(np.float32)), path)
+        paths.append(path)
+    return paths
+
+
+def getCalibrationThreads(numberOfCores=None):
+    if numberOfCores is None:
+        numberOfCores = os.cpu_count() or 1
+    threads = []
+    n = 1
+    while n < numberOfCores:
+        threads.append(n)
+        n *= 2
+    return threads + [numberOfCores]
+
+
+def calibrate(size=CALIBRATION_SIZE, threadCounts=None, directory=None):
+    """
+    Runs short registrations of synthetic images to measure the speed of the
+    NiftyReg binaries on this machine. reg_aladin is run with each number of
+    threads, reg_f3d only with the best one
+    """
+    # Imported here to avoid a circular import
+    from .registration import Registration, TRANSFORMATIONS_MAP
+
+    if findBinary(TRANSFORMATIONS_MAP['Rigid']) is None:
+        raise RuntimeError('reg_aladin was not found, so NiftyReg can not be calibrated')
+    if threadCounts is None:
+        threadCounts = getCalibrationThreads()
+
+    with tempfile.TemporaryDirectory(dir=directory) as tempDir:
+        refPath, floPath = writeCalibrationImages(tempDir, size=size)
+        numberOfVoxels = size ** 3
+
+        def run(transformationType, threads, **kwargs):
+            parameters = RegistrationParameters(transformationType, pyramidLevels=(1, 1), threads=threads, **kwargs)
+            registration = Registration(refPath, floPath, parameters, outputDir=tempDir)
+            registration.run()
+            if not registration.succeeded():
+                raise RuntimeError('Calibration failed:\n{}'.format(registration.errorOutput))
+            return registration.elapsedTime
+
+        iterations = CALIBRATION_ITERATIONS['linear']
+        threadTimes = {}
+        for threads in threadCounts:
+            threadTimes[threads] = run('Rigid', threads, linearIterations=iterations)
+        profile = MachineProfile(getMachineDescription(), threadTimes, {})
+        bestThreads = profile.getBestThreads()
+        speeds = profile.voxelIterationsPerSecond
+        speeds['linear'] = numberOfVoxels * iterations / threadTimes[bestThreads]
+        if findBinary(TRANSFORMATIONS_MAP['Non-linear']) is not None:
+            iterations = CALIBRATION_ITERATIONS['non-linear']
+            seconds = run('Non-linear', bestThreads, nonLinearIterations=iterations)
+            speeds['non-linear'] = numberOfVoxels * iterations / seconds
+    return profile
+
+
+def getMachineProfile(path, calibrateIfNeeded=True):
+    """
+    Reads the profile stored in path. If there is none, or it was measured on
+    another machine, NiftyReg is calibrated and the profile is stored
+    """
+    path = Path(path)
+    if path.is_file():
+        try:
+            profile = MachineProfile.read(path)
+        except (ValueError, TypeError, KeyError):
+            profile = None
+        if profile is not None and profile.isCurrentMachine():
+            return profile
+    if not calibrateIfNeeded:
+        return None
+    profile = calibrate()
+    profile.write(path)
+    return profile
+
+
+def getTunedParameters(parameters, referenceShape, floatingShape, profile=None,
+                       availableMemory=None, numberOfCores=None, timeBudget=TIME_BUDGET, **memoryOptions):
+    """
+    Returns a copy of the parameters with the pyramid levels, the number of
+    threads and, for non-linear registrations, the control point spacing
+    chosen for images of these shapes (x, y, z). The threads and the spacing
+    are only chosen if they are not set in the parameters.
+    All the pyramid levels whose sides are at least MINIMUM_LEVEL_SIZE are
+    created, and the finest ones are skipped if they would not fit in the
+    available memory (see estimateMemory, which gets the keyword arguments)
+    or, with a profile, in the time budget
+    """
+    # Imported here to avoid a circular import
+    from .memory import estimateMemory
+
+    kind = 'linear' if parameters.isLinear() else 'non-linear'
+    if numberOfCores is None:
+        numberOfCores = os.cpu_count() or 1
+    if parameters.isLinear():
+        iterations = parameters.linearIterations
+    else:
+        iterations = parameters.nonLinearIterations
+    referenceMap = getPyramidShapesMap(referenceShape)
+    floatingMap = getPyramidShapesMap(floatingShape)
+    # Level 0 is the full resolution, so the coarsest level is the last one
+    numberOfLevels = min(max(referenceMap), max(floatingMap)) + 1
+
+    def getLevelVoxels(level):
+        return getNumberOfVoxels(referenceMap[level]) + getNumberOfVoxels(floatingMap[level])
+
+    def fits(levelsToPerform):
+        finestLevel = numberOfLevels - levelsToPerform
+        if availableMemory is not None:
+            levelParameters = parameters.copy(pyramidLevels=(numberOfLevels, levelsToPerform))
+            estimate = estimateMemory(levelParameters, referenceShape, floatingShape, **memoryOptions)
+            if estimate.peak > MEMORY_FRACTION * availableMemory:
+                return False
+        if profile is not None and timeBudget is not None:
+            levels = range(finestLevel, numberOfLevels)
+            seconds = profile.estimateTime(kind, sum(getLevelVoxels(level) for level in levels), iterations)
+            if seconds is not None and seconds > timeBudget:
+                return False
+        return True
+
+    levelsToPerform = numberOfLevels
+    while levelsToPerform > 1 and not fits(levelsToPerform):
+        levelsToPerform -= 1
+    tuned = {'pyramidLevels': (numberOfLevels, levelsToPerform)}
+
+    if parameters.threads is None:
+        tuned['threads'] = numberOfCores if profile is None else min(numberOfCores, profile.getBestThreads())
+
+    if not parameters.isLinear() and parameters.controlPointSpacing is None:
+        # Keep the number of control points bounded for large images
+        ratio = getNumberOfVoxels(referenceShape) / float(MAXIMUM_CONTROL_POINTS)
+        spacing = max(DEFAULT_SPACING, int(math.ceil(ratio ** (1 / 3.))))
+        tuned['controlPointSpacing'] = -spacing  # negative means voxels
+
+    return parameters.copy(**tuned)
+
+
+def getTuningDescription(parameters):
+    ln, lp = parameters.pyramidLevels
+    text = 'Auto-tuned: {} of {} pyramid levels, {} threads'.format(lp, ln, parameters.threads)
+    if not parameters.isLinear() and parameters.controlPointSpacing is not None:
+        spacing = parameters.controlPointSpacing
+        units = 'voxels' if spacing < 0 else 'mm'
+        text += ', control point spacing {:g} {}'.format(abs(spacing), units)
+    return text
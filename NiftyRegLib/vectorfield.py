@@ -0,0 +1,223 @@
+import numpy as np
+import SimpleITK as sitk
+
+from .nifti import readNiftiHeader, readNiftiArray, iterNiftiChunks
+from .resampling import readGrid, resampleWithTransform
+
+
+# Values of intent_p1 in the transformation files written by NiftyReg
+# (intent_name is 'NREG_TRANS')
+DEF_FIELD = 0
+DISP_FIELD = 1
+CUB_SPLINE_GRID = 2
+
+RAS_TO_LPS = np.diag([-1, -1, 1])
+
+
+class VectorField(object):
+    """
+    A NiftyReg control point grid or a dense vector field, with the vectors
+    stored as displacements in RAS coordinates.
+    If the file does not say what it contains, it is considered a dense
+    displacement field when its shape is the reference shape and a grid of
+    control point positions (written by reg_f3d) otherwise
+    """
+
+    def __init__(self, path, referenceShape=None):
+        self.path = str(path)
+        self.header = readNiftiHeader(path)
+        dimensions = list(self.header.getDimensions()) + [1] * 5
+        self.shape = tuple(dimensions[:3][::-1])  # (z, y, x)
+        self.numberOfComponents = dimensions[4]
+        if self.numberOfComponents not in (2, 3):
+            raise ValueError('Not a vector field: {}'.format(path))
+
+        if self.header.getIntentName() == 'NREG_TRANS':
+            kind = int(self.header['intent_p1'])
+            if kind not in (DEF_FIELD, DISP_FIELD, CUB_SPLINE_GRID):
+                raise ValueError('NiftyReg transformation type not supported: {}'.format(kind))
+            self.isSplineGrid = kind == CUB_SPLINE_GRID
+            self.storesPositions = kind != DISP_FIELD
+        else:
+            isDense = referenceShape is not None and tuple(referenceShape) == self.shape
+            self.isSplineGrid = not isDense
+            self.storesPositions = not isDense
+
+        self.affine = self.header.getAffine()
+        self.spacing = np.linalg.norm(self.affine[:3, :3], axis=0)
+        self.direction = self.affine[:3, :3] / self.spacing
+        self.origin = self.affine[:3, 3].copy()
+
+
+    def getDisplacement(self, out=None, lps=False):
+        """
+        Returns an array of shape (z, y, x, 3). It is written into out if
+        given, which can be a view of the memory of a VTK array.
+        The file is read in chunks and the conversions are done in place, one
+        slice at a time, so the peak memory is close to the size of the output
+        """
+        if out is None:
+            out = np.empty(self.shape + (3,), dtype=np.float32)
+        else:
+            out = out.reshape(self.shape + (3,))
+
+        # NIfTI vectors are the fifth dimension, so the components come first
+        numberOfPoints = int(np.prod(self.shape))
+        flatOut = out.reshape(numberOfPoints, 3)
+        for start, chunk in iterNiftiChunks(self.path, header=self.header):
+            while chunk.size:
+                component, index = divmod(start, numberOfPoints)
+                n = min(chunk.size, numberOfPoints - index)
+                flatOut[index:index + n, component] = chunk[:n]
+                chunk = chunk[n:]
+                start += n
+        if self.numberOfComponents == 2:
+            out[..., 2] = 0
+        for k in range(self.shape[0]):
+            self._toDisplacement(out[k], k, lps)
+        return out
+
+
+    def getDisplacementSlab(self, start, stop, lps=False):
+        """
+        Returns the slices start:stop of getDisplacement, as float64. Only
+        these slices are read if the file is not compressed
+        """
+        vectors = readNiftiArray(self.path, header=self.header)
+        vectors = vectors.reshape((self.numberOfComponents,) + self.shape)
+        out = np.zeros((stop - start,) + self.shape[1:] + (3,))
+        for component in range(self.numberOfComponents):
+            out[..., component] = vectors[component, start:stop]
+        for k in range(start, stop):
+            self._toDisplacement(out[k - start], k, lps)
+        return out
+
+
+    def _toDisplacement(self, vectors, k, lps):
+        """
+        Converts in place the vectors of slice k, in RAS, to displacements
+        """
+        if self.storesPositions:
+            j, i = np.ogrid[:self.shape[1], :self.shape[2]]
+            for component in range(self.numberOfComponents):
+                row = self.affine[component]
+                vectors[..., component] -= row[0] * i + row[1] * j + (row[2] * k + row[3])
+        if lps:
+            vectors[..., :2] *= -1
+
+
+    def getSimpleITKTransform(self):
+        """
+        Returns a SimpleITK (LPS) transform equivalent to the vector field
+        """
+        origin = RAS_TO_LPS.dot(self.origin)
+        direction = RAS_TO_LPS.dot(self.direction)
+        displacement = self.getDisplacement(lps=True)
+
+        def getImage(array):
+            image = sitk.GetImageFromArray(array, isVector=array.ndim == 4)
+            image.SetOrigin(origin.tolist())
+            image.SetSpacing(self.spacing.tolist())
+            image.SetDirection(direction.ravel().tolist())
+            return image
+
+        if self.isSplineGrid:
+            coefficients = [getImage(displacement[..., c].astype(np.float64)) for c in range(3)]
+            return sitk.BSplineTransform(coefficients, 3)
+        else:
+            fieldImage = getImage(displacement.astype(np.float64))
+            return sitk.DisplacementFieldTransform(fieldImage)
+
+
+def getDisplacementFieldImage(vectorfieldPath, referenceImage):
+    """
+    Returns a SimpleITK displacement field in LPS coordinates on the grid of
+    the reference image
+    """
+    if referenceImage.GetDimension() == 2:
+        referenceImage = sitk.JoinSeries(referenceImage)
+    referenceShape = referenceImage.GetSize()[::-1]
+    transform = VectorField(vectorfieldPath, referenceShape=referenceShape).getSimpleITKTransform()
+    displacementImage = sitk.TransformToDisplacementField(
+        transform,
+        sitk.sitkVectorFloat64,
+        referenceImage.GetSize(),
+        referenceImage.GetOrigin(),
+        referenceImage.GetSpacing(),
+        referenceImage.GetDirection())
+    return sitk.Cast(displacementImage, sitk.sitkVectorFloat32)
+
+
+class ReferenceDisplacementField(object):
+    """
+    The displacement field of a vector field on the grid of a reference
+    image, in LPS coordinates, as an array of shape (z, y, x, 3) whose slices
+    are only computed when they are indexed along the first axis. A dense
+    field on the reference grid is read from the file and a control point
+    grid is evaluated by SimpleITK on the requested slices, so the whole
+    field is never in memory
+    """
+
+    def __init__(self, vectorfieldPath, referencePath):
+        size, origin, spacing, direction = readGrid(referencePath)
+        if len(size) == 2:
+            size, origin, spacing = tuple(size) + (1,), tuple(origin) + (0,), tuple(spacing) + (1,)
+            direction = (direction[0], direction[1], 0, direction[2], direction[3], 0, 0, 0, 1)
+        self.size, self.origin, self.spacing, self.direction = size, origin, spacing, direction
+        self.shape = tuple(size[::-1]) + (3,)
+        self.vectorField = VectorField(vectorfieldPath, referenceShape=self.shape[:3])
+        self.transform = None
+        if self.vectorField.isSplineGrid or self.vectorField.shape != self.shape[:3]:
+            self.transform = self.vectorField.getSimpleITKTransform()
+
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise IndexError('Only slices along the first axis are supported')
+        start, stop, step = index.indices(self.shape[0])
+        if step != 1:
+            raise IndexError('Only contiguous slices are supported')
+        stop = max(start, stop)
+        if stop == start:
+            return np.zeros((0,) + self.shape[1:])
+        if self.transform is None:
+            return self.vectorField.getDisplacementSlab(start, stop, lps=True)
+        indexToWorld = np.reshape(self.direction, (3, 3)) * self.spacing
+        origin = np.asarray(self.origin) + indexToWorld.dot([0, 0, start])
+        displacementImage = sitk.TransformToDisplacementField(
+            self.transform,
+            sitk.sitkVectorFloat64,
+            self.size[:2] + (stop - start,),
+            origin.tolist(),
+            self.spacing,
+            self.direction)
+        return sitk.GetArrayFromImage(displacementImage)
+
+
+def writeDisplacementField(vectorfieldPath, referencePath, displacementFieldPath):
+    referenceImage = sitk.ReadImage(str(referencePath))
+    displacementImage = getDisplacementFieldImage(vectorfieldPath, referenceImage)
+    sitk.WriteImage(displacementImage, str(displacementFieldPath))
+
+
+def resampleWithVectorField(referencePath, floatingPath, vectorfieldPath, outputPath=None, interpolation='linear'):
+    """
+    Resamples the floating image on the reference grid with a control point
+    grid or a dense vector field, like reg_resample
+    """
+    size, origin, spacing, direction = readGrid(referencePath)
+    is2D = len(size) == 2
+    if is2D:
+        size, origin, spacing = tuple(size) + (1,), tuple(origin) + (0,), tuple(spacing) + (1,)
+        direction = (direction[0], direction[1], 0, direction[2], direction[3], 0, 0, 0, 1)
+    transform = VectorField(vectorfieldPath, referenceShape=size[::-1]).getSimpleITKTransform()
+    floatingImage = sitk.ReadImage(str(floatingPath))
+    if is2D:
+        floatingImage = sitk.JoinSeries(floatingImage)
+    resampledImage = resampleWithTransform(floatingImage, transform, (size, origin, spacing, direction),
+                                           interpolation=interpolation)
+    if is2D:
+        resampledImage = resampledImage[:, :, 0]
+    if outputPath is not None:
+        sitk.WriteImage(resampledImage, str(outputPath))
+    return resampledImage
@@ -0,0 +1,51 @@
+"""
+Conversions between VTK and NumPy matrices. Elements are copied in bulk with
+DeepCopy instead of one GetElement/SetElement call per element
+"""
+
+import numpy as np
+import vtk
+
+
+def getVTKMatrixClass(size):
+    if size == 3:
+        return vtk.vtkMatrix3x3
+    elif size == 4:
+        return vtk.vtkMatrix4x4
+    else:
+        raise ValueError('Unknown matrix dimensions.')
+
+
+def getNumpyMatrixFromVTKMatrix(vtkMatrix):
+    size = 4 if isinstance(vtkMatrix, vtk.vtkMatrix4x4) else 3
+    matrix = np.identity(size)
+    vtkMatrix.DeepCopy(matrix.ravel(), vtkMatrix)
+    return matrix
+
+
+def getVTKMatrixFromNumpyMatrix(numpyMatrix):
+    numpyMatrix = np.ascontiguousarray(numpyMatrix, dtype=np.float64)
+    vtkMatrix = getVTKMatrixClass(len(numpyMatrix))()
+    vtkMatrix.DeepCopy(numpyMatrix.ravel())
+    return vtkMatrix
+
+
+def getNumpyMatricesFromVTKMatrices(vtkMatrices):
+    """
+    Returns an (N, 4, 4) array
+    """
+    vtkMatrices = list(vtkMatrices)
+    matrices = np.empty((len(vtkMatrices), 4, 4))
+    for matrix, vtkMatrix in zip(matrices, vtkMatrices):
+        vtkMatrix.DeepCopy(matrix.ravel(), vtkMatrix)
+    return matrices
+
+
+def getVTKMatricesFromNumpyMatrices(matrices):
+    matrices = np.ascontiguousarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    vtkMatrices = []
+    for matrix in matrices:
+        vtkMatrix = vtk.vtkMatrix4x4()
+        vtkMatrix.DeepCopy(matrix.ravel())
+        vtkMatrices.append(vtkMatrix)
+    return vtkMatrices
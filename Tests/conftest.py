@@ -0,0 +1,9 @@
+"""
+Tests of the Slicer-independent NiftyRegLib package. Run them from the
+repository with python -m pytest Tests
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,54 @@
+"""
+Writing of small NIfTI files for the tests, independent of the writer of
+NiftyRegLib so that the reader is tested against headers built field by field
+"""
+
+import gzip
+
+import numpy as np
+
+from NiftyRegLib.nifti import NIFTI1_HEADER_DTYPE, NIFTI2_HEADER_DTYPE
+
+
+DATA_TYPE_CODES = {
+    np.dtype(np.uint8): 2,
+    np.dtype(np.int16): 4,
+    np.dtype(np.int32): 8,
+    np.dtype(np.float32): 16,
+    np.dtype(np.float64): 64,
+}
+MAGIC = {1: b'n+1', 2: b'n+2\0\r\n\x1a\n'}
+
+
+def writeNifti(path, array, affine=None, version=1, byteOrder='<',
+               intent=None, scaling=None):
+    """
+    Writes a single-file NIfTI image. array is in C order (..., z, y, x).
+    The affine is written as the sform. intent is (name, intent_p1) and
+    scaling is (slope, intercept)
+    """
+    headerDtype = {1: NIFTI1_HEADER_DTYPE, 2: NIFTI2_HEADER_DTYPE}[version]
+    fields = np.zeros(1, headerDtype.newbyteorder(byteOrder))[0]
+    fields['sizeof_hdr'] = headerDtype.itemsize
+    fields['magic'] = MAGIC[version]
+    fields['dim'] = 1
+    fields['dim'][0] = array.ndim
+    fields['dim'][1:array.ndim + 1] = array.shape[::-1]
+    dtype = np.dtype(array.dtype).newbyteorder('=')
+    fields['datatype'] = DATA_TYPE_CODES[dtype]
+    fields['bitpix'] = 8 * dtype.itemsize
+    fields['vox_offset'] = headerDtype.itemsize + 4
+    fields['pixdim'][:4] = 1
+    if affine is not None:
+        fields['pixdim'][1:4] = np.linalg.norm(affine[:3, :3], axis=0)
+        fields['sform_code'] = 1
+        for row, key in enumerate(('srow_x', 'srow_y', 'srow_z')):
+            fields[key] = affine[row]
+    if intent is not None:
+        fields['intent_name'], fields['intent_p1'] = intent
+    if scaling is not None:
+        fields['scl_slope'], fields['scl_inter'] = scaling
+    data = fields.tobytes() + b'\0' * 4 + array.astype(dtype.newbyteorder(byteOrder)).tobytes()
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(str(path), 'wb') as f:
+        f.write(data)
@@ -0,0 +1,67 @@
+import datetime
+
+import numpy as np
+
+from NiftyRegLib.cache import ResultCache, getCommandKey, getFileDigest, getArrayDigest
+from NiftyRegLib.parameters import RegistrationParameters
+from NiftyRegLib.registration import Registration
+
+
+def getKey(tmp_path, outputName, dateTime=None, **kwargs):
+    parameters = RegistrationParameters('Affine', **kwargs)
+    registration = Registration('reference.nii', 'floating.nii', parameters,
+                                outputDir=tmp_path / outputName, dateTime=dateTime)
+    cache = ResultCache(tmp_path / 'cache')
+    return cache.getKey(registration, referenceDigest='reference', floatingDigest='floating')
+
+
+def testCommandKeyWithoutThreads(tmp_path):
+    parameters = RegistrationParameters('Affine', threads=4)
+    registration = Registration('reference.nii', 'floating.nii', parameters, outputDir=tmp_path)
+    assert '-omp' in registration.getCommandLineList()
+    command = getCommandKey(registration)
+    assert '-omp' not in command
+    assert '4' not in command
+    assert '<reference>' in command and '<floating>' in command
+
+
+def testKeyIgnoresThreadsAndPaths(tmp_path):
+    key = getKey(tmp_path, 'first', threads=1)
+    assert key == getKey(tmp_path, 'first', threads=1)
+    assert key == getKey(tmp_path, 'second', threads=8)
+    assert key == getKey(tmp_path, 'third', dateTime=datetime.datetime(2020, 1, 2, 3, 4, 5))
+    assert key == getKey(tmp_path, 'fourth')
+
+
+def testKeyDependsOnOptions(tmp_path):
+    key = getKey(tmp_path, 'output')
+    assert key != getKey(tmp_path, 'output', pyramidLevels=(3, 3))
+    assert key != getKey(tmp_path, 'output', linearIterations=10)
+
+    # The cropped inputs and the masks are not in the command line
+    thresholds = {'referenceThresholds': (10, 100), 'floatingThresholds': (10, 100)}
+    key = getKey(tmp_path, 'output', cropToThresholds=True, cropMargin=0, **thresholds)
+    assert key != getKey(tmp_path, 'output', cropToThresholds=True, cropMargin=50, **thresholds)
+    assert key != getKey(tmp_path, 'output', cropToThresholds=True, cropMargin=0,
+                         referenceThresholds=(20, 100), floatingThresholds=(10, 100))
+    assert key != getKey(tmp_path, 'output', cropToThresholds=True, cropMargin=0, useMasks=True, **thresholds)
+    assert key != getKey(tmp_path, 'output', **thresholds)
+
+
+def testFileDigest(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'abc' * 1000)
+    digest = getFileDigest(path)
+    assert digest == getFileDigest(path)
+    path.write_bytes(b'abd' * 1000)
+    assert digest != getFileDigest(path)
+
+
+def testArrayDigest():
+    array = np.arange(60, dtype=np.float32).reshape(3, 4, 5)
+    digest = getArrayDigest(array, (1, 1, 1))
+    assert digest == getArrayDigest(array.copy(), (1, 1, 1))
+    assert digest == getArrayDigest(np.asfortranarray(array), (1, 1, 1))
+    assert digest != getArrayDigest(array, (1, 1, 2))
+    assert digest != getArrayDigest(array.astype(np.float64), (1, 1, 1))
+    assert digest != getArrayDigest(array.reshape(3, 5, 4), (1, 1, 1))
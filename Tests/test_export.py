@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from NiftyRegLib.export import isLosslessInt16, getExportDataType, needsExport, writeExportImage
+from NiftyRegLib.nifti import readNiftiHeader, readNiftiArray
+
+
+@pytest.mark.parametrize('values, expected', [
+    ([0, 1, -1], True),
+    ([-32768, 32767], True),
+    ([32768], False),
+    ([-32769], False),
+    ([0.5], False),
+    ([np.nan], False),
+    ([np.inf], False),
+    ([-np.inf], False),
+])
+def testLosslessInt16(values, expected):
+    assert isLosslessInt16(np.array(values, dtype=np.float64)) == expected
+
+
+def testLosslessInt16Integers():
+    assert isLosslessInt16(np.array([200], dtype=np.uint8))
+    assert isLosslessInt16(np.array([-5, 5], dtype=np.int64))
+    assert not isLosslessInt16(np.array([40000], dtype=np.int64))
+    assert not isLosslessInt16(np.array([1 + 1j]))
+
+
+def testLosslessInt16LastSlab():
+    array = np.zeros((10, 4, 4))
+    array[-1, -1, -1] = np.nan
+    # Slabs of one slice, so that only the last one fails
+    assert not isLosslessInt16(array, slabSize=4 * 4 * array.itemsize)
+
+
+def testExportDataType():
+    assert getExportDataType(np.zeros(3, dtype=np.float64)) == np.int16
+    assert getExportDataType(np.array([0.5, 1])) == np.float32
+    assert getExportDataType(np.array([np.nan])) == np.float32
+    assert getExportDataType(np.array([70000], dtype=np.int64)) == np.float32
+    assert getExportDataType(np.array([1.5], dtype=np.float32)) == np.float32
+    assert getExportDataType(np.array([70000], dtype=np.int32)) == np.int32
+    assert getExportDataType(np.array([1], dtype='>i2')) == np.int16
+    assert needsExport(np.float64) and needsExport(np.int64)
+    assert not needsExport(np.float32) and not needsExport(np.int16)
+
+
+@pytest.mark.parametrize('values, dtype', [
+    (np.arange(60, dtype=np.float64) - 30, np.int16),
+    (np.linspace(0, 1, 60), np.float32),
+])
+def testWriteExportImage(tmp_path, values, dtype):
+    path = tmp_path / 'image.nii'
+    affine = np.diag([2., 3, 4, 1])
+    affine[:3, 3] = 1, 2, 3
+    array = values.reshape(3, 4, 5)
+    assert writeExportImage(path, array, affine=affine) == dtype
+    header = readNiftiHeader(path)
+    assert header.getNumpyDataType() == dtype
+    np.testing.assert_allclose(header.getAffine(), affine)
+    np.testing.assert_allclose(readNiftiArray(path), array.astype(dtype))
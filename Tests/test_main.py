@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+from NiftyRegLib.__main__ import main
+
+
+def testListRunsWithoutDatabase(capsys):
+    with pytest.raises(SystemExit):
+        main(['reference.nii', 'floating.nii', '--list-runs'])
+    assert '--database' in capsys.readouterr().err
+
+
+def testSavePresetWithoutRunning(tmp_path):
+    presetPath = tmp_path / 'preset.json'
+    outputDir = tmp_path / 'output'
+    # The images do not exist, so running a registration would fail
+    assert main(['reference.nii', 'floating.nii', '--save-preset', str(presetPath),
+                 '--linear-iterations', '3', '-o', str(outputDir)]) == 0
+    assert json.loads(presetPath.read_text()) == {'linearIterations': 3}
+    assert not outputDir.exists()
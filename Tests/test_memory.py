@@ -0,0 +1,54 @@
+import pytest
+
+from NiftyRegLib.memory import estimateMemory, fitMemoryBudget, formatBytes, getNumberOfControlPoints
+from NiftyRegLib.parameters import RegistrationParameters
+
+
+SHAPE = 512, 512, 400  # (x, y, z)
+GIB = 2**30
+
+
+def getPeak(parameters):
+    return estimateMemory(parameters, SHAPE, SHAPE, referenceItemSize=2, floatingItemSize=2).peak
+
+
+def testFewerLevelsNeedLessMemory():
+    peaks = [getPeak(RegistrationParameters('Affine', pyramidLevels=(3, lp))) for lp in (3, 2, 1)]
+    assert peaks[0] > peaks[1] > peaks[2]
+
+
+@pytest.mark.parametrize('budget', [None, 100 * GIB])
+def testFitWithoutChanges(budget):
+    parameters = RegistrationParameters('Affine', pyramidLevels=(3, 3))
+    fitted, estimate = fitMemoryBudget(parameters, SHAPE, SHAPE, budget)
+    assert fitted is parameters
+    assert estimate.peak == estimateMemory(parameters, SHAPE, SHAPE).peak
+
+
+def testFitSkipsFinestLevels():
+    parameters = RegistrationParameters('Affine', pyramidLevels=(3, 3))
+    budget = getPeak(parameters.copy(pyramidLevels=(3, 2)))
+    fitted, estimate = fitMemoryBudget(parameters, SHAPE, SHAPE, budget,
+                                       referenceItemSize=2, floatingItemSize=2)
+    assert fitted.pyramidLevels == (3, 2)
+    assert estimate.peak <= budget
+    assert parameters.pyramidLevels == (3, 3)
+
+
+def testFitFails():
+    parameters = RegistrationParameters('Affine', pyramidLevels=(3, 3))
+    with pytest.raises(ValueError, match='needs about'):
+        fitMemoryBudget(parameters, SHAPE, SHAPE, GIB / 4)
+
+
+def testNumberOfControlPoints():
+    # Three more control points than intervals on each axis
+    assert getNumberOfControlPoints((50, 50, 50), spacing=-5) == 13 ** 3
+    assert getNumberOfControlPoints((50, 50, 50), spacing=10, voxelSpacing=(2, 2, 2)) == 13 ** 3
+
+
+def testFormatBytes():
+    assert formatBytes(512) == '512.0 bytes'
+    assert formatBytes(1536) == '1.5 KiB'
+    assert formatBytes(3 * GIB) == '3.0 GiB'
+    assert formatBytes(2 * 1024 * GIB) == '2.0 TiB'
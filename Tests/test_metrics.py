@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from NiftyRegLib.metrics import computeJacobianStatistics, computeRegistrationMetrics
+from NiftyRegLib.vectorfield import DISP_FIELD
+
+from images import writeNifti
+from test_vectorfield import SHAPE, getAffine, writeVectorField
+
+
+def getDeterminants(displacement, spacing):
+    """
+    Determinants of the Jacobian of a field on a grid without rotation
+    """
+    gradients = np.stack([np.gradient(displacement, axis=axis) / spacing[2 - axis] for axis in (2, 1, 0)], axis=-1)
+    return np.linalg.det(gradients + np.identity(3))
+
+
+def testJacobianStatistics():
+    spacing = 2., 1.5, 3.
+    displacement = np.random.RandomState(0).normal(scale=0.3, size=SHAPE + (3,))
+    reference = np.random.RandomState(1).uniform(size=SHAPE)
+    determinants = getDeterminants(displacement, spacing)
+    # Slabs of a single slice, to test the halo
+    statistics = computeJacobianStatistics(displacement, spacing, np.identity(3), slabSize=1)
+    assert statistics['jacobianMin'] == pytest.approx(determinants.min())
+    assert statistics['jacobianMean'] == pytest.approx(determinants.mean())
+    assert statistics['jacobianStd'] == pytest.approx(determinants.std())
+    masked = computeJacobianStatistics(displacement, spacing, np.identity(3), slabSize=1,
+                                       referenceArray=reference, referenceThresholds=(0.5, 1))
+    determinants = determinants[reference >= 0.5]
+    assert masked['jacobianMax'] == pytest.approx(determinants.max())
+    assert masked['jacobianMean'] == pytest.approx(determinants.mean())
+    assert masked['jacobianFoldingFraction'] == pytest.approx(np.mean(determinants <= 0))
+    with pytest.raises(ValueError):
+        computeJacobianStatistics(displacement, spacing, np.identity(3),
+                                  referenceArray=reference, referenceThresholds=(2, 3))
+
+
+def testRegistrationMetricsInMask(tmp_path):
+    affine = getAffine()
+    reference = np.zeros(SHAPE, dtype=np.float32)
+    reference[1:3] = 1
+    referencePath = tmp_path / 'reference.nii'
+    writeNifti(referencePath, reference, affine=affine)
+    # Folded outside the mask only
+    displacement = np.zeros(SHAPE + (3,))
+    displacement[:, :, :, 0] = np.arange(SHAPE[2]) * -4.
+    displacement[1:3] = 0
+    transformPath = tmp_path / 'displacement.nii'
+    writeVectorField(transformPath, displacement, affine, kind=DISP_FIELD)
+    metrics = computeRegistrationMetrics(referencePath, transformPath=transformPath)
+    assert metrics['jacobianFoldingFraction'] > 0
+    metrics = computeRegistrationMetrics(referencePath, transformPath=transformPath, referenceThresholds=(1, 1))
+    assert metrics['jacobianFoldingFraction'] == 0
+    assert metrics['jacobianMean'] == pytest.approx(1)
@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+
+from NiftyRegLib.nifti import (
+    NiftiHeader,
+    makeNiftiHeader,
+    readNiftiHeader,
+    getCachedNiftiHeader,
+    clearNiftiHeaderCache,
+    readNiftiArray,
+    writeNiftiArray,
+    iterNiftiChunks,
+)
+
+from images import writeNifti
+
+
+def getAffine():
+    angle = 0.3
+    rotation = np.array([
+        [np.cos(angle), -np.sin(angle), 0],
+        [np.sin(angle), np.cos(angle), 0],
+        [0, 0, 1],
+    ])
+    affine = np.identity(4)
+    affine[:3, :3] = rotation.dot(np.diag([0.8, 1.2, 2]))
+    affine[:3, 3] = 10, -5, 3
+    return affine
+
+
+@pytest.mark.parametrize('version', [1, 2])
+@pytest.mark.parametrize('byteOrder', ['<', '>'])
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def testRoundTrip(tmp_path, version, byteOrder, extension):
+    path = tmp_path / ('image' + extension)
+    array = np.linspace(-1, 1, 4 * 5 * 6, dtype=np.float32).reshape(4, 5, 6)
+    affine = getAffine()
+    writeNifti(path, array, affine=affine, version=version, byteOrder=byteOrder)
+    header = readNiftiHeader(path)
+    assert header.getVersion() == version
+    assert header.getByteOrder() == byteOrder
+    assert header.getDimensions() == (6, 5, 4)
+    assert header.getNumpyDataType() == np.dtype(np.float32).newbyteorder(byteOrder)
+    np.testing.assert_allclose(header.getAffine(), affine, atol=1e-6)
+    np.testing.assert_array_equal(readNiftiArray(path), array)
+    np.testing.assert_array_equal(readNiftiArray(path, mmap=False), array)
+
+
+def testMemoryMap(tmp_path):
+    path = tmp_path / 'image.nii'
+    array = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    writeNifti(path, array)
+    result = readNiftiArray(path)
+    assert isinstance(result, np.memmap)
+    assert not result.flags.writeable
+
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def testChunks(tmp_path, extension):
+    path = tmp_path / ('image' + extension)
+    array = np.arange(60, dtype=np.int32).reshape(3, 4, 5)
+    writeNifti(path, array, byteOrder='>')
+    chunks = list(iterNiftiChunks(path, chunkSize=28))
+    assert [start for start, chunk in chunks] == list(range(0, 60, 7))
+    np.testing.assert_array_equal(np.concatenate([chunk for start, chunk in chunks]), array.reshape(-1))
+
+
+def testScaling(tmp_path):
+    path = tmp_path / 'image.nii'
+    array = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    writeNifti(path, array, scaling=(0.5, 10))
+    expected = array * 0.5 + 10
+    np.testing.assert_allclose(readNiftiArray(path), expected)
+    chunks = [chunk for start, chunk in iterNiftiChunks(path, chunkSize=10)]
+    np.testing.assert_allclose(np.concatenate(chunks), expected.reshape(-1))
+
+
+def testDefaultAffine(tmp_path):
+    path = tmp_path / 'image.nii'
+    writeNifti(path, np.zeros((2, 3, 4), dtype=np.uint8))
+    np.testing.assert_array_equal(readNiftiHeader(path).getAffine(), np.identity(4))
+
+
+@pytest.mark.parametrize('byteOrder', ['<', '>'])
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def testWrite(tmp_path, byteOrder, extension):
+    """
+    The written image keeps the byte order and the fields of the template
+    """
+    templatePath = tmp_path / 'template.nii'
+    writeNifti(templatePath, np.zeros((2, 2, 2), dtype=np.uint8), affine=getAffine(),
+               byteOrder=byteOrder, scaling=(2, 1))
+    path = tmp_path / ('image' + extension)
+    array = np.arange(60, dtype=np.int16).reshape(3, 4, 5)
+    affine = getAffine()
+    affine[:3, 3] = 1, 2, 3
+    writeNiftiArray(path, readNiftiHeader(templatePath), array, affine=affine)
+    header = readNiftiHeader(path)
+    assert header.getByteOrder() == byteOrder
+    assert header.getDimensions() == (5, 4, 3)
+    assert header.getScaling() is None
+    np.testing.assert_allclose(header.getAffine(), affine, atol=1e-6)
+    np.testing.assert_array_equal(readNiftiArray(path), array)
+
+
+def testWriteNiftiTwo(tmp_path):
+    templatePath = tmp_path / 'template.nii'
+    writeNifti(templatePath, np.zeros((2, 2, 2), dtype=np.uint8), version=2)
+    with pytest.raises(ValueError):
+        writeNiftiArray(tmp_path / 'image.nii', readNiftiHeader(templatePath), np.zeros((2, 2, 2)))
+
+
+def testCastWhileWriting(tmp_path):
+    path = tmp_path / 'image.nii'
+    array = np.arange(8 * 3 * 3, dtype=np.float64).reshape(8, 3, 3)
+    # Small slabs, so that the array is written in several pieces
+    writeNiftiArray(path, makeNiftiHeader(np.identity(4)), array[:, ::-1], dtype=np.float32, chunkSize=40)
+    result = readNiftiArray(path)
+    assert result.dtype == np.float32
+    np.testing.assert_array_equal(result, array[:, ::-1])
+
+
+@pytest.mark.parametrize('reflection', [1, -1])
+def testMakeNiftiHeader(reflection):
+    affine = getAffine()
+    affine[:3, 2] *= reflection
+    fields = makeNiftiHeader(affine).fields.copy()
+    np.testing.assert_allclose(NiftiHeader(fields).getAffine(), affine, atol=1e-6)
+    # The qform has the same geometry
+    fields['sform_code'] = 0
+    np.testing.assert_allclose(NiftiHeader(fields).getAffine(), affine, atol=1e-5)
+
+
+def testHeaderCache(tmp_path):
+    path = tmp_path / 'image.nii'
+    writeNifti(path, np.zeros((2, 3, 4), dtype=np.uint8))
+    clearNiftiHeaderCache()
+    header = getCachedNiftiHeader(path)
+    assert getCachedNiftiHeader(path) is header
+    # A modified file is read again
+    writeNifti(path, np.zeros((2, 3, 5), dtype=np.int16))
+    newHeader = getCachedNiftiHeader(path)
+    assert newHeader is not header
+    assert newHeader.getDimensions() == (5, 3, 2)
+    clearNiftiHeaderCache()
+    assert getCachedNiftiHeader(path) is not newHeader
+
+
+@pytest.mark.parametrize('contents', [b'', b'\0' * 400])
+def testNotNifti(tmp_path, contents):
+    path = tmp_path / 'image.nii'
+    path.write_bytes(contents)
+    with pytest.raises(ValueError):
+        readNiftiHeader(path)
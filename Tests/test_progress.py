@@ -0,0 +1,11 @@
+from NiftyRegLib.progress import EventLog, readEventLog
+
+
+def testEventLogOverwrites(tmp_path):
+    path = tmp_path / 'events.jsonl'
+    for run in range(2):
+        eventLog = EventLog(path)
+        eventLog.write({'run': run, 'event': 'start'})
+        eventLog.write({'run': run, 'event': 'end'})
+        eventLog.close()
+    assert readEventLog(path) == [{'run': 1, 'event': 'start'}, {'run': 1, 'event': 'end'}]
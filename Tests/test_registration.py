@@ -0,0 +1,19 @@
+from NiftyRegLib.parameters import RegistrationParameters
+from NiftyRegLib.registration import runOneToMany
+
+
+def testOneToManyWithoutReference(tmp_path):
+    """
+    Every floating image fails if the reference can not be prepared
+    """
+    parameters = RegistrationParameters('Affine', useMasks=True, referenceThresholds=(0, 1))
+    floPaths = [str(tmp_path / 'floating_{}.nii'.format(i)) for i in range(3)]
+    finished = []
+    results = list(runOneToMany(str(tmp_path / 'missing.nii'), floPaths, parameters, tmp_path / 'output',
+                                onJobFinished=finished.append))
+    assert results == finished
+    assert [result.index for result in results] == [0, 1, 2]
+    assert [result.floatingPath for result in results] == floPaths
+    for result in results:
+        assert result.returnCode is None
+        assert 'missing.nii' in result.errorOutput
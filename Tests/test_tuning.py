@@ -0,0 +1,20 @@
+import pytest
+
+from NiftyRegLib.parameters import RegistrationParameters
+from NiftyRegLib.tuning import getPyramidShapesMap, getTunedParameters
+
+
+def testPyramidShapesMap():
+    shapesMap = getPyramidShapesMap((256, 256, 100))
+    assert shapesMap == {0: [256, 256, 100], 1: [128, 128, 50]}
+
+
+@pytest.mark.parametrize('size, numberOfLevels', [(256, 4), (64, 2), (40, 1), (20, 1)])
+def testNumberOfLevels(size, numberOfLevels):
+    """
+    The coarsest level has sides of at least 32 voxels
+    """
+    shape = (size,) * 3
+    tuned = getTunedParameters(RegistrationParameters('Affine'), shape, shape,
+                               availableMemory=2**40, numberOfCores=4)
+    assert tuned.pyramidLevels == (numberOfLevels, numberOfLevels)
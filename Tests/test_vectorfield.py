@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from NiftyRegLib.vectorfield import (
+    VectorField,
+    ReferenceDisplacementField,
+    getDisplacementFieldImage,
+    DEF_FIELD,
+    DISP_FIELD,
+    CUB_SPLINE_GRID,
+)
+
+from images import writeNifti
+
+
+SHAPE = 4, 5, 6  # (z, y, x)
+DISPLACEMENT = np.array([1.5, -2, 0.25])
+
+
+def getAffine():
+    affine = np.identity(4)
+    affine[:3, :3] = np.diag([2, 1.5, 3])
+    affine[:3, 3] = -10, 20, 5
+    return affine
+
+
+def getPositions(affine):
+    """
+    RAS positions of the voxels, with shape (z, y, x, 3)
+    """
+    k, j, i = np.indices(SHAPE)
+    indices = np.stack([i, j, k, np.ones(SHAPE)], axis=-1)
+    return indices.dot(affine.T)[..., :3]
+
+
+def writeVectorField(path, vectors, affine, kind=None, **kwargs):
+    """
+    Writes vectors (z, y, x, 3) as the fifth dimension, as NiftyReg does
+    """
+    intent = None if kind is None else (b'NREG_TRANS', kind)
+    array = np.moveaxis(vectors, -1, 0)[:, np.newaxis].astype(np.float32)
+    writeNifti(path, array, affine=affine, intent=intent, **kwargs)
+
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def testConstantDisplacementField(tmp_path, extension):
+    path = tmp_path / ('displacement' + extension)
+    vectors = np.broadcast_to(DISPLACEMENT, SHAPE + (3,))
+    writeVectorField(path, vectors, getAffine(), kind=DISP_FIELD)
+    field = VectorField(path)
+    assert not field.storesPositions
+    displacement = field.getDisplacement()
+    assert displacement.shape == SHAPE + (3,)
+    np.testing.assert_allclose(displacement, vectors)
+
+
+@pytest.mark.parametrize('byteOrder', ['<', '>'])
+def testConstantDeformationField(tmp_path, byteOrder):
+    path = tmp_path / 'deformation.nii'
+    affine = getAffine()
+    writeVectorField(path, getPositions(affine) + DISPLACEMENT, affine, kind=DEF_FIELD, byteOrder=byteOrder)
+    displacement = VectorField(path).getDisplacement()
+    np.testing.assert_allclose(displacement, np.broadcast_to(DISPLACEMENT, displacement.shape), atol=1e-4)
+
+
+def testLPS(tmp_path):
+    path = tmp_path / 'displacement.nii'
+    writeVectorField(path, np.broadcast_to(DISPLACEMENT, SHAPE + (3,)), getAffine(), kind=DISP_FIELD)
+    out = np.empty(int(np.prod(SHAPE)) * 3, dtype=np.float32)
+    displacement = VectorField(path).getDisplacement(out=out, lps=True)
+    np.testing.assert_allclose(displacement[0, 0, 0], DISPLACEMENT * [-1, -1, 1])
+    np.testing.assert_allclose(out[:3], DISPLACEMENT * [-1, -1, 1])
+
+
+@pytest.mark.parametrize('referenceShape, storesPositions', [(SHAPE, False), ((9, 9, 9), True)])
+def testFieldWithoutIntent(tmp_path, referenceShape, storesPositions):
+    path = tmp_path / 'field.nii'
+    writeVectorField(path, np.zeros(SHAPE + (3,)), getAffine())
+    assert VectorField(path, referenceShape=referenceShape).storesPositions == storesPositions
+
+
+def writeSplineGrid(path, affine, shape=(4, 4, 5)):
+    """
+    Control point positions with random displacements, on a grid covering
+    the reference with two voxels between the points
+    """
+    gridAffine = affine.copy()
+    gridAffine[:3, :3] *= 2
+    gridAffine[:3, 3] -= gridAffine[:3, :3].sum(axis=1)
+    k, j, i = np.indices(shape)
+    indices = np.stack([i, j, k, np.ones(shape)], axis=-1)
+    positions = indices.dot(gridAffine.T)[..., :3]
+    noise = np.random.RandomState(0).normal(scale=0.5, size=shape + (3,))
+    writeVectorField(path, positions + noise, gridAffine, kind=CUB_SPLINE_GRID)
+
+
+@pytest.mark.parametrize('kind', [DISP_FIELD, CUB_SPLINE_GRID])
+def testReferenceDisplacementField(tmp_path, kind):
+    affine = getAffine()
+    referencePath = tmp_path / 'reference.nii'
+    writeNifti(referencePath, np.zeros(SHAPE, dtype=np.float32), affine=affine)
+    path = tmp_path / 'field.nii'
+    if kind == DISP_FIELD:
+        vectors = np.random.RandomState(0).normal(size=SHAPE + (3,))
+        writeVectorField(path, vectors, affine, kind=kind)
+    else:
+        writeSplineGrid(path, affine)
+    expected = sitk.GetArrayFromImage(getDisplacementFieldImage(path, sitk.ReadImage(str(referencePath))))
+    displacement = ReferenceDisplacementField(path, referencePath)
+    assert displacement.shape == SHAPE + (3,)
+    assert (displacement.transform is None) == (kind == DISP_FIELD)
+    np.testing.assert_allclose(displacement[1:3], expected[1:3], atol=1e-5)
+    np.testing.assert_allclose(displacement[:], expected, atol=1e-5)
+    assert displacement[2:2].shape == (0,) + SHAPE[1:] + (3,)
+
+
+def testNotVectorField(tmp_path):
+    path = tmp_path / 'image.nii'
+    writeNifti(path, np.zeros(SHAPE, dtype=np.float32), affine=getAffine())
+    with pytest.raises(ValueError):
+        VectorField(path)